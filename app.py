@@ -6,10 +6,24 @@ Escapade database.
 """
 
 import os
-from flask import Flask, abort, redirect, render_template, request, session
+import json
+import time
+from datetime import date, timedelta
+from urllib.parse import urlencode
+from flask import Flask, Response, abort, flash, jsonify, redirect, render_template, request, session
 from pathlib import Path
-from ss_api_functions import BrowseQuotes, BrowseQuotesFormatResults, CSVtoDict 
+from ss_api_functions import BrowseQuotes, BrowseQuotesErrors, BrowseQuotesFormatResults, CSVtoDict
+import ss_api_functions
 import db_functions
+import price_calendar
+import query_planner
+import quote_solver
+import results_query
+import search_jobs
+import storage_codec
+import write_behind
+from query_planner import (BrowseQuotesPlanned, checkSearchLimits, countSearchForm,
+                           estimateSearchCost, expandSearchForm, getSearchLimits)
 from helpers import sessionActive,login_required,apology,validFlightSearchQuery
 from werkzeug.security import check_password_hash, generate_password_hash
 
@@ -20,6 +34,14 @@ app.secret_key = os.urandom(24)
 # Ensure templates are auto-reloaded
 app.config["TEMPLATES_AUTO_RELOAD"] = True
 
+# How searches are run (refer to search_jobs.py):
+#   "sync": within the request, returning the results page when complete
+#   "async": as a background job, the browser polls for progress and then
+#            views the stored results
+#   "stream": the results page is returned immediately, and each quote is
+#             sent to it as soon as its API call completes
+app.config["SEARCH_MODE"] = "async"
+
 # Ensure responses aren't cashed
 @app.after_request
 def after_request(response):
@@ -29,10 +51,33 @@ def after_request(response):
     response.headers["Pragma"] = "no-cache"
     return response
 
-# Define datebase name, and if required create or update
-db = r"escapade.db"
+# Close the database connections of request threads that have finished. Each
+# thread reuses its own connection while it runs (refer to getConnection in
+# db_functions.py), and any remaining connections are closed at exit.
+@app.teardown_appcontext
+def teardown_db_connections(exception):
+    """Close finished threads' database connections"""
+    db_functions.pruneConnections()
+
+# Define datebase name, and if required create or update. ESCAPADE_DB may be
+# set to use a different database, e.g. for benchmarking
+db = os.environ.get("ESCAPADE_DB", r"escapade.db")
 db_functions.intialise(db)
 
+# Log searches and their results through a background writer, so requests do
+# not wait for them to be committed (refer to write_behind.py). Set
+# ESCAPADE_WRITE_BEHIND=1 to enable, only where a single app process logs
+# searches to the database.
+db_functions.writeBehind = os.environ.get("ESCAPADE_WRITE_BEHIND") == "1"
+
+# Store cached BrowseQuotes responses in a database next to escapade.db, so
+# they survive restarts and are shared by all app workers
+quote_cache_db = os.path.join(os.path.dirname(db), "escapade_cache.db")
+ss_api_functions.configureQuoteCache(db=quote_cache_db)
+
+# Restart any search jobs interrupted when the app last stopped
+search_jobs.resumeSearchJobs(db)
+
 
 # Define default values - TODO to be replaced by database and/or user defined parameters
 country = 'UK' # User's skyscanner home country
@@ -45,6 +90,15 @@ ss_places_csv = './data/results_places.csv'
 ss_places = CSVtoDict(ss_places_csv)
 
 
+@app.errorhandler(write_behind.WriteFailedError)
+def write_failed(e):
+    """
+    Reports a search or its results that the write-behind logger could not
+    store, found when a request went on to read it.
+    """
+    return apology("Your search could not be saved, please search again", 500), 500
+
+
 @app.route("/")
 def index():
     """Placeholder for home page"""
@@ -64,67 +118,83 @@ def search_bq():
                 destination_[0-N] (string): In the format Skyscanner PlaceId
                 outboundpartialdate_[0-N] (string): In the html date format yyyy-mm-dd
                 inboundpartialdate_[0-N] (string): In the html date format yyyy-mm-dd
+                confirmed (string): Optional, set once the user has confirmed a
+                long search
             TODO - placeholder - uses the globals country, currency and locale
 
         CALLS:
-            Passes data to BrowseQuotes in ss_api_functions.py
+            Checks the search against the user's limits, and estimates its cost,
+            using query_planner.py. If the search is predicted to take longer than
+            confirmSearchSeconds, returns confirm_bq.html showing the estimate and
+            resubmitting the form with confirmed set.
+
+            Passes data to BrowseQuotesPlanned in query_planner.py, or runs it
+            via search_jobs.py as configured by SEARCH_MODE
 
         RETURNS:
-            results_bq.html consisting of an automatically generated table
-            that contains the query results where:
-                resultsDict (list(of dictionaries)): From BrowseQuotes
+            Redirects to /search_results for the search, once it has run.
+
+            In "stream" SEARCH_MODE returns results_bq.html with an initially
+            empty table that is filled from /search_stream. In "async"
+            SEARCH_MODE, redirects to /search_status for the job.
     """
     # Reached via POST (form submitted)
     if request.method == "POST":
-    # Populate query dictionary with default location and form parameters
-        rows = int(request.form.get("rowNum"))
-        queryList = []
-        
-        # For each combination of destination and dates
-        for i in range(rows+1):
-            # Populate list of Origin places and Destination places
-            originplacesList = request.form.getlist("originplaces_" + str(i))
-            destinationplacesList = request.form.getlist("destinationplaces_" + str(i))
-            
-            # Populate list of outbound and inbound dates
-            outboundpartialdateString = request.form.get("outboundpartialdate_" + str(i))
-            inboundpartialdateString = request.form.get("inboundpartialdate_" + str(i))
+        if sessionActive():
+            user_id = session["user_id"]
+        else:
+            user_id = ""
+
+        # Reject oversized searches before building the query list
+        limits = getSearchLimits(user_id)
+        queryCount = countSearchForm(request.form, "inboundpartialdate")
+        if queryCount > limits["maxQueries"]:
+            return apology("Search has {} queries, the limit is {}".format(queryCount, limits["maxQueries"]))
+
+        # Populate query dictionary with default location and form parameters
+        queryList = expandSearchForm(request.form, "inboundpartialdate", country, currency, locale, adults)
 
-            outboundpartialdateList = outboundpartialdateString.split(",")
-            inboundpartialdateList = inboundpartialdateString.split(",")
-            
-            # Format multi-data lists into individual date and place itineraries and append to list
-            for originplace in originplacesList:
-                for destinationplace in destinationplacesList:
-                    for outboundDate in outboundpartialdateList:
-                        for inboundDate in inboundpartialdateList:
-                            queryList.append({'country' : country, 'currency': currency, 'locale' : locale, 'adults' : adults,
-                            'originplace': originplace,
-                            'destinationplace': destinationplace,
-                            'outboundpartialdate': outboundDate,
-                            'inboundpartialdate': inboundDate})
-       
         # Check search query values are valid - Raises error if not
         validFlightSearchQuery(queryList, ss_places)
 
+        # Estimate the cost of the search and check it against the user's limits
+        estimate = estimateSearchCost(queryList)
+        limitMessage = checkSearchLimits(estimate, limits)
+        if limitMessage:
+            return apology(limitMessage)
+
+        # Show long searches to the user to confirm before running them
+        if estimate["estimatedSeconds"] > query_planner.confirmSearchSeconds and not request.form.get("confirmed"):
+            return render_template("confirm_bq.html", estimate=estimate,
+                                   formItems=list(request.form.items(multi=True)))
+
         # Store the query  in the database before calling (to record timestamp)
-        if sessionActive():
-            user_id = session["user_id"]
-        else:
-            user_id = ""
-        
         search_id = db_functions.logBQQuery(db, user_id, queryList)  
 
-        # Call the Browse Quotes API endpoint and retreive raw results
-        results_json = BrowseQuotes(queryList)
-        
-        # Store the result in the database
-        db_functions.logBQResults(db, user_id, search_id, results_json) 
-        
+        # Show the results page straight away and stream the quotes into it
+        if app.config["SEARCH_MODE"] == "stream":
+            return render_template("results_bq.html", resultsDict=[],
+                                   streamUrl="/search_stream/" + str(search_id))
+
+        # Run the search in the background and show the user its progress
+        if app.config["SEARCH_MODE"] == "async":
+            job_id = search_jobs.submitSearchJob(db, user_id, search_id, queryList)
+            return redirect("/search_status/" + str(job_id))
+
+        # Call the Browse Quotes API endpoint and retreive raw results, optionally collapsing
+        # queries for many dates on the same route into month-level calls (refer to query_planner.py)
+        results_json = BrowseQuotesPlanned(queryList)
+
         # Format the results for interpretation be the return form
         resultsDict = BrowseQuotesFormatResults(results_json)
-        
-        return render_template("results_bq.html", resultsDict=resultsDict)
+        failedQueries = len(BrowseQuotesErrors(results_json))
+
+        # Store the raw and formatted results in the database
+        db_functions.logBQResults(db, user_id, search_id, results_json, resultsDict, failedQueries)
+
+        # Show the results page, which loads the results a page at a time
+        results_query.cacheResults(search_id, (resultsDict, failedQueries, len(queryList)))
+        return redirect("/search_results/" + str(search_id))
 
     # Reached via GET (display form)
     else:
@@ -161,35 +231,19 @@ def search_live2():
     """
     # Reached via POST (form submitted)
     if request.method == "POST":
-    # Populate query dictionary with default location and form parameters
-        rows = int(request.form.get("rowNum"))
-        queryList = []
-        
-        # For each combination of destination and dates
-        for i in range(rows+1):
-            # Populate list of Origin places and Destination places
-            originplacesList = request.form.getlist("originplaces_" + str(i))
-            destinationplacesList = request.form.getlist("destinationplaces_" + str(i))
-            
-            # Populate list of outbound and inbound dates
-            outboundpartialdateString = request.form.get("outboundpartialdate_" + str(i))
-            inbounddateString = request.form.get("inbounddate_" + str(i))
-
-            outboundpartialdateList = outboundpartialdateString.split(",")
-            inbounddateList = inbounddateString.split(",")
-            
-            # Format multi-data lists into individual date and place itineraries and append to list
-            for originplace in originplacesList:
-                for destinationplace in destinationplacesList:
-                    for outboundDate in outboundpartialdateList:
-                        for inboundDate in inbounddateList:
-                            queryList.append({'country' : country, 'currency': currency, 'locale' : locale, 'adults' : adults,
-                            'originplace': originplace,
-                            'destinationplace': destinationplace,
-                            'outboundpartialdate': outboundDate,
-                            'inbounddate': inboundDate})
+        if sessionActive():
+            user_id = session["user_id"]
+        else:
+            user_id = ""
 
+        # Reject oversized searches before building the query list
+        limits = getSearchLimits(user_id)
+        queryCount = countSearchForm(request.form, "inbounddate")
+        if queryCount > limits["maxQueries"]:
+            return apology("Search has {} queries, the limit is {}".format(queryCount, limits["maxQueries"]))
 
+        # Populate query dictionary with default location and form parameters
+        queryList = expandSearchForm(request.form, "inbounddate", country, currency, locale, adults)
 
         # Return the results to the user
         return render_template("results_live.html", resultsDict={})
@@ -209,6 +263,12 @@ def search_history():
 
         Builds the search history table with data and fields from the
         search_bq_log database, with form submission names links to search_ids.
+        Shows one page of searches, newest first. The full query of a search
+        is loaded from /api/search_query when its row is expanded.
+
+        INPUTS:
+            Optional query string argument:
+                before (integer): Show the searches older than this search_id
 
     POST - "rerun":
         INPUTS:
@@ -217,12 +277,15 @@ def search_history():
             search_bq query.
 
         CALLS:
-            Passes data to BrowseQuotes in ss_api_functions.py
+            Passes data to BrowseQuotesPlanned in query_planner.py, or runs it
+            via search_jobs.py as configured by SEARCH_MODE
 
         RETURNS:
-            results_bq.html consisting of an automatically generated table
-            that contains the query results where:
-                resultsDict (list(of dictionaries)): From Browse Quotes
+            Redirects to /search_results for the search, once it has run.
+
+            In "stream" SEARCH_MODE returns results_bq.html with an initially
+            empty table that is filled from /search_stream. In "async"
+            SEARCH_MODE, redirects to /search_status for the job.
 
         DATABASE:
             Stores the search query, raw results and formatted results in the
@@ -230,18 +293,11 @@ def search_history():
 
     POST - "view_results"  :
         INPUTS:
-            Using the search_id submitted with the POST form, retreives the
-            associated raw search results.
-
-        CALLS:
-            Formats the raw results from the database using BrowseQuotesFormatResults
-            in ss-ss_api_functions.py.
+            The search_id submitted with the POST form.
 
         RETURNS:
-            results_bq.html consisting of an automatically generated table
-            that contains the query results where:
-                resultsDict (list(of dictionaries)): Formatted from results
-                retreived from the database.
+            Redirects to /search_results for the search, which loads the stored
+            results a page at a time.
 
         DATABASE:
             N/A: Makes no changess
@@ -265,37 +321,419 @@ def search_history():
                 user_id = session["user_id"]
             else:
                 user_id = ""
+
+            # Check the cost of the search against the user's limits
+            limitMessage = checkSearchLimits(estimateSearchCost(queryList), getSearchLimits(user_id))
+            if limitMessage:
+                return apology(limitMessage)
             
             search_id = db_functions.logBQQuery(db, user_id, queryList)  
 
-            # Call the Browse Quotes API endpoint and retreive raw results
-            results_json = BrowseQuotes(queryList)
-            
-            # Store the result in the database
-            db_functions.logBQResults(db, user_id, search_id, results_json) 
+            # Show the results page straight away and stream the quotes into it
+            if app.config["SEARCH_MODE"] == "stream":
+                return render_template("results_bq.html", resultsDict=[],
+                                       streamUrl="/search_stream/" + str(search_id))
+
+            # Run the search in the background and show the user its progress
+            if app.config["SEARCH_MODE"] == "async":
+                job_id = search_jobs.submitSearchJob(db, user_id, search_id, queryList)
+                return redirect("/search_status/" + str(job_id))
+
+            # Call the Browse Quotes API endpoint and retreive raw results, optionally collapsing
+            # queries for many dates on the same route into month-level calls (refer to query_planner.py)
+            results_json = BrowseQuotesPlanned(queryList)
 
             # Format the results for interpretation be the return form
             resultsDict = BrowseQuotesFormatResults(results_json)
+            failedQueries = len(BrowseQuotesErrors(results_json))
+
+            # Store the raw and formatted results in the database
+            db_functions.logBQResults(db, user_id, search_id, results_json, resultsDict, failedQueries)
+            results_query.cacheResults(search_id, (resultsDict, failedQueries, len(queryList)))
 
         # If retreive results selected on POST
         else:
             # Get the search ID
             search_id = request.form.get("view_results")
 
-            # Retreive the raw historic results for the search-id from the database
-            results_json = db_functions.getSearchResult(db, search_id)
+        # Show the results page, which loads the results a page at a time
+        return redirect("/search_results/" + str(search_id))
 
-            # Format the results for interpretation be the return form
-            resultsDict = BrowseQuotesFormatResults(results_json)
+    else:
+        #For GET - Retreive a page of the user's search history from the database
+        before = request.args.get("before", type=int)
+        userSearchHistory = db_functions.getUserSearchHistory(db, session["user_id"], before) or []
 
-        # Return the results to the user
-        return render_template("results_bq.html", resultsDict=resultsDict)
+        # The last search_id of a full page starts the next page
+        nextBefore = None
+        if len(userSearchHistory) == db_functions.historyPageSize:
+            nextBefore = userSearchHistory[-1]["search_id"]
 
-    else:
-        #For GET - Retreive the user's search history from the database
-        userSearchHistory = db_functions.getUserSearchHistory(db, session["user_id"])
+        return render_template("search_history.html", searchHistory=userSearchHistory,
+                               firstPage=before is None, nextBefore=nextBefore)
+
+
+@app.route("/api/search_query/<int:search_id>")
+@login_required
+def api_search_query(search_id):
+    """
+    Returns the full query list of a logged search as json, loaded when a row
+    of search_history.html is expanded.
 
-        return render_template("search_history.html", searchHistory=userSearchHistory)
+    DATABASE:
+        N/A: Makes no changes
+    """
+    if db_functions.getSearchUser(db, search_id) != session.get("user_id"):
+        abort(404)
+
+    return jsonify(db_functions.getSearchQuery(db, search_id))
+
+
+@app.route("/search_status/<int:job_id>")
+def search_status(job_id):
+    """
+    Presents search_status.html, which polls /api/search_jobs/<job_id> to show
+    the progress of a background search, and then loads its results.
+    """
+    job = db_functions.getSearchJob(db, job_id)
+    if job is None or job["user_id"] != session.get("user_id", ""):
+        abort(404)
+
+    return render_template("search_status.html", job=job)
+
+
+@app.route("/api/search_jobs/<int:job_id>")
+def search_job_api(job_id):
+    """
+    Returns the status of a background search job as json, with the keys from
+    the search_jobs table and resultsUrl once the job is done.
+    """
+    job = db_functions.getSearchJob(db, job_id)
+    if job is None or job["user_id"] != session.get("user_id", ""):
+        abort(404)
+
+    if job["status"] == "done":
+        job["resultsUrl"] = "/search_results/" + str(job["search_id"])
+
+    return jsonify(job)
+
+
+@app.route("/search_results/<int:search_id>")
+def search_results(search_id):
+    """
+    Presents results_bq.html for the stored results of a search, for example
+    once a search or a background search job is done. The table loads the
+    results a page at a time from /api/results.
+
+    INPUTS:
+        Optional query string arguments, passed on to /api/results:
+            cheapest (string): Show only the cheapest quote per "origin",
+            "destination", "carrier", "outboundDate" or "inboundDate"
+            maxPrice (number): Show only quotes up to this price
+            direct (string): If "1", show only direct trips
+
+    DATABASE:
+        N/A: Makes no changes
+    """
+    if db_functions.getSearchUser(db, search_id) != session.get("user_id", ""):
+        abort(404)
+
+    # Results are only stored once a search completes, e.g. not for a job
+    # still running or failed, or a stream the browser left. A job that is
+    # done has no results to wait for, and its status page would send the
+    # browser straight back here
+    if not db_functions.searchHasResults(db, search_id):
+        job = db_functions.getSearchJobForSearch(db, search_id)
+        if job is None or job["status"] == "done":
+            return apology("No results are stored for this search", 404), 404
+        flash("This search has no stored results yet")
+        return redirect("/search_status/" + str(job["job_id"]))
+
+    # Let the user know if any queries failed, rather than silently omit them
+    resultsDict, failedQueries, numQueries = results_query.getResults(db, search_id)
+    if failedQueries:
+        flash("{} of {} queries could not be completed".format(failedQueries, numQueries))
+
+    resultsUrl = "/api/results/" + str(search_id)
+    if request.query_string:
+        resultsUrl += "?" + request.query_string.decode()
+
+    return render_template("results_bq.html", resultsDict=[], resultsUrl=resultsUrl,
+                           viewsUrl=request.path, insightsUrl="/search_insights/" + str(search_id))
+
+
+@app.route("/api/results/<int:search_id>")
+def api_results(search_id):
+    """
+    Returns a page of the formatted results of a stored search as json, for the
+    server-side processing mode of DataTables in results_bq.html.
+
+    INPUTS:
+        Query string arguments:
+            draw, start, length, search[value], order[0][column],
+            order[0][dir]: As sent by DataTables, refer to
+            https://datatables.net/manual/server-side
+            cheapest, maxPrice, direct: As for /search_results
+            minPrice (number): Only quotes from this price
+            origin, destination (string): Only places whose name contains
+            the text
+            outboundFrom, outboundTo (string): Only outbound dates in this
+            range, in the format yyyy-mm-dd
+
+    RETURNS:
+        json with the keys "draw", "recordsTotal", "recordsFiltered" and "data",
+        where data is a list of rows in the order of the results table columns.
+
+    DATABASE:
+        N/A: Makes no changes
+    """
+    if db_functions.getSearchUser(db, search_id) != session.get("user_id", ""):
+        abort(404)
+    if not db_functions.searchHasResults(db, search_id):
+        abort(404)
+
+    try:
+        query = results_query.parseResultsRequest(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    resultsDict, failedQueries, numQueries = results_query.getResults(db, search_id)
+    page, recordsFiltered = results_query.queryResults(resultsDict, **query)
+
+    return jsonify({"draw": request.args.get("draw", 0, type=int),
+                    "recordsTotal": len(resultsDict),
+                    "recordsFiltered": recordsFiltered,
+                    "data": [results_query.resultRow(quote) for quote in page]})
+
+
+@app.route("/api/v1/search", methods=["POST"])
+def api_v1_search():
+    """
+    Runs a search for programmatic clients, streaming the formatted quotes back
+    as newline delimited json (NDJSON) as soon as the API call for each query
+    completes, rather than rendering results_bq.html.
+
+    INPUTS:
+        A json body, either a list of queries or an object with the key
+        "queries". Each query is an object in the format of formatBqUrl in
+        ss_api_functions.py: "originplace", "destinationplace" and
+        "outboundpartialdate" are required, and "inboundpartialdate",
+        "country", "currency", "locale" and "adults" are optional (refer to
+        parseQueryList in query_planner.py).
+
+    RETURNS:
+        400 or 403 with a json "error" if the queries are invalid or over the
+        user's search limits. Otherwise application/x-ndjson, one json object
+        per line, each with a "type":
+            "search": First, with the "search_id" and number of "queries"
+            "quote": A formatted quote (refer to BrowseQuotesFormatResults),
+                with the "queryIndex" of the query it answers
+            "error": A query with the "queryIndex" could not be completed
+            "done": Last, with the number of "quotes" and "failedQueries"
+
+    DATABASE:
+        Logs the search, and stores its results once every query has
+        completed, as for search_bq.
+    """
+    user_id = session.get("user_id", "")
+
+    payload = request.get_json(silent=True)
+    if isinstance(payload, dict):
+        payload = payload.get("queries")
+
+    try:
+        queryList = query_planner.parseQueryList(payload, country, currency, locale, adults)
+        validFlightSearchQuery(queryList, ss_places)
+    except (ValueError, AssertionError) as e:
+        return jsonify({"error": str(e)}), 400
+
+    # Apply the same limits as a search from search_bq
+    limits = getSearchLimits(user_id)
+    if len(queryList) > limits["maxQueries"]:
+        return jsonify({"error": "Search has {} queries, the limit is {}".format(
+            len(queryList), limits["maxQueries"])}), 403
+    limitMessage = checkSearchLimits(estimateSearchCost(queryList), limits)
+    if limitMessage:
+        return jsonify({"error": limitMessage}), 403
+
+    search_id = db_functions.logBQQuery(db, user_id, queryList)
+
+    def generateLines():
+        yield storage_codec.dumpsJson({"type": "search", "search_id": search_id,
+                                       "queries": len(queryList)}) + b"\n"
+        quotes = 0
+        failedQueries = 0
+        for queryIndex, formattedResults, failed in search_jobs.streamSearch(db, user_id, search_id, queryList):
+            if failed:
+                failedQueries += 1
+                yield storage_codec.dumpsJson({"type": "error", "queryIndex": queryIndex}) + b"\n"
+            for formattedResult in formattedResults:
+                quote = formattedResult.asDict()
+                quote["type"] = "quote"
+                quote["queryIndex"] = queryIndex
+                quotes += 1
+                yield storage_codec.dumpsJson(quote) + b"\n"
+        yield storage_codec.dumpsJson({"type": "done", "quotes": quotes,
+                                       "failedQueries": failedQueries}) + b"\n"
+
+    return Response(generateLines(), mimetype="application/x-ndjson",
+                    headers={"X-Accel-Buffering": "no"})
+
+
+@app.route("/search_insights/<int:search_id>")
+def search_insights(search_id):
+    """
+    Presents insights.html, with the cheapest destinations from each origin,
+    the cheapest destinations common to every origin, and the cheapest date
+    pairs for a stored search, using quote_solver.py. Makes no API calls.
+
+    INPUTS:
+        Optional query string arguments:
+            cached (string): If "0", use only the stored results, not the
+            more recent responses in the quote cache
+            sameDates (string): If "1", common destinations must share the
+            same dates from every origin
+            windowStart, windowEnd (string): Date pairs must fall within
+            these dates, in the format yyyy-mm-dd
+            minNights, maxNights (integer): Limits on the nights of the date
+            pairs
+
+    DATABASE:
+        N/A: Makes no changes
+    """
+    if db_functions.getSearchUser(db, search_id) != session.get("user_id", ""):
+        abort(404)
+    if not db_functions.searchHasResults(db, search_id):
+        abort(404)
+
+    windowStart = request.args.get("windowStart", "")
+    windowEnd = request.args.get("windowEnd", "")
+    for windowDate in (windowStart, windowEnd):
+        if windowDate and not query_planner.isExactDate(windowDate):
+            return apology("Dates must be in the format yyyy-mm-dd", 400)
+
+    quotes, cachedQueries = quote_solver.gatherQuotes(db, search_id, request.args.get("cached") != "0")
+
+    perOrigin = quote_solver.cheapestPerOrigin(quotes)
+    common = quote_solver.cheapestCommonDestination(quotes, sameDates=request.args.get("sameDates") == "1")
+    datePairs = quote_solver.cheapestDatePairs(quotes, windowStart or None, windowEnd or None,
+                                               request.args.get("minNights", type=int),
+                                               request.args.get("maxNights", type=int))
+
+    return render_template("insights.html", search_id=search_id, cachedQueries=cachedQueries,
+                           perOrigin=perOrigin, common=common, datePairs=datePairs)
+
+
+@app.route("/calendar", methods=["GET", "POST"])
+def calendar():
+    """
+    GET:
+        Presents calendar.html, a heatmap of the cheapest price on a route for
+        each outbound date and number of nights away, from the price_calendar
+        table (refer to price_calendar.py). Makes no API calls.
+
+        INPUTS:
+            Optional query string arguments:
+                origin, destination (string): Skyscanner PlaceIds of the route
+                start (string): The first outbound date, yyyy-mm-dd
+                days (integer): The number of outbound dates
+                minNights, maxNights (integer): The range of nights away
+
+    POST:
+        Fills the cells of the calendar that are missing or out of date, by
+        searching for only those date pairs, then redirects to GET.
+
+        INPUTS:
+            As for GET, via request.form.
+
+        DATABASE:
+            Logs the search and its results, which updates the price_calendar
+            table through logBQResults.
+    """
+    args = request.form if request.method == "POST" else request.args
+    try:
+        calendarRequest = price_calendar.parseCalendarRequest(args)
+    except ValueError as e:
+        return apology(str(e))
+
+    origin, destination = calendarRequest["origin"], calendarRequest["destination"]
+    start, days = calendarRequest["start"], calendarRequest["days"]
+
+    grid = []
+    if origin and destination:
+        end = start + timedelta(days=days - 1)
+        calendarRows = db_functions.getPriceCalendar(db, origin, destination, currency,
+                                                     start.isoformat(), end.isoformat())
+        grid = price_calendar.calendarGrid(calendarRows, start, days, calendarRequest["minNights"],
+                                           calendarRequest["maxNights"], time.time())
+
+    queryList = price_calendar.missingQueries(grid, origin, destination, country, currency, locale,
+                                              adults, date.today())
+
+    if request.method == "POST" and queryList:
+        user_id = session.get("user_id", "")
+
+        # Apply the same checks as a search from search_bq
+        validFlightSearchQuery(queryList, ss_places)
+        limits = getSearchLimits(user_id)
+        if len(queryList) > limits["maxQueries"]:
+            return apology("Search has {} queries, the limit is {}".format(len(queryList), limits["maxQueries"]))
+        limitMessage = checkSearchLimits(estimateSearchCost(queryList), limits)
+        if limitMessage:
+            return apology(limitMessage)
+
+        # Search for the missing cells. Storing the results fills the calendar.
+        search_id = db_functions.logBQQuery(db, user_id, queryList)
+        results_json = BrowseQuotesPlanned(queryList)
+        resultsDict = BrowseQuotesFormatResults(results_json)
+        failedQueries = len(BrowseQuotesErrors(results_json))
+        db_functions.logBQResults(db, user_id, search_id, results_json, resultsDict, failedQueries)
+        if failedQueries:
+            flash("{} of {} queries could not be completed".format(failedQueries, len(queryList)))
+
+    if request.method == "POST":
+        return redirect("/calendar?" + urlencode({key: args.get(key, "") for key in
+                                                 ("origin", "destination", "start", "days",
+                                                  "minNights", "maxNights")}))
+
+    return render_template("calendar.html", ss_places=ss_places, calendarRequest=calendarRequest,
+                           grid=grid, missingCells=len(queryList), currency=currency)
+
+
+@app.route("/search_stream/<int:search_id>")
+def search_stream(search_id):
+    """
+    Streams the formatted results of a logged search as server-sent events,
+    running the search if it has not already been run. Each event carries
+    one formatted quote as json, as soon as the API call for its query
+    completes. A final "done" event carries the number of failed queries.
+
+    DATABASE:
+        Stores the raw results once every query has completed.
+    """
+    user_id = session.get("user_id", "")
+    if db_functions.getSearchUser(db, search_id) != user_id:
+        abort(404)
+
+    if db_functions.searchHasResults(db, search_id):
+        # Already run (e.g. the page was reloaded) - send the stored results
+        results_json = db_functions.getSearchResult(db, search_id)
+        queryResults = ((queryIndex, BrowseQuotesFormatResults([result]), bool(BrowseQuotesErrors([result])))
+                        for queryIndex, result in enumerate(results_json))
+    else:
+        queryList = db_functions.getSearchQuery(db, search_id)
+        queryResults = search_jobs.streamSearch(db, user_id, search_id, queryList)
+
+    def generateEvents():
+        failed = 0
+        for queryIndex, formattedResults, queryFailed in queryResults:
+            failed += queryFailed
+            for formattedResult in formattedResults:
+                yield "data: " + json.dumps(formattedResult.asDict()) + "\n\n"
+        yield "event: done\ndata: " + json.dumps({"failed": failed}) + "\n\n"
+
+    return Response(generateEvents(), mimetype="text/event-stream",
+                    headers={"X-Accel-Buffering": "no"})
 
 
 @app.route("/register", methods=["GET", "POST"])
@@ -0,0 +1,472 @@
+"""
+This file contains the Escapade performance benchmarks. They run against the
+local stand-in API in mock_ss_server.py, so that results are reproducible and
+no RapidAPI quota is used.
+
+    python benchmark.py routes --searches 200 --concurrency 8 --latency 0.2
+
+The "routes" benchmark drives the real app.py routes (via the Flask test
+client) with concurrent searches, and reports throughput and p50/p95/p99
+latency. The app uses a temporary database, so escapade.db is not touched.
+With --mode api the searches are posted as json to /api/v1/search, and the
+NDJSON response read in full.
+
+The "formatter" benchmark times BrowseQuotesFormatResults on synthetic
+responses with many quotes and carriers. The "table" benchmark compares
+filterResults in plain Python with the columnar QuoteTable on large result sets.
+The "codec" benchmark compares the storage codecs for stored results, by
+read/write throughput and database size. The "database" benchmark runs
+concurrent readers of search history and writers of search results, with the
+earlier rollback journal settings, with WAL (refer to intialise in
+db_functions.py), and with WAL and the write-behind logger (refer to
+write_behind.py).
+"""
+
+import argparse
+import datetime
+import logging
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.serving import make_server
+import mock_ss_server
+
+
+def percentile(values, pct):
+    """
+    Returns the pct percentile of a list of numbers, by linear interpolation.
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * pct / 100.0
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def reportLatencies(name, latencies, elapsed):
+    """
+    Prints the count, throughput and latency percentiles for a set of timings.
+
+    Args:
+        name(string): A label for the measurement.
+
+        latencies(list(of floats)): Seconds taken by each operation.
+
+        elapsed(float): Total wall-clock seconds over which they ran.
+    """
+    print("{}: {} operations in {:.2f}s, {:.1f}/s".format(
+        name, len(latencies), elapsed, len(latencies) / elapsed if elapsed else 0))
+    if latencies:
+        print("    mean {:.1f}ms  p50 {:.1f}ms  p95 {:.1f}ms  p99 {:.1f}ms  max {:.1f}ms".format(
+            statistics.mean(latencies) * 1000, percentile(latencies, 50) * 1000,
+            percentile(latencies, 95) * 1000, percentile(latencies, 99) * 1000,
+            max(latencies) * 1000))
+
+
+def startMockServer():
+    """
+    Starts mock_ss_server in a background thread on a free port.
+
+    Returns:
+        baseUrl(string): The base URL to use for the Skyscanner API.
+    """
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, mock_ss_server.createMockApp(), threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return "http://127.0.0.1:{}".format(server.server_port)
+
+
+def loadApp(workDir):
+    """
+    Imports app.py using a database in workDir, so that benchmarks do not
+    write to escapade.db.
+
+    Returns:
+        app(module): The imported app module.
+    """
+    os.environ["ESCAPADE_DB"] = os.path.join(workDir, "benchmark.db")
+    import app
+
+    return app
+
+
+def buildSearchForm(placeCodes, rng, numOrigins, numDestinations, numDates):
+    """
+    Builds a search_bq form for a random search, for a single row with the
+    given numbers of origins, destinations and outbound dates.
+    """
+    startDate = datetime.date.today() + datetime.timedelta(days=rng.randint(30, 200))
+    outboundDates = [str(startDate + datetime.timedelta(days=day)) for day in range(numDates)]
+    inboundDate = str(startDate + datetime.timedelta(days=numDates + 7))
+
+    return {"rowNum": "0",
+            "originplaces_0": rng.sample(placeCodes, numOrigins),
+            "destinationplaces_0": rng.sample(placeCodes, numDestinations),
+            "outboundpartialdate_0": ",".join(outboundDates),
+            "inboundpartialdate_0": inboundDate,
+            "confirmed": "1"}
+
+
+def benchmarkRoutes(args):
+    """
+    Runs concurrent searches through the app routes against the mock API.
+    """
+    mock_ss_server.mockSettings.update({"latency": args.latency, "latencyJitter": args.latency / 4,
+                                        "errorRate": args.error_rate, "numQuotes": args.quotes})
+    baseUrl = startMockServer()
+
+    workDir = tempfile.mkdtemp(prefix="escapade_benchmark_")
+    app = loadApp(workDir)
+    import ss_api_functions, query_planner
+    from werkzeug.datastructures import MultiDict
+
+    ss_api_functions.apiBaseUrl = baseUrl
+    ss_api_functions.rateLimitPerSecond = args.rate_limit
+    ss_api_functions.rateLimitBurst = args.rate_limit
+    ss_api_functions.bqMaxWorkers = args.workers
+    if args.no_cache:
+        ss_api_functions.quoteCacheTTL = 0
+    for limits in query_planner.searchLimits.values():
+        limits.update({"maxQueries": 100000, "maxApiCalls": 100000})
+    app.app.config["SEARCH_MODE"] = "sync" if args.mode == "api" else args.mode
+    app.app.config["TESTING"] = True
+
+    # A fixed set of distinct searches, repeated to make up the total
+    rng = random.Random(args.seed)
+    placeCodes = [place["PlaceId"] for place in app.ss_places]
+    forms = [buildSearchForm(placeCodes, rng, args.origins, args.destinations, args.dates)
+             for i in range(args.distinct)]
+
+    if args.mode == "api":
+        queryLists = [query_planner.expandSearchForm(MultiDict(form), "inboundpartialdate", app.country,
+                                                     app.currency, app.locale, app.adults)
+                      for form in forms]
+
+    def runSearch(number):
+        client = app.app.test_client()
+        start = time.perf_counter()
+        if args.mode == "api":
+            response = client.post("/api/v1/search", json=queryLists[number % len(forms)])
+            response.get_data()
+            return time.perf_counter() - start, response.status_code
+        response = client.post("/search_bq", data=forms[number % len(forms)])
+        if args.mode == "stream":
+            streamUrl = response.get_data(as_text=True).split('streamResults(table, "')[1].split('"')[0]
+            response = client.get(streamUrl)
+            response.get_data()
+        return time.perf_counter() - start, response.status_code
+
+    print("Running {} searches ({} distinct) of {} queries each, {} at a time, mode {}".format(
+        args.searches, args.distinct, args.origins * args.destinations * args.dates,
+        args.concurrency, args.mode))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        outcomes = list(executor.map(runSearch, range(args.searches)))
+    elapsed = time.perf_counter() - start
+
+    latencies = [latency for latency, status in outcomes if status < 400]
+    reportLatencies("searches", latencies, elapsed)
+    quotaStatus = ss_api_functions.getQuotaStatus()
+    print("    failed searches {}  mock API calls {}  mock errors {}  client retries {}".format(
+        len(outcomes) - len(latencies), mock_ss_server.mockStats["browseQuotes"],
+        mock_ss_server.mockStats["errors"], quotaStatus["retries"]))
+
+
+def benchmarkFormatter(args):
+    """
+    Times BrowseQuotesFormatResults on synthetic responses, for all quotes and
+    for the cheapest quote per route and date.
+    """
+    from ss_api_functions import BrowseQuotesFormatResults
+
+    placeCodes = [place["PlaceCode"] for place in mock_ss_server.getPlaces()]
+    rng = random.Random(args.seed)
+    responses = [mock_ss_server.syntheticBrowseQuotes(rng.choice(placeCodes), rng.choice(placeCodes),
+                                                      "2030-01", "2030-02", args.quotes, args.carriers)
+                 for i in range(args.responses)]
+    print("Formatting {} responses of {} quotes and {} carriers, {} times".format(
+        args.responses, args.quotes, args.carriers, args.repeat))
+
+    for cheapestOnly in (False, True):
+        latencies = []
+        start = time.perf_counter()
+        for i in range(args.repeat):
+            for response in responses:
+                callStart = time.perf_counter()
+                formatted = BrowseQuotesFormatResults([response], cheapestOnly=cheapestOnly)
+                latencies.append(time.perf_counter() - callStart)
+        elapsed = time.perf_counter() - start
+        reportLatencies("cheapestOnly={} ({} rows per response)".format(cheapestOnly, len(formatted)),
+                        latencies, elapsed)
+
+    # Memory held per formatted quote, as records and as plain dictionaries
+    tracemalloc.start()
+    formatted = BrowseQuotesFormatResults(responses)
+    recordBytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    tracemalloc.start()
+    dictionaries = [quote.asDict() for quote in formatted]
+    dictionaryBytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print("memory per quote: {:.0f} bytes as Quote records, {:.0f} bytes as dictionaries".format(
+        recordBytes / len(formatted), dictionaryBytes / len(dictionaries)))
+
+
+def benchmarkTable(args):
+    """
+    Times filterResults on a large formatted result set, in plain Python and
+    using QuoteTable.
+    """
+    import quote_table
+    from ss_api_functions import BrowseQuotesFormatResults
+
+    placeCodes = [place["PlaceCode"] for place in mock_ss_server.getPlaces()]
+    rng = random.Random(args.seed)
+    responses = [mock_ss_server.syntheticBrowseQuotes(rng.choice(placeCodes), rng.choice(placeCodes),
+                                                      "2030-01", "2030-02", args.quotes)
+                 for i in range(args.rows // args.quotes)]
+    resultsDict = BrowseQuotesFormatResults(responses)
+    print("Filtering {} quotes, {} times".format(len(resultsDict), args.repeat))
+
+    thresholds = [("python", len(resultsDict) + 1)]
+    if quote_table.numpyAvailable():
+        thresholds.append(("columnar", 0))
+    for name, columnarMinRows in thresholds:
+        quote_table.columnarMinRows = columnarMinRows
+        for cheapestBy, maxPrice, directOnly in ((None, None, False), ("destination", None, False),
+                                                 ("outboundDate", 200, True)):
+            latencies = []
+            start = time.perf_counter()
+            for i in range(args.repeat):
+                callStart = time.perf_counter()
+                quote_table.filterResults(resultsDict, cheapestBy, maxPrice, directOnly)
+                latencies.append(time.perf_counter() - callStart)
+            reportLatencies("{} cheapestBy={} maxPrice={} directOnly={}".format(
+                name, cheapestBy, maxPrice, directOnly), latencies, time.perf_counter() - start)
+
+    if not quote_table.numpyAvailable():
+        return
+    start = time.perf_counter()
+    table = quote_table.QuoteTable(resultsDict)
+    for column in ("price", "direct", "destination", "outboundDate"):
+        table.column(column)
+    print("columnar table built in {:.1f}ms, then reused:".format((time.perf_counter() - start) * 1000))
+    for name, operation in (("sortByPrice", lambda: table.sortByPrice().toRows()),
+                            ("cheapestBy destination", lambda: table.cheapestBy("destination").toRows()),
+                            ("filter then cheapestBy outboundDate",
+                             lambda: table.filter(maxPrice=200, directOnly=True).cheapestBy("outboundDate").toRows()),
+                            ("rankBy destination", lambda: table.rankBy("destination"))):
+        latencies = []
+        start = time.perf_counter()
+        for i in range(args.repeat):
+            callStart = time.perf_counter()
+            operation()
+            latencies.append(time.perf_counter() - callStart)
+        reportLatencies("reused " + name, latencies, time.perf_counter() - start)
+
+
+def benchmarkCodec(args):
+    """
+    Writes and reads back stored search results with each storage codec, and
+    reports the throughput and the size of the database file.
+    """
+    import db_functions
+    import storage_codec
+
+    placeCodes = [place["PlaceCode"] for place in mock_ss_server.getPlaces()]
+    rng = random.Random(args.seed)
+    searches = [[mock_ss_server.syntheticBrowseQuotes(rng.choice(placeCodes), rng.choice(placeCodes),
+                                                      "2030-01", "2030-02", args.quotes)
+                 for i in range(args.responses)]
+                for j in range(args.searches)]
+    print("Storing {} searches of {} responses, each of {} quotes, using {}".format(
+        args.searches, args.responses, args.quotes,
+        "orjson" if storage_codec.orjson is not None else "json"))
+
+    workDir = tempfile.mkdtemp(prefix="escapade_benchmark_")
+    for codec in storage_codec.availableCodecs():
+        storage_codec.storageCodec = codec
+        db = os.path.join(workDir, "codec_{}.db".format(codec))
+        db_functions.intialise(db)
+
+        latencies = []
+        start = time.perf_counter()
+        for search_id, results_json in enumerate(searches, 1):
+            callStart = time.perf_counter()
+            db_functions.logBQResults(db, "", search_id, results_json)
+            latencies.append(time.perf_counter() - callStart)
+        reportLatencies("{} write".format(codec), latencies, time.perf_counter() - start)
+
+        latencies = []
+        start = time.perf_counter()
+        for search_id in range(1, len(searches) + 1):
+            callStart = time.perf_counter()
+            db_functions.getSearchResult(db, search_id)
+            latencies.append(time.perf_counter() - callStart)
+        reportLatencies("{} read".format(codec), latencies, time.perf_counter() - start)
+        print("    database size {:,} bytes".format(os.path.getsize(db)))
+
+
+def benchmarkDatabase(args):
+    """
+    Runs concurrent readers and writers against a database in each journal
+    mode, and reports the latency of each.
+    """
+    import db_functions
+
+    placeCodes = [place["PlaceCode"] for place in mock_ss_server.getPlaces()]
+    rng = random.Random(args.seed)
+    searches = [[mock_ss_server.syntheticBrowseQuotes(rng.choice(placeCodes), rng.choice(placeCodes),
+                                                      "2030-01", "2030-02", args.quotes)
+                 for i in range(args.responses)]
+                for j in range(20)]
+    query = [{"country": "UK", "currency": "GBP", "locale": "en-GB", "adults": "1",
+              "originplace": "LHR-sky", "destinationplace": "JFK-sky",
+              "outboundpartialdate": "2030-01", "inboundpartialdate": "2030-02"}]
+
+    # The settings before WAL, with SQLite's default synchronous=FULL, then
+    # WAL with writes made in the calling thread, and through the write-behind
+    # logger
+    settings = [("rollback journal", "DELETE", ["PRAGMA busy_timeout={}".format(db_functions.connectionTimeout * 1000)],
+                 False),
+                ("WAL", "WAL", db_functions.connectionPragmas, False),
+                ("WAL write-behind", "WAL", db_functions.connectionPragmas, True)]
+    print("{} readers and {} writers for {}s, results of {} responses".format(
+        args.readers, args.writers, args.seconds, args.responses))
+
+    workDir = tempfile.mkdtemp(prefix="escapade_benchmark_")
+    for name, journalMode, pragmas, writeBehind in settings:
+        db_functions.journalMode = journalMode
+        db_functions.connectionPragmas = pragmas
+        db_functions.writeBehind = writeBehind
+        db = os.path.join(workDir, "database_{}{}.db".format(journalMode.lower(), "_write_behind" * writeBehind))
+        db_functions.intialise(db)
+
+        # Some history to read
+        storedSearches = {}
+        for user_id in range(1, args.users + 1):
+            storedSearches[user_id] = db_functions.logBQQuery(db, user_id, query)
+            db_functions.logBQResults(db, user_id, storedSearches[user_id], searches[user_id % len(searches)])
+
+        reads, writes, failures = [], [], []
+        stopAt = time.perf_counter() + args.seconds
+
+        def reader(number):
+            readerRng = random.Random(number)
+            while time.perf_counter() < stopAt:
+                user_id = readerRng.randint(1, args.users)
+                callStart = time.perf_counter()
+                db_functions.getUserSearchHistory(db, user_id)
+                db_functions.getSearchResult(db, storedSearches[user_id])
+                reads.append(time.perf_counter() - callStart)
+            db_functions.closeConnections()
+
+        def writer(number):
+            while time.perf_counter() < stopAt:
+                user_id = number % args.users + 1
+                callStart = time.perf_counter()
+                search_id = db_functions.logBQQuery(db, user_id, query)
+                results_id = db_functions.logBQResults(db, user_id, search_id, searches[len(writes) % len(searches)])
+                if search_id is None or results_id is None:
+                    failures.append(number)
+                writes.append(time.perf_counter() - callStart)
+            db_functions.closeConnections()
+
+        start = time.perf_counter()
+        threads = ([threading.Thread(target=reader, args=(i,)) for i in range(args.readers)] +
+                   [threading.Thread(target=writer, args=(i,)) for i in range(args.writers)])
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        reportLatencies(name + " reads", reads, elapsed)
+        reportLatencies(name + " writes", writes, elapsed)
+        print("    failed writes {}".format(len(failures)))
+
+        # Writes are only queued by the callers, so include the time for the
+        # writer to catch up
+        if writeBehind:
+            db_functions.flushWriteBehind(db)
+            committedIn = time.perf_counter() - start
+            status = db_functions.getWriteBehindStatus(db)
+            db_functions.closeWriteBehind()
+            print("    committed {} rows in {:.2f}s, {:.1f}/s, in {} transactions, {} failed".format(
+                status["written"], committedIn, status["written"] / committedIn, status["batches"],
+                status["failed"]))
+            print("    max queued {} of {}, blocked puts {} ({:.2f}s), max lag {:.1f}ms, "
+                  "reads waited {} ({:.2f}s)".format(
+                      status["maxQueued"], status["queueSize"], status["blockedPuts"], status["blockedSeconds"],
+                      status["maxLag"] * 1000, status["waits"], status["waitSeconds"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Escapade performance benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark")
+    subparsers.required = True
+
+    routes = subparsers.add_parser("routes", help="Concurrent searches through the app routes")
+    routes.add_argument("--searches", type=int, default=100, help="Total searches to run")
+    routes.add_argument("--distinct", type=int, default=20, help="Distinct searches, repeated")
+    routes.add_argument("--concurrency", type=int, default=4, help="Searches at once")
+    routes.add_argument("--origins", type=int, default=2)
+    routes.add_argument("--destinations", type=int, default=2)
+    routes.add_argument("--dates", type=int, default=2, help="Outbound dates per search")
+    routes.add_argument("--mode", choices=["sync", "stream", "api"], default="sync")
+    routes.add_argument("--workers", type=int, default=8, help="bqMaxWorkers")
+    routes.add_argument("--rate-limit", type=float, default=1000.0, help="API calls per second")
+    routes.add_argument("--no-cache", action="store_true", help="Disable the quote cache")
+    routes.add_argument("--latency", type=float, default=0.2, help="Mock API latency, seconds")
+    routes.add_argument("--error-rate", type=float, default=0.0, help="Mock API error fraction")
+    routes.add_argument("--quotes", type=int, default=10, help="Quotes per mock response")
+    routes.add_argument("--seed", type=int, default=1)
+    routes.set_defaults(run=benchmarkRoutes)
+
+    formatter = subparsers.add_parser("formatter", help="BrowseQuotesFormatResults on large responses")
+    formatter.add_argument("--responses", type=int, default=50)
+    formatter.add_argument("--quotes", type=int, default=500, help="Quotes per response")
+    formatter.add_argument("--carriers", type=int, default=500, help="Carriers per response")
+    formatter.add_argument("--repeat", type=int, default=5)
+    formatter.add_argument("--seed", type=int, default=1)
+    formatter.set_defaults(run=benchmarkFormatter)
+
+    table = subparsers.add_parser("table", help="filterResults in plain Python and with QuoteTable")
+    table.add_argument("--rows", type=int, default=50000, help="Quotes in the result set")
+    table.add_argument("--quotes", type=int, default=500, help="Quotes per response")
+    table.add_argument("--repeat", type=int, default=5)
+    table.add_argument("--seed", type=int, default=1)
+    table.set_defaults(run=benchmarkTable)
+
+    codec = subparsers.add_parser("codec", help="Storage codecs for stored results")
+    codec.add_argument("--searches", type=int, default=50)
+    codec.add_argument("--responses", type=int, default=20, help="Responses per search")
+    codec.add_argument("--quotes", type=int, default=10, help="Quotes per response")
+    codec.add_argument("--seed", type=int, default=1)
+    codec.set_defaults(run=benchmarkCodec)
+
+    database = subparsers.add_parser("database", help="Concurrent reads and writes by journal mode and write-behind")
+    database.add_argument("--readers", type=int, default=4, help="Reading threads")
+    database.add_argument("--writers", type=int, default=2, help="Writing threads")
+    database.add_argument("--seconds", type=float, default=5.0)
+    database.add_argument("--users", type=int, default=50, help="Users with search history")
+    database.add_argument("--responses", type=int, default=20, help="Responses per search")
+    database.add_argument("--quotes", type=int, default=10, help="Quotes per response")
+    database.add_argument("--seed", type=int, default=1)
+    database.set_defaults(run=benchmarkDatabase)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,14 +6,50 @@ sqlite3.
 """
 
 
+import atexit
 import sqlite3
 from sqlite3 import Error
+import hashlib
 import json
-from datetime import datetime
+import threading
+from datetime import datetime, timedelta
+import price_calendar
+import quote_records
+import storage_codec
+import write_behind
 
 
 """ Generic database helpers:"""
 
+# putData, putDataMany and getDataDict reuse one connection per thread for each
+# database file (refer to getConnection), rather than opening a new connection
+# for every call. If False, each call opens and closes its own connection.
+poolConnections = True
+
+# Seconds a connection waits for a lock held by another connection before
+# raising "database is locked"
+connectionTimeout = 10
+
+# Statements run on each new connection. The database itself is put in WAL
+# mode by intialise, so readers are not blocked by a writer, and in WAL mode
+# synchronous=NORMAL is safe against corruption, only the last transactions
+# may be lost on a power failure.
+connectionPragmas = ["PRAGMA busy_timeout={}".format(connectionTimeout * 1000),
+                     "PRAGMA synchronous=NORMAL",
+                     "PRAGMA mmap_size=268435456", # Read through up to 256MB of memory mapped I/O
+                     "PRAGMA cache_size=-8000", # 8MB page cache per connection
+                     "PRAGMA temp_store=MEMORY"]
+
+# Journal mode set on each database by intialise
+journalMode = "WAL"
+
+# Connections of the current thread, as db file: connection
+_threadConnections = threading.local()
+
+# Every pooled connection, as (thread ident, db file): (thread, connection)
+_openConnections = {}
+_openConnectionsLock = threading.Lock()
+
 def db_connect(db_file):
     """
     Create a connection object to the database. If no database exists, will
@@ -36,6 +72,127 @@ def db_connect(db_file):
 
     return conn
 
+def getConnection(db):
+    """
+    Returns the connection to the database for the current thread, opening it
+    (with connectionPragmas applied) on first use. Each thread has its own
+    connection, as an sqlite3 connection must not be used by two threads at
+    once, and SQLite's own locking manages access between them.
+
+    Connections of threads that have finished are closed by pruneConnections,
+    and all connections at exit by closeAllConnections.
+
+    Args:
+        db(string): The address of the database file.
+
+    Returns:
+        conn(object): The database connection object.
+
+    Exceptions:
+        sqlite3.Error: If the connection cannot be opened.
+    """
+    connections = getattr(_threadConnections, "connections", None)
+    if connections is None:
+        connections = _threadConnections.connections = {}
+
+    conn = connections.get(db)
+    if conn is not None:
+        return conn
+
+    # Closed from another thread once this thread has finished, so not
+    # restricted to the creating thread
+    conn = applyPragmas(sqlite3.connect(db, check_same_thread=False))
+
+    connections[db] = conn
+    with _openConnectionsLock:
+        _openConnections[(threading.get_ident(), db)] = (threading.current_thread(), conn)
+
+    return conn
+
+def applyPragmas(conn):
+    """
+    Runs connectionPragmas on a new connection, and returns it.
+    """
+    for pragma in connectionPragmas:
+        conn.execute(pragma)
+
+    return conn
+
+def _useConnection(db):
+    """
+    Context manager used by putData, putDataMany and getDataDict: the pooled
+    connection for the current thread, or if poolConnections is False a new
+    connection closed afterwards. In either case, commits on success and
+    rolls back on an exception.
+    """
+    if poolConnections:
+        return getConnection(db)
+    return _ClosingConnection(applyPragmas(sqlite3.connect(db)))
+
+class _ClosingConnection:
+    """
+    Wraps an unpooled connection so that it is closed at the end of the with
+    block, as well as committed or rolled back.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self.conn.__enter__()
+
+    def __exit__(self, *excInfo):
+        try:
+            return self.conn.__exit__(*excInfo)
+        finally:
+            self.conn.close()
+
+def pruneConnections():
+    """
+    Closes the pooled connections of threads that have finished, e.g. the
+    threads used for each request by the Flask development server.
+
+    Returns:
+        closed(integer): The number of connections closed.
+    """
+    with _openConnectionsLock:
+        finished = [key for key, (thread, conn) in _openConnections.items() if not thread.is_alive()]
+        closing = [_openConnections.pop(key)[1] for key in finished]
+
+    for conn in closing:
+        conn.close()
+
+    return len(closing)
+
+def closeConnections():
+    """
+    Closes the pooled connections of the current thread, e.g. before a
+    background thread finishes.
+    """
+    connections = getattr(_threadConnections, "connections", None) or {}
+    with _openConnectionsLock:
+        for db in connections:
+            _openConnections.pop((threading.get_ident(), db), None)
+
+    for conn in connections.values():
+        conn.close()
+    connections.clear()
+
+def closeAllConnections():
+    """
+    Closes every pooled connection. Registered to run at exit.
+    """
+    with _openConnectionsLock:
+        closing = [conn for thread, conn in _openConnections.values()]
+        _openConnections.clear()
+
+    for conn in closing:
+        try:
+            conn.close()
+        except Error as e:
+            print(e)
+
+atexit.register(closeAllConnections)
+
 def putData(db,sql,data):
     """
     A generic function for creating or updating data within any table
@@ -61,8 +218,7 @@ def putData(db,sql,data):
     """
 
     try:
-        conn = db_connect(db)
-        with conn:
+        with _useConnection(db) as conn:
             cur = conn.cursor()
             cur.execute(sql, data)
             return cur.lastrowid
@@ -87,8 +243,7 @@ def putDataMany(db,sql,data):
     """
 
     try:
-        conn = db_connect(db)
-        with conn:
+        with _useConnection(db) as conn:
             cur = conn.cursor()
             cur.executemany(sql, data)
             return cur.lastrowid
@@ -123,12 +278,10 @@ def getDataDict(db,sql,data):
     """
     result = []
     try:
-        conn = db_connect(db)
-        # Row_factory allows column headers to return with rows
-        conn.row_factory = sqlite3.Row
-
-        with conn:
+        with _useConnection(db) as conn:
             cur = conn.cursor()
+            # Row_factory allows column headers to return with rows
+            cur.row_factory = sqlite3.Row
             cur.execute(sql, data)
             rows = cur.fetchall()
 
@@ -167,6 +320,105 @@ def createTable(conn, createTableSQL):
         print(e)
 
 
+def addColumn(conn, table, column, definition):
+    """
+    Adds a column to an existing table, if it does not already have it. Used
+    to update databases created before the column was added to the schema.
+
+    Args:
+        conn(object): A database connection object
+
+        table(string): The name of the table.
+
+        column(string): The name of the column.
+
+        definition(string): The column type and constraints, e.g. "text".
+    """
+    try:
+        c = conn.cursor()
+        existing = [row[1] for row in c.execute("PRAGMA table_info({})".format(table))]
+        if column not in existing:
+            c.execute("ALTER TABLE {} ADD COLUMN {} {}".format(table, column, definition))
+    except Error as e:
+        print(e)
+
+
+def addColumns(conn):
+    """
+    Adds the columns in addedColumns to databases created before they were
+    in the schema.
+    """
+    for table, column, definition in addedColumns:
+        addColumn(conn, table, column, definition)
+
+
+def addSearchSummaryColumns(conn):
+    """
+    Adds searchSummaryColumns to the search_bq_log table.
+    """
+    for column, definition in searchSummaryColumns:
+        addColumn(conn, "search_bq_log", column, definition)
+
+
+def getSchemaVersion(conn):
+    """
+    Returns the schema version of a database, the version of the last
+    migration applied to it (refer to schemaMigrations). 0 if none.
+    """
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrateSchema(conn, migrations):
+    """
+    Applies the migrations newer than the schema version of a database, in
+    order. Each migration runs in its own transaction, with the new version
+    recorded in PRAGMA user_version, so a failed migration leaves the
+    database at the previous version. The transactions take the write lock
+    before reading the version, so app workers starting at once apply each
+    migration only once.
+
+    Args:
+        conn(object): A database connection object
+
+        migrations(list(of tuples)): (version, description, steps) in
+        ascending version order, where steps is a list of SQL statements or
+        functions taking conn.
+
+    Returns:
+        applied(list(of integers)): The versions applied.
+
+    Exceptions:
+        sqlite3.Error: If a migration fails. Earlier migrations stay applied.
+    """
+    applied = []
+    isolationLevel = conn.isolation_level
+    # Manage the transactions here, rather than by the sqlite3 module
+    conn.isolation_level = None
+
+    try:
+        for version, description, steps in migrations:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if version <= getSchemaVersion(conn):
+                    conn.execute("ROLLBACK")
+                    continue
+                for step in steps:
+                    if callable(step):
+                        step(conn)
+                    else:
+                        conn.execute(step)
+                conn.execute("PRAGMA user_version={:d}".format(version))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            applied.append(version)
+    finally:
+        conn.isolation_level = isolationLevel
+
+    return applied
+
+
 # SQL Schema for the "users" table
 createTableSQL_Users = """ CREATE TABLE IF NOT EXISTS users (
                                         user_id integer PRIMARY KEY AUTOINCREMENT,
@@ -189,6 +441,27 @@ createTableSQL_search_bq_log = """ CREATE TABLE IF NOT EXISTS search_bq_log (
                                             searchName text
                                             ); """
 
+# Summary columns added to search_bq_log by schema migration 4, written by
+# logBQQuery (refer to searchSummary) and logBQResults, so the search history
+# can be listed without reading searchJson
+searchSummaryColumns = [("queryCount", "integer"),
+                        ("origins", "text"),
+                        ("destinations", "text"),
+                        ("firstDate", "text"),
+                        ("lastDate", "text"),
+                        ("resultCount", "integer")]
+
+# Searches per page of the search history
+historyPageSize = 50
+
+# Inserts a search, refer to searchRow. A search_id of None is allocated by
+# SQLite.
+insertSQL_search_bq_log = ''' INSERT INTO search_bq_log (search_id,user_id,created,searchJson,queryCount,
+                                            origins,destinations,firstDate,lastDate)
+                VALUES(?,?,?,?,?,?,?,?,?) '''
+
+updateSQL_resultCount = "UPDATE search_bq_log SET resultCount=? WHERE search_id=?"
+
 # SQL Schema for the "browse_quotes_results" table
 createTableSQL_browse_quotes_results = """ CREATE TABLE IF NOT EXISTS browse_quotes_results (
                                             results_id integer PRIMARY KEY AUTOINCREMENT,
@@ -196,7 +469,182 @@ createTableSQL_browse_quotes_results = """ CREATE TABLE IF NOT EXISTS browse_quo
                                             user_id integer,
                                             resultTimestamp timestamp,
                                             resultsJson text,
-                                            searchName text
+                                            searchName text,
+                                            formattedJson text,
+                                            formatterVersion integer
+                                            ); """
+
+# Inserts a set of results, refer to resultsRow. A results_id of None is
+# allocated by SQLite.
+insertSQL_browse_quotes_results = ''' INSERT INTO browse_quotes_results(results_id,search_id,user_id,
+                                            resultTimestamp,resultsJson,formattedJson,formatterVersion)
+                VALUES(?,?,?,?,?,?,?) '''
+
+# Columns added to existing tables since they were first created, as
+# (table, column, definition). Refer to addColumn.
+addedColumns = [("browse_quotes_results", "formattedJson", "text"),
+                ("browse_quotes_results", "formatterVersion", "integer")]
+
+# Columns holding json values encoded by storage_codec.py, as
+# (table, key column, column). Refer to migrateStorageCodec.
+encodedColumns = [("search_bq_log", "search_id", "searchJson"),
+                  ("browse_quotes_results", "results_id", "resultsJson"),
+                  ("browse_quotes_results", "results_id", "formattedJson"),
+                  ("response_blobs", "blobHash", "blobData")]
+
+# Raw BrowseQuotes responses are stored as content addressed blobs in the
+# response_blobs table, rather than in full in each browse_quotes_results row
+storeResponseBlobs = True
+
+# Keys of a BrowseQuotes response stored as separate blobs, as they are often
+# identical across responses and searches
+sharedResponseKeys = ("Places", "Carriers", "Currencies")
+
+# Maximum number of blob hashes per SELECT
+blobQueryBatch = 500
+
+# SQL Schema for the "search_jobs" table, used by the background search worker
+# in search_jobs.py. status is one of "queued", "running", "done" or "failed".
+createTableSQL_search_jobs = """ CREATE TABLE IF NOT EXISTS search_jobs (
+                                            job_id integer PRIMARY KEY AUTOINCREMENT,
+                                            search_id integer NOT NULL,
+                                            user_id integer,
+                                            status text NOT NULL,
+                                            totalCalls integer,
+                                            completedCalls integer,
+                                            created timestamp,
+                                            updated timestamp,
+                                            errorMessage text
+                                            ); """
+
+# SQL Schema for the "response_blobs" table. Holds the parts of raw BrowseQuotes
+# responses, stored once for each distinct content and referenced by the hash
+# of that content from browse_quotes_results.resultsJson (refer to
+# splitResponses). blobData is encoded by storage_codec.py.
+createTableSQL_response_blobs = """ CREATE TABLE IF NOT EXISTS response_blobs (
+                                            blobHash text PRIMARY KEY,
+                                            created timestamp,
+                                            blobData blob
+                                            ); """
+
+insertSQL_response_blobs = "INSERT OR IGNORE INTO response_blobs(blobHash,created,blobData) VALUES(?,?,?)"
+
+# SQL Schema for the "price_calendar" table. Holds the cheapest price seen for
+# each route and date pair, updated by logBQResults (refer to price_calendar.py).
+# inboundDate is "" for one way trips. updated is seconds since epoch.
+createTableSQL_price_calendar = """ CREATE TABLE IF NOT EXISTS price_calendar (
+                                            originplace text NOT NULL,
+                                            destinationplace text NOT NULL,
+                                            currency text NOT NULL,
+                                            outboundDate text NOT NULL,
+                                            inboundDate text NOT NULL,
+                                            minPrice real NOT NULL,
+                                            updated real NOT NULL,
+                                            search_id integer,
+                                            PRIMARY KEY (originplace, destinationplace, currency,
+                                                         outboundDate, inboundDate)
+                                            ); """
+
+# The price_calendar table is updated with the quotes of every search stored by
+# logBQResults
+storePriceCalendar = True
+
+# Upserts a cell of the price calendar, refer to calendarRows. Prices already
+# stored from more recent results are kept.
+upsertSQL_price_calendar = ''' INSERT INTO price_calendar(originplace,destinationplace,currency,outboundDate,
+                                            inboundDate,minPrice,updated,search_id)
+                VALUES(?,?,?,?,?,?,?,?)
+                ON CONFLICT(originplace,destinationplace,currency,outboundDate,inboundDate)
+                DO UPDATE SET minPrice=excluded.minPrice, updated=excluded.updated,
+                              search_id=excluded.search_id
+                WHERE excluded.updated >= price_calendar.updated '''
+
+# SQL Schema for the "quotes" table. Holds one row per quote in the results
+# stored by logBQResults, for queries across the whole search history (refer to
+# getCheapestQuotes). Places and carriers are identified by their numeric
+# Skyscanner ids, named in the "places" and "carriers" tables. Carrier ids are
+# comma separated. inboundDate is "" for one way trips. created is the time of
+# the results, in seconds since epoch.
+createTableSQL_quotes = """ CREATE TABLE IF NOT EXISTS quotes (
+                                            quote_id integer PRIMARY KEY,
+                                            results_id integer NOT NULL,
+                                            search_id integer NOT NULL,
+                                            created real NOT NULL,
+                                            originId integer NOT NULL,
+                                            destinationId integer NOT NULL,
+                                            outboundDate text NOT NULL,
+                                            inboundDate text NOT NULL,
+                                            price real NOT NULL,
+                                            currency text,
+                                            direct integer,
+                                            outboundCarrierIds text,
+                                            inboundCarrierIds text,
+                                            quoteDateTime text
+                                            ); """
+
+# SQL Schema for the "places" table, the places named in stored results
+createTableSQL_places = """ CREATE TABLE IF NOT EXISTS places (
+                                            placeId integer PRIMARY KEY,
+                                            name text,
+                                            skyscannerCode text,
+                                            iataCode text,
+                                            type text,
+                                            countryName text
+                                            ); """
+
+# SQL Schema for the "carriers" table, the carriers named in stored results
+createTableSQL_carriers = """ CREATE TABLE IF NOT EXISTS carriers (
+                                            carrierId integer PRIMARY KEY,
+                                            name text
+                                            ); """
+
+# logBQResults also stores each quote in the quotes table
+storeQuoteRows = True
+
+# (db, table): {id: row} of the places and carriers rows stored by this
+# process, so that putQuoteRows only writes the rows that are new or changed
+_storedDimensions = {}
+
+# Statements used to store the rows from quoteRows
+insertSQL_quotes = ''' INSERT INTO quotes(results_id,search_id,created,originId,destinationId,
+                                outboundDate,inboundDate,price,currency,direct,
+                                outboundCarrierIds,inboundCarrierIds,quoteDateTime)
+                VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?) '''
+upsertSQL_places = ''' INSERT INTO places(placeId,name,skyscannerCode,iataCode,type,countryName)
+                VALUES(?,?,?,?,?,?)
+                ON CONFLICT(placeId) DO UPDATE SET name=excluded.name,
+                    skyscannerCode=coalesce(excluded.skyscannerCode, skyscannerCode),
+                    iataCode=coalesce(excluded.iataCode, iataCode),
+                    type=coalesce(excluded.type, type),
+                    countryName=coalesce(excluded.countryName, countryName) '''
+upsertSQL_carriers = ''' INSERT INTO carriers(carrierId,name) VALUES(?,?)
+                ON CONFLICT(carrierId) DO UPDATE SET name=excluded.name '''
+
+# logBQQuery and logBQResults queue their writes to a background writer for
+# each database, which commits many of them in each transaction, rather than
+# writing within the request (refer to write_behind.py and writeLogBatch).
+# The search_id and results_id of queued rows are allocated by this process,
+# so only one process may log searches to the database while this is True.
+writeBehind = False
+writeBehindQueueSize = 200 # Writes queued before logBQQuery and logBQResults block
+writeBehindBatchSize = 100 # Most writes committed in one transaction
+
+# db file: WriteBehindLogger
+_writeBehindLoggers = {}
+_writeBehindLock = threading.Lock()
+
+# (db file, table): the last id allocated to a queued row. Ids are allocated
+# and queued under one lock, so rows are queued, and written, in id order.
+_writeBehindIds = {}
+_writeBehindIdLock = threading.Lock()
+
+# SQL Schema for the "quote_cache" table. This is held in a separate cache
+# database file (refer to intialiseQuoteCache). Times are seconds since epoch.
+createTableSQL_quote_cache = """ CREATE TABLE IF NOT EXISTS quote_cache (
+                                            cacheKey text PRIMARY KEY,
+                                            created real NOT NULL,
+                                            expires real NOT NULL,
+                                            responseJson text
                                             ); """
 
 # SQL Schema for the "search_live_data" table
@@ -238,6 +686,46 @@ createTableSQL_search_live_data = """ CREATE TABLE IF NOT EXISTS search_live_dat
                                             ); """
 
 
+# Ordered schema migrations applied by intialise, as (version, description,
+# steps), refer to migrateSchema. Add changes to the schema as a new migration
+# at the end, never by editing an applied one.
+schemaMigrations = [
+    (1, "Tables and columns as of databases with no schema version", [
+        createTableSQL_Users,
+        createTableSQL_search_bq_log,
+        createTableSQL_browse_quotes_results,
+        createTableSQL_search_jobs,
+        createTableSQL_response_blobs,
+        createTableSQL_price_calendar,
+        addColumns,
+        ]),
+    (2, "Indexes for searches by user, results by search and unfinished jobs", [
+        "CREATE INDEX IF NOT EXISTS search_bq_log_user_id ON search_bq_log(user_id)",
+        "CREATE INDEX IF NOT EXISTS browse_quotes_results_search_id ON browse_quotes_results(search_id)",
+        "CREATE INDEX IF NOT EXISTS search_jobs_status ON search_jobs(status)",
+        ]),
+    (3, "Quotes fact table, with the places and carriers they refer to", [
+        createTableSQL_quotes,
+        createTableSQL_places,
+        createTableSQL_carriers,
+        # Cheapest quotes on a route for a range of dates. Its origin prefix
+        # also serves queries by origin or by time stored, with the rows
+        # filtered and sorted, as every search adds its quotes at scattered
+        # places in each index of the quotes table
+        "CREATE INDEX IF NOT EXISTS quotes_route_date_price ON quotes(originId, destinationId, outboundDate, price)",
+        "CREATE INDEX IF NOT EXISTS quotes_results_id ON quotes(results_id)",
+        "CREATE INDEX IF NOT EXISTS places_skyscanner_code ON places(skyscannerCode)",
+        "CREATE INDEX IF NOT EXISTS places_iata_code ON places(iataCode)",
+        ]),
+    (4, "Search summary columns, and an index for paging through a user's searches", [
+        addSearchSummaryColumns,
+        "CREATE INDEX IF NOT EXISTS search_bq_log_user_search ON search_bq_log(user_id, search_id)",
+        # Covered by search_bq_log_user_search
+        "DROP INDEX IF EXISTS search_bq_log_user_id",
+        ]),
+    ]
+
+
 """ User account setting functions: """
 
 def createUser(db, user):
@@ -290,27 +778,111 @@ def getUser(db, username):
 
     return user
 
-def getUserSearchHistory(db, user_id):
-    """Returns a list of dictionaries comprising the user search history, obtained
-    from the search_live_log table in the database.
+def getUserSearchHistory(db, user_id, before=None, limit=None):
+    """Returns a page of the user's search history, newest first, obtained
+    from the summary columns of the search_bq_log table in the database. The
+    search queries themselves are not read, refer to getSearchQuery.
+
+    Pages are found by search_id (keyset pagination) rather than by offset,
+    so each page reads only its own rows.
+
+    Searches logged before the summary columns existed are summarised when
+    first listed, refer to updateSearchSummary.
 
     Args:
         db(string): The address of the database file to interogate
 
         user_id(integer): The unique identifier for the user.
 
+        before(integer): Optional, only searches with a lower search_id, i.e.
+        the last search_id of the previous page.
+
+        limit(integer): Optional, the number of searches. Defaults to
+        historyPageSize.
+
     Returns:
         userSearchHistory(list(of dictionaries)): A list of dictionaries each
-        comprising of data from the columns within the search_live_log table
-        of the escapde database, for searches with matching user_id. Returns None
-        on error.
+        with the search_id, created, searchName and searchSummaryColumns of a
+        search with matching user_id. Returns None on error.
     """
-    sql = "SELECT * FROM search_bq_log WHERE user_id=?"
+    columns = ["search_id", "created", "searchName"] + [column for column, definition in searchSummaryColumns]
+    conditions, data = ["user_id=?"], [user_id]
+    if before is not None:
+        conditions.append("search_id<?")
+        data.append(before)
+
+    sql = "SELECT {} FROM search_bq_log WHERE {} ORDER BY search_id DESC LIMIT ?".format(
+        ",".join(columns), " AND ".join(conditions))
+
+    awaitLogWrites(db, ("user", str(user_id)))
+
+    userSearchHistory = getDataDict(db, sql, tuple(data) + (limit or historyPageSize,))
 
-    userSearchHistory = getDataDict(db, sql, (user_id,))
+    for search in userSearchHistory or []:
+        if search["queryCount"] is None:
+            search.update(updateSearchSummary(db, search["search_id"]))
 
     return userSearchHistory
 
+def searchSummary(searchQuery):
+    """
+    Summarises a search query for the search history.
+
+    Args:
+        searchQuery(list(of dictionaries)): The queries, as for logBQQuery.
+
+    Returns:
+        summary(dictionary): The queryCount, the distinct origins and
+        destinations (comma separated, in order of first use), and the
+        firstDate and lastDate of travel (yyyy-mm-dd or yyyy-mm). The dates are
+        None if the search has no dates.
+    """
+    origins, destinations, dates = {}, {}, []
+    for query in searchQuery:
+        origins[query.get("originplace")] = None
+        destinations[query.get("destinationplace")] = None
+        dates.extend(date for date in (query.get("outboundpartialdate"), query.get("inboundpartialdate"))
+                     if date)
+
+    return {"queryCount": len(searchQuery),
+            "origins": ",".join(str(origin) for origin in origins),
+            "destinations": ",".join(str(destination) for destination in destinations),
+            "firstDate": min(dates) if dates else None,
+            "lastDate": max(dates) if dates else None}
+
+def countResponseQuotes(browseQuotesList):
+    """
+    Returns the number of quotes in a list of BrowseQuotes responses.
+    """
+    return sum(len(response["Quotes"]) for response in browseQuotesList
+               if isinstance(response, dict) and isinstance(response.get("Quotes"), list))
+
+def updateSearchSummary(db, search_id):
+    """
+    Computes and stores the summary columns of a search logged before they
+    existed, from its query and any stored formatted results.
+
+    Args:
+        db(string): The address of the database file to be written to.
+
+        search_id(integer): The unique identifier for the search.
+
+    Returns:
+        summary(dictionary): The values stored for searchSummaryColumns.
+    """
+    summary = searchSummary(getSearchQuery(db, search_id))
+
+    summary["resultCount"] = None
+    stored = getDataDict(db, "SELECT formattedJson FROM browse_quotes_results WHERE search_id=?", (search_id,))
+    if stored and stored[0]["formattedJson"] is not None:
+        summary["resultCount"] = len(storage_codec.decodeJson(stored[0]["formattedJson"])["quotes"])
+
+    columns = [column for column, definition in searchSummaryColumns]
+    sql = "UPDATE search_bq_log SET {} WHERE search_id=?".format(",".join(column + "=?" for column in columns))
+    putData(db, sql, tuple(summary[column] for column in columns) + (search_id,))
+
+    return summary
+
 def getSearchQuery(db, search_id):
     """
     Returns a Python formatted search query from the database.
@@ -326,11 +898,12 @@ def getSearchQuery(db, search_id):
     """
     sql = "SELECT * FROM search_bq_log WHERE search_id=?"
 
+    awaitLogWrites(db, ("search", str(search_id)))
     queryDB = getDataDict(db, sql, (search_id,))
     queryJson = queryDB[0]["searchJson"]
 
-    # Convert from json into Python
-    queryList = json.loads(queryJson)
+    # Convert from the stored json into Python
+    queryList = storage_codec.decodeJson(queryJson)
 
     return queryList
 
@@ -350,15 +923,38 @@ def getSearchResult(db, search_id):
     """
     sql = "SELECT resultsJson FROM browse_quotes_results WHERE search_id=?"
 
+    awaitLogWrites(db, ("results", str(search_id)))
     resultDB = getDataDict(db, sql, (search_id,))
     responseJson = resultDB[0]["resultsJson"]
 
-    # Convert from json into Python
-    responseHistoric = json.loads(responseJson)
+    # Convert from the stored json into Python
+    responseHistoric = storage_codec.decodeJson(responseJson)
+
+    # Put together the responses stored as blobs
+    if isinstance(responseHistoric, dict) and "responseBlobs" in responseHistoric:
+        responseHistoric = joinResponses(db, responseHistoric)
 
     return responseHistoric
 
 
+def searchHasResults(db, search_id):
+    """
+    Checks whether results have been stored for a search.
+
+    Args:
+        db(string): The address of the database file to interogate
+
+        search_id(integer): The unique identifier for the search.
+
+    Returns:
+        (Bool): True if the browse_quotes_results table has a row for the search.
+    """
+    sql = "SELECT 1 FROM browse_quotes_results WHERE search_id=?"
+
+    awaitLogWrites(db, ("results", str(search_id)))
+    return bool(getDataDict(db, sql, (search_id,)))
+
+
 def updatePassword(db,newPassword,username):
     """
     Uses putData to ammend a users password hash. Refer to putData
@@ -385,7 +981,8 @@ def updatePassword(db,newPassword,username):
 def logBQQuery(db, user_id, searchQuery):
     """
     Uses putData to log any search carried out using search_live as
-    a .json with associated metadata.
+    a .json with associated metadata. If writeBehind is set, the search is
+    queued and written by writeLogBatch in the background.
 
     Refer to putData for further information on returns and exceptions.
 
@@ -402,30 +999,53 @@ def logBQQuery(db, user_id, searchQuery):
 
     Returns:
         search_id(integer): The last row id, which is the unique autoincrement
-        value for search_id.
+        value for search_id. If writeBehind is set, the search_id allocated to
+        the queued row.
 
     """
-    # Convert searchQuery into .json format for storage in the database
-    searchJson = json.dumps(searchQuery)
     timestamp = datetime.now()
 
-    data = (user_id, timestamp, searchJson)
-
-    sql = ''' INSERT INTO search_bq_log (user_id,created,searchJson)
-                VALUES(?,?,?) '''
+    # Queue the search for the background writer, refer to writeLogBatch
+    if writeBehind:
+        with _writeBehindIdLock:
+            search_id = _nextLogId(db, "search_bq_log")
+            getWriteBehindLogger(db).put(("search_bq_log", search_id, user_id, searchQuery, timestamp),
+                                         [("search", str(search_id)), ("user", str(user_id))])
+        return search_id
 
     # Call PUT function
-
-    search_id = putData(db, sql, data)
+    search_id = putData(db, insertSQL_search_bq_log, searchRow(None, user_id, searchQuery, timestamp))
 
     return search_id
 
-def logBQResults(db, user_id, search_id, browseQuotesList):
+
+def searchRow(search_id, user_id, searchQuery, timestamp):
+    """
+    Returns the row of search_bq_log for a search, in the order of
+    insertSQL_search_bq_log. The query is stored as .json, with its summary
+    (refer to searchSummary).
+    """
+    summary = searchSummary(searchQuery)
+
+    return (search_id, user_id, timestamp, storage_codec.encodeJson(searchQuery), summary["queryCount"],
+            summary["origins"], summary["destinations"], summary["firstDate"], summary["lastDate"])
+
+def logBQResults(db, user_id, search_id, browseQuotesList, formattedResults=None, failedQueries=0):
     """
     Uses putData to log results retreived from the Browse quotes endpoint as a .json
     with associated metadata.  The  results are stored as a single .json object
     that is created from the list of .jsons returned from BrowseQuotes.
 
+    If provided, the formatted results are also stored, so that the results can
+    later be viewed without parsing and formatting the raw results (refer to
+    getFormattedSearchResult).
+
+    The quotes are also added to the price_calendar table (refer to
+    updatePriceCalendar) and the quotes table (refer to putQuoteRows).
+
+    If writeBehind is set, the results are queued and all of this is written
+    by writeLogBatch in the background.
+
     Refer to putData for further information on returns and exceptions.
 
     Args:
@@ -441,117 +1061,1275 @@ def logBQResults(db, user_id, search_id, browseQuotesList):
         multiple API response .json.
         Refer to API documentation for structure.
 
+        formattedResults(list(of Quotes)): Optional, the output of
+        BrowseQuotesFormatResults for browseQuotesList.
+
+        failedQueries(integer): Optional, the number of unsuccessful responses
+        in browseQuotesList, stored with the formatted results.
+
     Returns:
         results_id(integer): The last row id, which is the unique autoincrement
-        value for resutls_id.
+        value for resutls_id. If writeBehind is set, the results_id allocated
+        to the queued row.
     """
-    # Convert browseQuotesList into .json format for storage in the database
-    resultsJson = json.dumps(browseQuotesList)
     resultTimestamp = datetime.now()
 
-    data = (search_id, user_id, resultTimestamp, resultsJson)
-
-    sql = ''' INSERT INTO browse_quotes_results(search_id,user_id,resultTimestamp,
-                                            resultsJson)
-                VALUES(?,?,?,?) '''
+    # Queue the results for the background writer, refer to writeLogBatch
+    if writeBehind:
+        with _writeBehindIdLock:
+            results_id = _nextLogId(db, "browse_quotes_results")
+            getWriteBehindLogger(db).put(("browse_quotes_results", results_id, search_id, user_id,
+                                          browseQuotesList, formattedResults, failedQueries, resultTimestamp),
+                                         [("results", str(search_id)), ("user", str(user_id))])
+        return results_id
+
+    # Add the quotes to the price calendar of each route searched
+    if storePriceCalendar:
+        updatePriceCalendar(db, search_id, browseQuotesList, resultTimestamp.timestamp())
+
+    # Store the responses as shared blobs, referenced by the stored manifest
+    data, blobs = resultsRow(None, search_id, user_id, browseQuotesList, formattedResults, failedQueries,
+                             resultTimestamp)
+    if blobs:
+        putResponseBlobs(db, blobs, resultTimestamp)
 
     # Call the PUT function
-    results_id = putData(db, sql, data)
+    results_id = putData(db, insertSQL_browse_quotes_results, data)
+
+    # Add each quote to the quotes table
+    if storeQuoteRows and results_id is not None:
+        putQuoteRows(db, results_id, search_id, browseQuotesList, resultTimestamp.timestamp())
+
+    # Record the number of quotes for the search history
+    putData(db, updateSQL_resultCount, (resultCount(browseQuotesList, formattedResults), search_id))
 
     return results_id
 
-def db_logSLItineraries(db, user_id, search_id, results_id, resultsDict):
+
+def resultsRow(results_id, search_id, user_id, browseQuotesList, formattedResults, failedQueries,
+               resultTimestamp):
     """
-    LEGACY - This function is not currently used as of version 0.5.1. Retained for
-    potential future use.
+    Returns the row of browse_quotes_results for a set of results, in the
+    order of insertSQL_browse_quotes_results, with the arguments as for
+    logBQResults.
 
-    Uses putDataMany to log the formatted itinaries created by liveSearchFormatResult
-    for analysis and presentation to the user, and the associated search
-    metadata.
-    Refer to putData for further information on returns and exceptions.
+    Returns:
+        (tuple): (row, blobs) where blobs is a dictionary of the response
+        blobs referenced by the row (refer to splitResponses), to be stored
+        with putResponseBlobs. Empty if storeResponseBlobs is False.
+    """
+    numQueries = len(browseQuotesList)
 
-    Args:
-        db(string): The address of the database file to be written to.
+    # Store the responses as shared blobs, and a manifest referencing them
+    blobs = {}
+    if storeResponseBlobs:
+        browseQuotesList, blobs = splitResponses(browseQuotesList)
 
-        user_id(integer): User id for the search to be recorded against. May be
-        "" if no user_id to be stored.
+    # Convert browseQuotesList into .json format for storage in the database
+    resultsJson = storage_codec.encodeJson(browseQuotesList)
 
-        search_id(integer): The unique id of the search query for which the result
-        is associated.
+    formattedJson = None
+    formatterVersion = None
+    if formattedResults is not None:
+        formattedJson = packFormattedResults(formattedResults, failedQueries, numQueries)
+        formatterVersion = quote_records.formatVersion
 
-        results_id(integer): The unique id for the search result key from the
-        search_live_data table.
+    return (results_id, search_id, user_id, resultTimestamp, resultsJson, formattedJson, formatterVersion), blobs
 
-        resultsDict (list(of dictionaries)): List of dictionaries containing the
-        itinary data defined within liveSearchFormatResult in ss_api_functions.
 
-    Constraints:
-        This function works by defining a generic SQL insertion statement, and determines
-        no number of variables to enter based on the number of key:value pair for the first 
-        entry in resultsDict, which is different for one-way and return trips. As such if
-        there are a mixture of return and single route trips in resultsDict, the SQL will
-        not commit properly. This may be fixed as part of a future datastructure refactor,
-        but does not currently affect core functionality of the program. 
+def resultCount(browseQuotesList, formattedResults):
+    """
+    Returns the number of quotes in a set of results, for the resultCount
+    column of the search history.
+    """
+    if formattedResults is not None:
+        return len(formattedResults)
+    return countResponseQuotes(browseQuotesList)
 
+
+def quoteRows(browseQuotesList):
     """
+    Flattens raw BrowseQuotes responses into rows for the quotes, places and
+    carriers tables. Error responses, and malformed quotes, are skipped.
 
-    # Create the SQL insertion to be used for each entry
-    columns = "user_id,search_id,results_id,itineraryTimestamp," + ','.join(resultsDict[0].keys())
-    # Placeholders for length of itinary, plus 3 id and 1 timestamp parameters
-    itineraryLength = len(resultsDict[0])
-    placeholders = ', '.join(['?'] * (itineraryLength + 4))
-    sql = "INSERT INTO search_live_data(%s) VALUES (%s)" % (columns, placeholders)
+    Args:
+        browseQuotesList (List( of dictionaries): API responses, as for
+        logBQResults.
 
-    # Initialise values list
-    values = []
+    Returns:
+        (tuple): (quotes, places, carriers) where quotes is a list of tuples
+        (originId, destinationId, outboundDate, inboundDate, price, currency,
+        direct, outboundCarrierIds, inboundCarrierIds, quoteDateTime), and
+        places and carriers are dictionaries of id: row tuple for the places
+        and carriers tables.
+    """
+    quotes, places, carriers = [], {}, {}
+
+    # Most quotes share a few lists of carriers, so join each list once
+    carrierIdStrings = {}
+
+    def carrierIds(leg):
+        ids = tuple(leg["CarrierIds"])
+        if ids not in carrierIdStrings:
+            carrierIdStrings[ids] = ",".join(str(carrierId) for carrierId in ids)
+        return carrierIdStrings[ids]
+
+    for response in browseQuotesList:
+        if not isinstance(response, dict) or "Quotes" not in response:
+            continue
+
+        currencies = response.get("Currencies") or [{}]
+        currency = currencies[0].get("Code")
+
+        for place in response.get("Places", []):
+            places[place["PlaceId"]] = (place["PlaceId"], place.get("Name"), place.get("SkyscannerCode"),
+                                        place.get("IataCode"), place.get("Type"), place.get("CountryName"))
+        for carrier in response.get("Carriers", []):
+            carriers[carrier["CarrierId"]] = (carrier["CarrierId"], carrier.get("Name"))
+
+        for quote in response["Quotes"]:
+            try:
+                outbound = quote["OutboundLeg"]
+                inbound = quote.get("InboundLeg")
+                quotes.append((outbound["OriginId"], outbound["DestinationId"],
+                               outbound["DepartureDate"][:10],
+                               inbound["DepartureDate"][:10] if inbound else "",
+                               quote["MinPrice"], currency, int(bool(quote.get("Direct"))),
+                               carrierIds(outbound),
+                               carrierIds(inbound) if inbound else "",
+                               quote.get("QuoteDateTime")))
+            except (KeyError, TypeError):
+                continue
+
+    return quotes, places, carriers
+
+
+def putQuoteRows(db, results_id, search_id, browseQuotesList, created):
+    """
+    Stores each quote in a set of results in the quotes table, and the places
+    and carriers they refer to in the places and carriers tables, in one
+    transaction.
 
-    # For each itinerary dict in the list:
-    for itinerary in resultsDict:
-        # Create timestamp
-        itineraryTimestamp = datetime.now()
+    Args:
+        db(string): The address of the database file to be written to.
 
-        #Create a values tuple and append to list
-        entry = (user_id, search_id, results_id,itineraryTimestamp) + tuple(itinerary.values())
-        values.append(entry)
+        results_id(integer): The browse_quotes_results row of the results.
 
-    # Call PUT MANY function
-    putDataMany(db, sql, values)
+        search_id(integer): The unique id of the search.
 
+        browseQuotesList (List( of dictionaries): API responses, as for
+        logBQResults.
 
-"""Specific database operators and wrappers"""
+        created(float): The time of the results, in seconds since epoch.
 
-def intialise(db):
+    Returns:
+        (integer): The number of quotes stored, or None on failure.
     """
-    Wrapper for use in app.py that creates (if none present) the database or
-    updates the structure and associated schema if required.
+    quotes, places, carriers = quoteRows(browseQuotesList)
+    places, carriers = newDimensions(db, places, carriers)
 
-    Args:
-        None
+    try:
+        with _useConnection(db) as conn:
+            conn.executemany(upsertSQL_places, places.values())
+            conn.executemany(upsertSQL_carriers, carriers.values())
+            conn.executemany(insertSQL_quotes, [(results_id, search_id, created) + quote for quote in quotes])
+        storeDimensions(db, places, carriers)
+        return len(quotes)
+    except Error as e:
+        print(e)
+        return None
 
-    Returns:
-        Creates or updates the application database.db file in the app.py directory
 
-    Exceptions:
-        TBD
+def newDimensions(db, places, carriers):
+    """
+    Returns the places and carriers rows from quoteRows that this process has
+    not already stored as they are, so only those need to be written.
     """
+    storedPlaces = _storedDimensions.get((db, "places"), {})
+    storedCarriers = _storedDimensions.get((db, "carriers"), {})
 
-    # Connect to database
-    conn = db_connect(db)
+    return ({placeId: row for placeId, row in places.items() if storedPlaces.get(placeId) != row},
+            {carrierId: row for carrierId, row in carriers.items() if storedCarriers.get(carrierId) != row})
 
-    if conn is not None:
-        # create tables using schema defined above
-        createTable(conn, createTableSQL_Users)
-        createTable(conn, createTableSQL_search_bq_log)
-        createTable(conn, createTableSQL_browse_quotes_results)
 
-    else:
-        print("Error! cannot create the database connection.")
+def storeDimensions(db, places, carriers):
+    """
+    Records places and carriers rows as stored, once committed, refer to
+    newDimensions.
+    """
+    _storedDimensions.setdefault((db, "places"), {}).update(places)
+    _storedDimensions.setdefault((db, "carriers"), {}).update(carriers)
 
-    # Disconnect from database
+
+def getCheapestQuotes(db, origin, destination=None, seenFrom=None, seenTo=None,
+                      outboundFrom=None, outboundTo=None, limit=10):
+    """
+    Returns the cheapest quotes stored from an origin, over the whole search
+    history, using the indexes on the quotes table.
+
+    Args:
+        db(string): The address of the database file to interogate
+
+        origin, destination(string): Skyscanner or IATA codes of the places,
+        e.g. "LHR" or "LHR-sky". destination is optional, and if origin is
+        None the quotes from every origin are included.
+
+        seenFrom, seenTo(datetime): Optional, the range of times the quotes
+        were stored.
+
+        outboundFrom, outboundTo(string): Optional, the inclusive range of
+        outbound dates, in the format yyyy-mm-dd.
+
+        limit(integer): Optional, the maximum number of quotes.
+
+    Returns:
+        quotes(list(of dictionaries)): Cheapest first, with the columns of
+        the quotes table, and originName and destinationName.
+    """
+    # Quotes from any search may be queued
+    awaitLogWrites(db)
+
+    def placeIds(code):
+        code = code.upper()
+        if code.endswith("-SKY"):
+            code = code[:-4]
+        rows = getDataDict(db, "SELECT placeId FROM places WHERE skyscannerCode=? OR iataCode=?", (code, code))
+        return [row["placeId"] for row in rows or []]
+
+    conditions, data = [], []
+    for column, code in (("originId", origin), ("destinationId", destination)):
+        if code is not None:
+            ids = placeIds(code)
+            if not ids:
+                return []
+            conditions.append("q.{} IN ({})".format(column, ",".join("?" * len(ids))))
+            data.extend(ids)
+
+    for condition, value in (("q.created >= ?", seenFrom.timestamp() if seenFrom else None),
+                             ("q.created <= ?", seenTo.timestamp() if seenTo else None),
+                             ("q.outboundDate >= ?", outboundFrom),
+                             ("q.outboundDate <= ?", outboundTo)):
+        if value is not None:
+            conditions.append(condition)
+            data.append(value)
+
+    sql = ''' SELECT q.*, o.name AS originName, d.name AS destinationName FROM quotes q
+                LEFT JOIN places o ON o.placeId = q.originId
+                LEFT JOIN places d ON d.placeId = q.destinationId
+                {} ORDER BY q.price LIMIT ? '''.format("WHERE " + " AND ".join(conditions) if conditions else "")
+
+    return getDataDict(db, sql, tuple(data) + (limit,)) or []
+
+
+def backfillQuotes(db, batchSize=100):
+    """
+    Adds the quotes of results stored before the quotes table existed to it.
+    Results that already have quotes are skipped, so the backfill may be
+    interrupted and run again.
+
+    Args:
+        db(string): The address of the database file.
+
+        batchSize(integer): Optional, the number of results read at a time.
+
+    Returns:
+        stats(dictionary): The number of "results" read, and the number of
+        "quotes" added.
+    """
+    stats = {"results": 0, "quotes": 0}
+    lastKey = 0
+
+    while True:
+        sql = ''' SELECT results_id, search_id, resultTimestamp FROM browse_quotes_results r
+                    WHERE results_id > ? AND NOT EXISTS
+                        (SELECT 1 FROM quotes q WHERE q.results_id = r.results_id)
+                    ORDER BY results_id LIMIT ? '''
+        rows = getDataDict(db, sql, (lastKey, batchSize))
+        if not rows:
+            break
+        lastKey = rows[-1]["results_id"]
+
+        for row in rows:
+            stats["results"] += 1
+            created = datetime.fromisoformat(str(row["resultTimestamp"])).timestamp()
+            stats["quotes"] += putQuoteRows(db, row["results_id"], row["search_id"],
+                                            getSearchResult(db, row["search_id"]), created) or 0
+
+    return stats
+
+
+def splitResponses(browseQuotesList):
+    """
+    Splits a list of raw BrowseQuotes responses into content addressed blobs:
+    the body of each response, and each of its sharedResponseKeys. Blobs are
+    identified by the sha256 hash of their canonical json, so identical
+    content (e.g. the Places of a rerun search) is held only once.
+
+    Args:
+        browseQuotesList (List( of dictionaries): API responses, as for
+        logBQResults.
+
+    Returns:
+        (tuple): (manifest, blobs) where manifest is a dictionary describing
+        how to put the responses back together (refer to joinResponses), and
+        blobs is a dictionary of blobHash: canonical json bytes.
+    """
+    blobs = {}
+
+    def addBlob(obj):
+        data = storage_codec.canonicalJson(obj)
+        blobHash = hashlib.sha256(data).hexdigest()
+        blobs[blobHash] = data
+        return blobHash
+
+    responses = []
+    for response in browseQuotesList:
+        refs = {}
+        if isinstance(response, dict):
+            refs = {key: addBlob(response[key]) for key in sharedResponseKeys if key in response}
+            response = {key: value for key, value in response.items() if key not in refs}
+        responses.append({"body": addBlob(response), "refs": refs})
+
+    return {"responseBlobs": 1, "responses": responses}, blobs
+
+
+def putResponseBlobs(db, blobs, created):
+    """
+    Stores the blobs from splitResponses that are not already stored.
+
+    Args:
+        db(string): The address of the database file to be written to.
+
+        blobs(dictionary): blobHash: canonical json bytes.
+
+        created(datetime): The time to record against new blobs.
+    """
+    data = blobRows(db, blobs, created)
+
+    if data:
+        putDataMany(db, insertSQL_response_blobs, data)
+
+
+def blobRows(db, blobs, created):
+    """
+    Returns the rows of response_blobs for the blobs from splitResponses that
+    are not already stored, in the order of insertSQL_response_blobs.
+    """
+    existing = set(getResponseBlobs(db, blobs, decode=False))
+
+    return [(blobHash, created, storage_codec.encodeJsonBytes(blobData))
+            for blobHash, blobData in blobs.items() if blobHash not in existing]
+
+
+def getResponseBlobs(db, blobHashes, decode=True):
+    """
+    Returns the stored blobs with the given hashes.
+
+    Args:
+        db(string): The address of the database file to interogate
+
+        blobHashes(iterable(of strings)): The hashes of the blobs.
+
+        decode(boolean): Optional, if False only the hashes are looked up, and
+        the values returned are None.
+
+    Returns:
+        blobs(dictionary): blobHash: the stored object, for each hash found.
+    """
+    blobHashes = list(blobHashes)
+    blobs = {}
+    column = "blobData" if decode else "NULL AS blobData"
+
+    for start in range(0, len(blobHashes), blobQueryBatch):
+        batch = blobHashes[start:start + blobQueryBatch]
+        sql = "SELECT blobHash, {} FROM response_blobs WHERE blobHash IN ({})".format(
+            column, ",".join("?" * len(batch)))
+        for row in getDataDict(db, sql, tuple(batch)) or []:
+            blobs[row["blobHash"]] = storage_codec.decodeJson(row["blobData"]) if decode else None
+
+    return blobs
+
+
+def joinResponses(db, manifest):
+    """
+    Puts the list of raw responses split by splitResponses back together.
+
+    Args:
+        db(string): The address of the database file to interogate
+
+        manifest(dictionary): As returned by splitResponses.
+
+    Returns:
+        browseQuotesList (List( of dictionaries): The original responses.
+        Responses may share the same objects for their sharedResponseKeys.
+
+    Exceptions:
+        KeyError: If a referenced blob is missing.
+    """
+    blobHashes = set()
+    for entry in manifest["responses"]:
+        blobHashes.add(entry["body"])
+        blobHashes.update(entry["refs"].values())
+    blobs = getResponseBlobs(db, blobHashes)
+
+    browseQuotesList = []
+    for entry in manifest["responses"]:
+        response = blobs[entry["body"]]
+        if entry["refs"]:
+            response = dict(response)
+            for key, blobHash in entry["refs"].items():
+                response[key] = blobs[blobHash]
+        browseQuotesList.append(response)
+
+    return browseQuotesList
+
+
+def packFormattedResults(formattedResults, failedQueries, numQueries):
+    """
+    Returns formatted results encoded for the formattedJson column, refer to
+    packQuotes in quote_records.py.
+    """
+    return storage_codec.encodeJson({"failedQueries": failedQueries, "numQueries": numQueries,
+                                     "quotes": quote_records.packQuotes(formattedResults)})
+
+
+def getFormattedSearchResult(db, search_id):
+    """
+    Returns the stored formatted results for a search, if they were stored by
+    the current version of the formatter.
+
+    Args:
+        db(string): The address of the database file to interogate
+
+        search_id(integer): The unique identifier for the search.
+
+    Returns:
+        (tuple): (formattedResults, failedQueries, numQueries) where
+        formattedResults is a list of Quotes. None if the search has no stored
+        formatted results, or they were stored by an earlier formatter version.
+    """
+    sql = "SELECT formattedJson, formatterVersion FROM browse_quotes_results WHERE search_id=?"
+
+    awaitLogWrites(db, ("results", str(search_id)))
+    resultDB = getDataDict(db, sql, (search_id,))
+    if not resultDB or resultDB[0]["formatterVersion"] != quote_records.formatVersion:
+        return None
+
+    formatted = storage_codec.decodeJson(resultDB[0]["formattedJson"])
+
+    return (quote_records.unpackQuotes(formatted["quotes"]), formatted["failedQueries"],
+            formatted["numQueries"])
+
+
+def updateFormattedSearchResult(db, search_id, formattedResults, failedQueries, numQueries):
+    """
+    Replaces the stored formatted results for a search, e.g. once rebuilt by
+    the current version of the formatter.
+
+    Args:
+        db(string): The address of the database file to be written to.
+
+        search_id(integer): The unique identifier for the search.
+
+        formattedResults(list(of Quotes)): The output of BrowseQuotesFormatResults.
+
+        failedQueries(integer): The number of unsuccessful responses.
+
+        numQueries(integer): The total number of responses.
+    """
+    sql = "UPDATE browse_quotes_results SET formattedJson=?, formatterVersion=? WHERE search_id=?"
+
+    data = (packFormattedResults(formattedResults, failedQueries, numQueries),
+            quote_records.formatVersion, search_id)
+
+    return putData(db, sql, data)
+
+def updatePriceCalendar(db, search_id, browseQuotesList, updated):
+    """
+    Upserts the cheapest price for each route and date pair in the results of
+    a search into the price_calendar table. Prices already stored from more
+    recent results are kept.
+
+    Args:
+        db(string): The address of the database file to be written to.
+
+        search_id(integer): The unique id of the search, whose logged query
+        list is used to find the route of each response. Nothing is stored if
+        the search has no logged query.
+
+        browseQuotesList (List( of dictionaries): The response to each query
+        of the search, as for logBQResults.
+
+        updated(float): The time of the results, in seconds since epoch.
+    """
+    # Results may be stored without a logged query, e.g. by benchmark.py
+    if not getDataDict(db, "SELECT 1 FROM search_bq_log WHERE search_id=?", (search_id,)):
+        return None
+
+    data = calendarRows(search_id, getSearchQuery(db, search_id), browseQuotesList, updated)
+    if not data:
+        return None
+
+    return putDataMany(db, upsertSQL_price_calendar, data)
+
+
+def calendarRows(search_id, queryList, browseQuotesList, updated):
+    """
+    Returns the rows of price_calendar for the results of a search (refer to
+    calendarCells in price_calendar.py), in the order of
+    upsertSQL_price_calendar.
+    """
+    return [key + (minPrice, updated, search_id)
+            for key, minPrice in price_calendar.calendarCells(queryList, browseQuotesList).items()]
+
+
+def getPriceCalendar(db, originplace, destinationplace, currency, outboundFrom, outboundTo):
+    """
+    Returns the price_calendar cells of a route for a range of outbound dates.
+
+    Args:
+        db(string): The address of the database file to interogate
+
+        originplace, destinationplace(string): The Skyscanner PlaceIds of the
+        route, as in the search queries.
+
+        currency(string): The currency of the prices.
+
+        outboundFrom, outboundTo(string): The inclusive range of outbound
+        dates, in the format yyyy-mm-dd.
+
+    Returns:
+        calendarRows(list(of dictionaries)): With the keys outboundDate,
+        inboundDate, minPrice and updated.
+    """
+    sql = ''' SELECT outboundDate, inboundDate, minPrice, updated FROM price_calendar
+                WHERE originplace=? AND destinationplace=? AND currency=?
+                AND outboundDate BETWEEN ? AND ? '''
+
+    # Cells from any search may be queued
+    awaitLogWrites(db)
+    return getDataDict(db, sql, (originplace, destinationplace, currency, outboundFrom, outboundTo)) or []
+
+
+def rebuildPriceCalendar(db, batchSize=100):
+    """
+    Adds the results stored before the price_calendar table existed to it,
+    oldest first, so the most recent price for each cell is kept.
+
+    Args:
+        db(string): The address of the database file.
+
+        batchSize(integer): Optional, the number of results read at a time.
+
+    Returns:
+        stats(dictionary): The number of "results" read, and the number of
+        "cells" in the price_calendar table.
+    """
+    stats = {"results": 0, "cells": 0}
+    lastKey = 0
+
+    while True:
+        sql = "SELECT results_id, search_id, resultTimestamp FROM browse_quotes_results WHERE results_id > ? ORDER BY results_id LIMIT ?"
+        rows = getDataDict(db, sql, (lastKey, batchSize))
+        if not rows:
+            break
+        lastKey = rows[-1]["results_id"]
+
+        for row in rows:
+            stats["results"] += 1
+            updated = datetime.fromisoformat(str(row["resultTimestamp"])).timestamp()
+            updatePriceCalendar(db, row["search_id"], getSearchResult(db, row["search_id"]), updated)
+
+    stats["cells"] = getDataDict(db, "SELECT COUNT(*) AS cells FROM price_calendar", ())[0]["cells"]
+
+    return stats
+
+
+def getSearchUser(db, search_id):
+    """
+    Returns the user_id that a search was recorded against.
+
+    Args:
+        db(string): The address of the database file to interogate
+
+        search_id(integer): The unique identifier for the search.
+
+    Returns:
+        user_id(integer): The user id, "" for a search made without logging in,
+        or None if the search does not exist.
+    """
+    sql = "SELECT user_id FROM search_bq_log WHERE search_id=?"
+
+    awaitLogWrites(db, ("search", str(search_id)))
+    result = getDataDict(db, sql, (search_id,))
+
+    if not result:
+        return None
+
+    return result[0]["user_id"]
+
+
+""" Write-behind logging functions """
+
+def getWriteBehindLogger(db):
+    """
+    Returns the write-behind logger of a database, starting its writer thread
+    on first use. Refer to writeBehind and write_behind.py.
+
+    Args:
+        db(string): The address of the database file.
+
+    Returns:
+        logger(WriteBehindLogger): The logger, which writes through
+        writeLogBatch.
+    """
+    with _writeBehindLock:
+        logger = _writeBehindLoggers.get(db)
+        if logger is None:
+            logger = write_behind.WriteBehindLogger(lambda items: writeLogBatch(db, items),
+                                                    writeBehindQueueSize, writeBehindBatchSize)
+            _writeBehindLoggers[db] = logger
+
+    return logger
+
+def _nextLogId(db, table):
+    """
+    Allocates the id of a row of table to be queued for the write-behind
+    logger. The first id follows the last one allocated by SQLite, from the
+    sqlite_sequence table. Called holding _writeBehindIdLock.
+    """
+    lastId = _writeBehindIds.get((db, table))
+    if lastId is None:
+        rows = getDataDict(db, "SELECT seq FROM sqlite_sequence WHERE name=?", (table,))
+        lastId = rows[0]["seq"] if rows else 0
+
+    _writeBehindIds[(db, table)] = lastId + 1
+
+    return lastId + 1
+
+def awaitLogWrites(db, key=None):
+    """
+    Waits until writes queued for the write-behind logger of a database have
+    been committed, so that they may be read. Returns at once if the database
+    has no write-behind logger.
+
+    Args:
+        db(string): The address of the database file.
+
+        key(tuple): Optional, the writes to wait for, as queued by logBQQuery
+        and logBQResults: ("search", search_id), ("results", search_id) or
+        ("user", user_id), with the id as a string. If None, every write
+        queued so far.
+
+    Exceptions:
+        write_behind.WriteFailedError: If the last write queued with a
+        "search" or "results" key could not be written, so that the reader
+        does not go on to look for rows that were never stored. A failed
+        write is not raised for a "user" key, as the user's other searches
+        may still be read.
+    """
+    logger = _writeBehindLoggers.get(db)
+    if logger is not None and not logger.waitFor(key) and key[0] != "user":
+        raise write_behind.WriteFailedError("The {} {} could not be stored".format(*key))
+
+def writeLogBatch(db, items):
+    """
+    Writes searches and results queued by logBQQuery and logBQResults in one
+    transaction, with an executemany for each table. Called by the writer
+    thread of the write-behind logger of the database.
+
+    Args:
+        db(string): The address of the database file to be written to.
+
+        items(list(of tuples)): The queued writes, in the order queued, each
+        either:
+            ("search_bq_log", search_id, user_id, searchQuery, timestamp)
+            ("browse_quotes_results", results_id, search_id, user_id,
+             browseQuotesList, formattedResults, failedQueries, resultTimestamp)
+        with the arguments as for logBQQuery and logBQResults.
+
+    Exceptions:
+        sqlite3.Error: If the batch could not be written, in which case none
+        of it is.
+    """
+    searchRows, resultsRows, calendar, quotes, resultCounts = [], [], [], [], []
+    blobs, places, carriers = {}, {}, {}
+
+    # The query of each search, for the price calendar of its results
+    searchQueries = {}
+
+    for item in items:
+        if item[0] == "search_bq_log":
+            table, search_id, user_id, searchQuery, timestamp = item
+            searchQueries[search_id] = searchQuery
+            searchRows.append(searchRow(search_id, user_id, searchQuery, timestamp))
+            continue
+
+        (table, results_id, search_id, user_id, browseQuotesList, formattedResults, failedQueries,
+         resultTimestamp) = item
+        updated = resultTimestamp.timestamp()
+
+        data, resultsBlobs = resultsRow(results_id, search_id, user_id, browseQuotesList, formattedResults,
+                                        failedQueries, resultTimestamp)
+        resultsRows.append(data)
+        blobs.update(resultsBlobs)
+
+        # The query is in this batch, or was written by an earlier one.
+        # Results may be stored without a logged query, e.g. by benchmark.py
+        if storePriceCalendar:
+            if search_id not in searchQueries and getDataDict(
+                    db, "SELECT 1 FROM search_bq_log WHERE search_id=?", (search_id,)):
+                searchQueries[search_id] = getSearchQuery(db, search_id)
+            if search_id in searchQueries:
+                calendar.extend(calendarRows(search_id, searchQueries[search_id], browseQuotesList, updated))
+
+        if storeQuoteRows:
+            resultsQuotes, resultsPlaces, resultsCarriers = quoteRows(browseQuotesList)
+            quotes.extend((results_id, search_id, updated) + quote for quote in resultsQuotes)
+            places.update(resultsPlaces)
+            carriers.update(resultsCarriers)
+
+        resultCounts.append((resultCount(browseQuotesList, formattedResults), search_id))
+
+    blobData = blobRows(db, blobs, datetime.now()) if blobs else []
+    places, carriers = newDimensions(db, places, carriers)
+
+    with _useConnection(db) as conn:
+        conn.executemany(insertSQL_search_bq_log, searchRows)
+        conn.executemany(insertSQL_browse_quotes_results, resultsRows)
+        conn.executemany(insertSQL_response_blobs, blobData)
+        conn.executemany(upsertSQL_price_calendar, calendar)
+        conn.executemany(upsertSQL_places, places.values())
+        conn.executemany(upsertSQL_carriers, carriers.values())
+        conn.executemany(insertSQL_quotes, quotes)
+        conn.executemany(updateSQL_resultCount, resultCounts)
+
+    storeDimensions(db, places, carriers)
+
+def flushWriteBehind(db, timeout=None):
+    """
+    Waits until every write queued for the write-behind logger of a database
+    has been committed, e.g. before another process reads the database.
+
+    Args:
+        db(string): The address of the database file.
+
+        timeout(float): Optional, the most seconds to wait.
+
+    Returns:
+        (Bool): False if the timeout passed first, otherwise True.
+    """
+    logger = _writeBehindLoggers.get(db)
+
+    return logger.flush(timeout) if logger is not None else True
+
+def getWriteBehindStatus(db):
+    """
+    Returns the backpressure and lag counters of the write-behind logger of a
+    database, refer to WriteBehindLogger.status in write_behind.py, or None if
+    the database has no write-behind logger.
+    """
+    logger = _writeBehindLoggers.get(db)
+
+    return logger.status() if logger is not None else None
+
+def closeWriteBehind(timeout=None):
+    """
+    Writes everything still queued for each write-behind logger, and stops
+    their writer threads. Registered to run at exit, before the connections
+    are closed by closeAllConnections. A later logBQQuery or logBQResults
+    starts a new logger.
+
+    Args:
+        timeout(float): Optional, the most seconds to wait for each logger.
+    """
+    with _writeBehindLock:
+        closing = list(_writeBehindLoggers.items())
+
+    for db, logger in closing:
+        if not logger.close(timeout):
+            print("Write-behind logger of {} did not finish writing".format(db))
+
+        # A new logger allocates ids again from the database
+        with _writeBehindIdLock:
+            with _writeBehindLock:
+                _writeBehindLoggers.pop(db, None)
+            for table in ("search_bq_log", "browse_quotes_results"):
+                _writeBehindIds.pop((db, table), None)
+
+atexit.register(closeWriteBehind)
+
+
+""" Search job functions """
+
+def createSearchJob(db, search_id, user_id, totalCalls):
+    """
+    Uses putData to record a new queued search job.
+
+    Args:
+        db(string): The address of the database file to be written to.
+
+        search_id(integer): The search, from logBQQuery, that the job will run.
+
+        user_id(integer): User id for the job. May be "" if no user_id to be
+        stored.
+
+        totalCalls(integer): The number of API calls planned for the search.
+
+    Returns:
+        job_id(integer): The unique autoincrement value for the job.
+    """
+    timestamp = datetime.now()
+
+    sql = ''' INSERT INTO search_jobs(search_id,user_id,status,totalCalls,
+                                      completedCalls,created,updated)
+                VALUES(?,?,?,?,?,?,?) '''
+
+    return putData(db, sql, (search_id, user_id, "queued", totalCalls, 0, timestamp, timestamp))
+
+def updateSearchJob(db, job_id, status, completedCalls=None, errorMessage=None, totalCalls=None):
+    """
+    Uses putData to update the status and progress of a search job.
+
+    Args:
+        db(string): The address of the database file to be written to.
+
+        job_id(integer): The unique identifier for the job.
+
+        status(string): "queued", "running", "done" or "failed".
+
+        completedCalls(integer): Optional, the number of API calls completed.
+        Left unchanged if None.
+
+        errorMessage(string): Optional, the reason for a failure.
+
+        totalCalls(integer): Optional, the number of API calls the job makes,
+        e.g. once follow-up calls are known. Left unchanged if None.
+    """
+    sql = ''' UPDATE search_jobs SET status=?, completedCalls=coalesce(?, completedCalls),
+                                     totalCalls=coalesce(?, totalCalls), errorMessage=?, updated=?
+                WHERE job_id=? '''
+
+    return putData(db, sql, (status, completedCalls, totalCalls, errorMessage, datetime.now(), job_id))
+
+def getSearchJob(db, job_id):
+    """
+    Returns a search job.
+
+    Args:
+        db(string): The address of the database file to interogate
+
+        job_id(integer): The unique identifier for the job.
+
+    Returns:
+        job(dict): The columns of the search_jobs table for the job, or None
+        if the job does not exist.
+    """
+    sql = "SELECT * FROM search_jobs WHERE job_id=?"
+
+    result = getDataDict(db, sql, (job_id,))
+
+    if not result:
+        return None
+
+    return result[0]
+
+def getSearchJobForSearch(db, search_id):
+    """
+    Returns the latest search job for a search.
+
+    Args:
+        db(string): The address of the database file to interogate
+
+        search_id(integer): The unique identifier for the search.
+
+    Returns:
+        job(dict): The columns of the search_jobs table for the job, or None
+        if the search was not run as a job.
+    """
+    sql = "SELECT * FROM search_jobs WHERE search_id=? ORDER BY job_id DESC LIMIT 1"
+
+    result = getDataDict(db, sql, (search_id,))
+
+    if not result:
+        return None
+
+    return result[0]
+
+def getUnfinishedSearchJobs(db):
+    """
+    Returns all search jobs that are queued or running, oldest first. Used to
+    resume jobs interrupted by an app restart.
+
+    Args:
+        db(string): The address of the database file to interogate
+
+    Returns:
+        jobs(list(of dictionaries)): The columns of the search_jobs table for
+        each job.
+    """
+    sql = "SELECT * FROM search_jobs WHERE status IN ('queued','running') ORDER BY job_id"
+
+    return getDataDict(db, sql, ())
+
+
+""" BrowseQuotes cache functions """
+
+def getCachedQuote(db, cacheKey, now):
+    """
+    Returns an unexpired cached BrowseQuotes response from the quote_cache table.
+
+    Args:
+        db(string): The address of the cache database file to interogate.
+
+        cacheKey(string): The normalised BrowseQuotes URL for the query.
+
+        now(float): The current time in seconds since epoch.
+
+    Returns:
+        (tuple): (response_json (dictionary), expires (float)) for the cached
+        response, or None if there is no unexpired entry.
+    """
+    sql = "SELECT expires, responseJson FROM quote_cache WHERE cacheKey=? AND expires>?"
+
+    result = getDataDict(db, sql, (cacheKey, now))
+
+    if not result:
+        return None
+
+    return (json.loads(result[0]["responseJson"]), result[0]["expires"])
+
+def isCachedQuote(db, cacheKey, now):
+    """
+    Checks whether the quote_cache table holds an unexpired response for the
+    query, without loading the response.
+
+    Args:
+        db(string): The address of the cache database file to interogate.
+
+        cacheKey(string): The normalised BrowseQuotes URL for the query.
+
+        now(float): The current time in seconds since epoch.
+
+    Returns:
+        (Bool): True if an unexpired entry is present.
+    """
+    sql = "SELECT 1 FROM quote_cache WHERE cacheKey=? AND expires>?"
+
+    result = getDataDict(db, sql, (cacheKey, now))
+
+    return bool(result)
+
+def putCachedQuote(db, cacheKey, response_json, now, expires):
+    """
+    Uses putData to add or replace a cached BrowseQuotes response in the
+    quote_cache table.
+
+    Args:
+        db(string): The address of the cache database file to be written to.
+
+        cacheKey(string): The normalised BrowseQuotes URL for the query.
+
+        response_json(dictionary): The response received from the API endpoint.
+
+        now(float): The current time in seconds since epoch.
+
+        expires(float): The time, in seconds since epoch, after which the entry
+        is no longer valid.
+    """
+    sql = ''' INSERT OR REPLACE INTO quote_cache(cacheKey,created,expires,responseJson)
+                VALUES(?,?,?,?) '''
+
+    return putData(db, sql, (cacheKey, now, expires, json.dumps(response_json)))
+
+def pruneQuoteCache(db, maxEntries, now):
+    """
+    Removes expired entries from the quote_cache table, then the oldest entries
+    beyond maxEntries.
+
+    Args:
+        db(string): The address of the cache database file to be written to.
+
+        maxEntries(integer): The maximum number of entries to retain.
+
+        now(float): The current time in seconds since epoch.
+    """
+    putData(db, "DELETE FROM quote_cache WHERE expires<=?", (now,))
+
+    sql = ''' DELETE FROM quote_cache WHERE cacheKey IN
+                (SELECT cacheKey FROM quote_cache ORDER BY created DESC
+                 LIMIT -1 OFFSET ?) '''
+
+    return putData(db, sql, (maxEntries,))
+
+def db_logSLItineraries(db, user_id, search_id, results_id, resultsDict):
+    """
+    LEGACY - This function is not currently used as of version 0.5.1. Retained for
+    potential future use.
+
+    Uses putDataMany to log the formatted itinaries created by liveSearchFormatResult
+    for analysis and presentation to the user, and the associated search
+    metadata.
+    Refer to putData for further information on returns and exceptions.
+
+    Args:
+        db(string): The address of the database file to be written to.
+
+        user_id(integer): User id for the search to be recorded against. May be
+        "" if no user_id to be stored.
+
+        search_id(integer): The unique id of the search query for which the result
+        is associated.
+
+        results_id(integer): The unique id for the search result key from the
+        search_live_data table.
+
+        resultsDict (list(of dictionaries)): List of dictionaries containing the
+        itinary data defined within liveSearchFormatResult in ss_api_functions.
+
+    Constraints:
+        This function works by defining a generic SQL insertion statement, and determines
+        no number of variables to enter based on the number of key:value pair for the first 
+        entry in resultsDict, which is different for one-way and return trips. As such if
+        there are a mixture of return and single route trips in resultsDict, the SQL will
+        not commit properly. This may be fixed as part of a future datastructure refactor,
+        but does not currently affect core functionality of the program. 
+
+    """
+
+    # Create the SQL insertion to be used for each entry
+    columns = "user_id,search_id,results_id,itineraryTimestamp," + ','.join(resultsDict[0].keys())
+    # Placeholders for length of itinary, plus 3 id and 1 timestamp parameters
+    itineraryLength = len(resultsDict[0])
+    placeholders = ', '.join(['?'] * (itineraryLength + 4))
+    sql = "INSERT INTO search_live_data(%s) VALUES (%s)" % (columns, placeholders)
+
+    # Initialise values list
+    values = []
+
+    # For each itinerary dict in the list:
+    for itinerary in resultsDict:
+        # Create timestamp
+        itineraryTimestamp = datetime.now()
+
+        #Create a values tuple and append to list
+        entry = (user_id, search_id, results_id,itineraryTimestamp) + tuple(itinerary.values())
+        values.append(entry)
+
+    # Call PUT MANY function
+    putDataMany(db, sql, values)
+
+
+"""Specific database operators and wrappers"""
+
+def intialise(db):
+    """
+    Wrapper for use in app.py that creates (if none present) the database or
+    updates the structure and associated schema if required, by applying the
+    schemaMigrations not yet applied to it.
+
+    Args:
+        None
+
+    Returns:
+        Creates or updates the application database.db file in the app.py directory
+
+    Exceptions:
+        sqlite3.Error: If a migration fails, refer to migrateSchema.
+    """
+
+    # Connect to database
+    conn = db_connect(db)
+
+    if conn is not None:
+        # The journal mode is stored in the database file, so is set once here
+        conn.execute("PRAGMA journal_mode={}".format(journalMode))
+        applyPragmas(conn)
+
+        # Create the tables, or bring an existing database up to date, using
+        # the migrations defined above
+        migrateSchema(conn, schemaMigrations)
+
+    else:
+        print("Error! cannot create the database connection.")
+
+    # Disconnect from database
     if conn:
         conn.close()
 
 
+def intialiseQuoteCache(db):
+    """
+    Creates (if none present) the cache database used by the persistent tier of
+    the BrowseQuotes cache in ss_api_functions.
+
+    Args:
+        db(string): The address of the cache database file.
+    """
+    conn = db_connect(db)
+
+    if conn is not None:
+        conn.execute("PRAGMA journal_mode={}".format(journalMode))
+        createTable(conn, createTableSQL_quote_cache)
+        createTable(conn, "CREATE INDEX IF NOT EXISTS quote_cache_created ON quote_cache(created)")
+
+    else:
+        print("Error! cannot create the cache database connection.")
+
+    # Disconnect from database
+    if conn:
+        conn.close()
+
+
+def migrateStorageCodec(db, codec=None, batchSize=500):
+    """
+    Re-encodes every value in encodedColumns with a storage codec, e.g. to
+    compress values stored as plain json text by earlier versions. Values
+    already stored with the codec are left unchanged. Each batch of rows is
+    updated in its own transaction, so the migration may be interrupted and
+    run again.
+
+    Args:
+        db(string): The address of the database file.
+
+        codec(string): Optional, one of storage_codec.availableCodecs().
+        Defaults to storage_codec.storageCodec.
+
+        batchSize(integer): Optional, the number of rows per transaction.
+
+    Returns:
+        stats(dictionary): For each "table.column", a dictionary of the number
+        of "rows" read, the number "converted", and the total stored size in
+        bytes "before" and "after".
+    """
+    codec = codec or storage_codec.storageCodec
+    stats = {}
+    conn = db_connect(db)
+
+    try:
+        for table, keyColumn, column in encodedColumns:
+            columnStats = {"rows": 0, "converted": 0, "before": 0, "after": 0}
+            stats[table + "." + column] = columnStats
+            lastKey = 0
+
+            while True:
+                rows = conn.execute("SELECT {0}, {1} FROM {2} WHERE {0} > ? ORDER BY {0} LIMIT ?".format(
+                                        keyColumn, column, table), (lastKey, batchSize)).fetchall()
+                if not rows:
+                    break
+                lastKey = rows[-1][0]
+
+                updates = []
+                for key, value in rows:
+                    columnStats["rows"] += 1
+                    if value is None:
+                        continue
+                    columnStats["before"] += storage_codec.storedSize(value)
+                    if storage_codec.valueCodec(value) != codec:
+                        value = storage_codec.encodeJson(storage_codec.decodeJson(value), codec)
+                        updates.append((value, key))
+                    columnStats["after"] += storage_codec.storedSize(value)
+
+                with conn:
+                    conn.executemany("UPDATE {} SET {}=? WHERE {}=?".format(table, column, keyColumn), updates)
+                columnStats["converted"] += len(updates)
+
+    finally:
+        conn.close()
+
+    return stats
+
+
+def dedupResponseBlobs(db, batchSize=100, graceSeconds=3600):
+    """
+    Moves raw results stored in full in browse_quotes_results (by earlier
+    versions) into response_blobs, then deletes any blobs no longer
+    referenced by a result. Each batch of rows is updated in its own
+    transaction, so the conversion may be interrupted and run again.
+
+    Blobs are stored before the result that references them, so the app may
+    have stored blobs it has not yet referenced. The delete is made in one
+    transaction with a final check of the results stored since they were
+    read, and only blobs stored more than graceSeconds ago are deleted. A
+    blob stored earlier that a search being logged finds and reuses is not
+    protected, so stop the app first where that matters (db_tools.py says to).
+
+    Args:
+        db(string): The address of the database file.
+
+        batchSize(integer): Optional, the number of rows per transaction.
+
+        graceSeconds(float): Optional, blobs stored within this many seconds
+        are kept even if unreferenced.
+
+    Returns:
+        stats(dictionary): The number of result "rows" read, the number
+        "converted", the number of "blobs" remaining and the number of blobs
+        "deleted".
+    """
+    stats = {"rows": 0, "converted": 0, "blobs": 0, "deleted": 0}
+    referenced = set()
+    lastKey = 0
+
+    def addReferences(stored):
+        for entry in stored["responses"]:
+            referenced.add(entry["body"])
+            referenced.update(entry["refs"].values())
+
+    while True:
+        sql = "SELECT results_id, resultsJson FROM browse_quotes_results WHERE results_id > ? ORDER BY results_id LIMIT ?"
+        rows = getDataDict(db, sql, (lastKey, batchSize))
+        if not rows:
+            break
+        lastKey = rows[-1]["results_id"]
+
+        updates = []
+        for row in rows:
+            stats["rows"] += 1
+            stored = storage_codec.decodeJson(row["resultsJson"])
+            if stored is None:
+                continue
+            if not (isinstance(stored, dict) and "responseBlobs" in stored):
+                stored, blobs = splitResponses(stored)
+                putResponseBlobs(db, blobs, datetime.now())
+                updates.append((storage_codec.encodeJson(stored), row["results_id"]))
+            addReferences(stored)
+
+        if updates:
+            putDataMany(db, "UPDATE browse_quotes_results SET resultsJson=? WHERE results_id=?", updates)
+        stats["converted"] += len(updates)
+
+    # Delete blobs not referenced by any result, holding the write lock so
+    # that no result is stored between the last check and the delete
+    cutoff = datetime.now() - timedelta(seconds=graceSeconds)
+    conn = db_connect(db)
+    conn.isolation_level = None
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        # Results stored since the scan above may reference older blobs
+        for resultsJson, in conn.execute("SELECT resultsJson FROM browse_quotes_results WHERE results_id > ?",
+                                         (lastKey,)):
+            stored = storage_codec.decodeJson(resultsJson)
+            if isinstance(stored, dict) and "responseBlobs" in stored:
+                addReferences(stored)
+
+        unreferenced = [(blobHash,) for blobHash, in conn.execute(
+                            "SELECT blobHash FROM response_blobs WHERE created < ?", (cutoff,))
+                        if blobHash not in referenced]
+        conn.executemany("DELETE FROM response_blobs WHERE blobHash=?", unreferenced)
+        conn.execute("COMMIT")
+    except Error:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    stats["deleted"] = len(unreferenced)
+    stats["blobs"] = len(referenced)
+
+    return stats
+
+
 def main():
     """ Test Area"""
     # Create the database if it doesn't exist
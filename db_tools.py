@@ -0,0 +1,156 @@
+"""
+This file contains command line maintenance tools for the Escapade database.
+
+    python db_tools.py migrate-codec --db escapade.db --codec zlib --vacuum
+    python db_tools.py dedup-blobs --db escapade.db --vacuum
+    python db_tools.py build-calendar --db escapade.db
+    python db_tools.py backfill-quotes --db escapade.db
+    python db_tools.py cheapest --db escapade.db --origin LHR --destination AMS --days 30
+
+migrate-codec re-encodes the stored json values (search queries, raw and
+formatted results) with a storage codec, refer to storage_codec.py.
+
+dedup-blobs moves raw results stored in full into the shared response_blobs
+table, and deletes blobs that are no longer referenced and were stored more
+than --grace seconds ago (refer to splitResponses and dedupResponseBlobs in
+db_functions.py).
+
+build-calendar adds results stored before the price_calendar table existed to
+it (refer to price_calendar.py).
+
+backfill-quotes adds the quotes of results stored before the quotes table
+existed to it. cheapest lists the cheapest quotes stored on a route (refer to
+getCheapestQuotes in db_functions.py), and makes no changes.
+
+Stop the app, and back up the database, before running any of them.
+"""
+
+import argparse
+import os
+from datetime import datetime, timedelta
+import db_functions
+import storage_codec
+
+
+def migrateCodec(args):
+    """
+    Runs migrateStorageCodec and reports the change in stored size.
+    """
+    print("Converting {} to the {} codec".format(args.db, args.codec))
+    stats = db_functions.migrateStorageCodec(args.db, args.codec, args.batch)
+
+    for column, columnStats in stats.items():
+        print("{}: {} rows, {} converted, {:,} -> {:,} bytes".format(
+            column, columnStats["rows"], columnStats["converted"], columnStats["before"],
+            columnStats["after"]))
+
+    if args.vacuum:
+        vacuum(args.db)
+
+
+def dedupBlobs(args):
+    """
+    Runs dedupResponseBlobs and reports the rows converted.
+    """
+    # Create the response_blobs table if the database predates it
+    db_functions.intialise(args.db)
+    stats = db_functions.dedupResponseBlobs(args.db, args.batch, args.grace)
+
+    print("{} results read, {} converted, {} blobs referenced, {} unreferenced blobs deleted".format(
+        stats["rows"], stats["converted"], stats["blobs"], stats["deleted"]))
+
+    if args.vacuum:
+        vacuum(args.db)
+
+
+def buildCalendar(args):
+    """
+    Runs rebuildPriceCalendar and reports the cells stored.
+    """
+    # Create the price_calendar table if the database predates it
+    db_functions.intialise(args.db)
+    stats = db_functions.rebuildPriceCalendar(args.db, args.batch)
+
+    print("{} results read, {} price calendar cells".format(stats["results"], stats["cells"]))
+
+
+def backfillQuotes(args):
+    """
+    Runs backfillQuotes and reports the quotes added.
+    """
+    # Create the quotes table if the database predates it
+    db_functions.intialise(args.db)
+    stats = db_functions.backfillQuotes(args.db, args.batch)
+
+    print("{} results read, {} quotes added".format(stats["results"], stats["quotes"]))
+
+
+def cheapest(args):
+    """
+    Prints the cheapest quotes stored on a route.
+    """
+    seenFrom = datetime.now() - timedelta(days=args.days) if args.days else None
+    quotes = db_functions.getCheapestQuotes(args.db, args.origin, args.destination, seenFrom,
+                                            limit=args.limit)
+
+    for quote in quotes:
+        print("{:>10.2f} {}  {} -> {}  {} {}  {}".format(
+            quote["price"], quote["currency"] or "", quote["originName"], quote["destinationName"],
+            quote["outboundDate"], quote["inboundDate"] or "one way",
+            datetime.fromtimestamp(quote["created"]).strftime("%Y-%m-%d %H:%M")))
+
+
+def vacuum(db):
+    """
+    Vacuums the database, returning the space freed by earlier changes to the
+    file system.
+    """
+    sizeBefore = os.path.getsize(db)
+    conn = db_functions.db_connect(db)
+    conn.execute("VACUUM")
+    conn.close()
+    print("Vacuumed {}: {:,} -> {:,} bytes".format(db, sizeBefore, os.path.getsize(db)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Escapade database maintenance tools")
+    parser.add_argument("--db", default=os.environ.get("ESCAPADE_DB", "escapade.db"),
+                        help="The database file")
+    subparsers = parser.add_subparsers(dest="tool")
+    subparsers.required = True
+
+    codec = subparsers.add_parser("migrate-codec", help="Re-encode stored json values")
+    codec.add_argument("--codec", choices=storage_codec.availableCodecs(),
+                       default=storage_codec.storageCodec)
+    codec.add_argument("--batch", type=int, default=500, help="Rows per transaction")
+    codec.add_argument("--vacuum", action="store_true", help="Vacuum the database afterwards")
+    codec.set_defaults(run=migrateCodec)
+
+    blobs = subparsers.add_parser("dedup-blobs", help="Store raw results as shared blobs")
+    blobs.add_argument("--batch", type=int, default=100, help="Rows per transaction")
+    blobs.add_argument("--grace", type=float, default=3600,
+                       help="Keep unreferenced blobs stored within this many seconds")
+    blobs.add_argument("--vacuum", action="store_true", help="Vacuum the database afterwards")
+    blobs.set_defaults(run=dedupBlobs)
+
+    calendar = subparsers.add_parser("build-calendar", help="Add stored results to the price calendar")
+    calendar.add_argument("--batch", type=int, default=100, help="Results read at a time")
+    calendar.set_defaults(run=buildCalendar)
+
+    quotes = subparsers.add_parser("backfill-quotes", help="Add stored results to the quotes table")
+    quotes.add_argument("--batch", type=int, default=100, help="Results read at a time")
+    quotes.set_defaults(run=backfillQuotes)
+
+    cheapestQuotes = subparsers.add_parser("cheapest", help="The cheapest quotes stored on a route")
+    cheapestQuotes.add_argument("--origin", required=True, help="Skyscanner or IATA code")
+    cheapestQuotes.add_argument("--destination", help="Skyscanner or IATA code")
+    cheapestQuotes.add_argument("--days", type=int, default=0, help="Only quotes stored in the last N days")
+    cheapestQuotes.add_argument("--limit", type=int, default=10)
+    cheapestQuotes.set_defaults(run=cheapest)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,324 @@
+"""
+This file is a local stand-in for the RapidAPI Skyscanner API, so that the
+performance of Escapade can be measured offline and reproducibly. It serves
+the BrowseQuotes and autosuggest endpoints with either recorded responses or
+synthetic Quotes/Places/Carriers payloads, with configurable latency and error
+rates.
+
+To use, run the server and point the app at it:
+    python mock_ss_server.py --port 5001 --latency 0.3 --error-rate 0.02
+    SS_API_BASE_URL=http://127.0.0.1:5001 flask run
+
+Refer to benchmark.py to run the app routes against it under load.
+"""
+
+import argparse
+import glob
+import itertools
+import json
+import os
+import random
+import threading
+import time
+import zlib
+from calendar import monthrange
+from flask import Flask, jsonify, request
+from ss_api_functions import CSVtoDict
+
+# Server behaviour, set from the command line or by createMockApp
+mockSettings = {
+    "latency": 0.2, # Mean seconds before responding
+    "latencyJitter": 0.05, # Standard deviation of the latency
+    "errorRate": 0.0, # Fraction of calls answered with a 500 error
+    "throttleRate": 0.0, # Fraction of calls answered with a 429 error
+    "numQuotes": 10, # Quotes per synthetic response, for each date pair served
+    "numCarriers": 20, # Carriers per synthetic response
+    "monthQuotes": 1000, # Most quotes in a month-level response, refer to cachedBrowseQuotes
+    "quota": 100000, # Reported in the x-ratelimit headers
+    }
+
+# Recorded responses to serve instead of synthetic ones, if any are loaded
+recordedResponses = []
+
+# Counters of the calls received, for reporting by benchmark.py. errors counts
+# every response with status 400 or above, injected or not, and throttled the
+# injected 429 responses
+mockStats = {"browseQuotes": 0, "autosuggest": 0, "errors": 0, "throttled": 0}
+_statsLock = threading.Lock()
+
+# Skyscanner places used for synthetic responses and autosuggest
+placesCsv = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "results_places.csv")
+_places = None
+
+
+def getPlaces():
+    """
+    Returns the places from data/results_places.csv, each with a numeric
+    PlaceId as used in BrowseQuotes responses.
+    """
+    global _places
+    if _places is None:
+        # Built in full before it is shared, as the server is threaded
+        places = []
+        for number, place in enumerate(CSVtoDict(placesCsv), 1000):
+            places.append({"PlaceId": number,
+                            "SkyscannerCode": place["PlaceId"].split("-")[0],
+                            "IataCode": place["PlaceId"].split("-")[0],
+                            "Name": place["PlaceName"],
+                            "CountryName": place["CountryName"],
+                            "Type": "Station",
+                            "CityId": place["CityId"],
+                            "PlaceCode": place["PlaceId"]})
+        _places = places
+    return _places
+
+
+def _datesIn(partialDate):
+    """
+    Returns the exact dates (yyyy-mm-dd) within a BrowseQuotes partial date,
+    which may be a month (yyyy-mm) or already an exact date.
+    """
+    if len(partialDate) == 10:
+        return [partialDate]
+    year, month = int(partialDate[:4]), int(partialDate[5:7])
+    return ["{}-{:02d}".format(partialDate, day) for day in range(1, monthrange(year, month)[1] + 1)]
+
+
+def _randomDate(partialDate, rng):
+    """
+    Returns an exact date (yyyy-mm-dd) within a BrowseQuotes partial date,
+    which may be a month (yyyy-mm) or already an exact date.
+    """
+    if len(partialDate) == 10:
+        return partialDate
+    year, month = int(partialDate[:4]), int(partialDate[5:7])
+    return "{}-{:02d}".format(partialDate, rng.randint(1, monthrange(year, month)[1]))
+
+
+def syntheticBrowseQuotes(originplace, destinationplace, outboundpartialdate,
+                          inboundpartialdate="", numQuotes=10, numCarriers=20, seed=None):
+    """
+    Generates a BrowseQuotes response with the same structure as the real
+    endpoint. The content is determined by the arguments, so the same query
+    always receives the same response.
+
+    Args:
+        originplace, destinationplace(string): Skyscanner place codes, e.g.
+        "LHR-sky".
+
+        outboundpartialdate, inboundpartialdate(string): Dates in the format
+        yyyy-mm-dd or yyyy-mm. inboundpartialdate may be "" for one way.
+
+        numQuotes(integer): The number of quotes to generate.
+
+        numCarriers(integer): The number of carriers in the Carriers list.
+
+        seed(integer): Optional, overrides the seed derived from the query.
+
+    Returns:
+        response_json(dictionary): With the keys "Quotes", "Places",
+        "Carriers" and "Currencies".
+    """
+    if seed is None:
+        seed = zlib.crc32("/".join([originplace, destinationplace, outboundpartialdate,
+                                    inboundpartialdate]).encode())
+    rng = random.Random(seed)
+
+    places = getPlaces()
+    placeCodes = {place["PlaceCode"]: place for place in places}
+    origin = placeCodes.get(originplace, places[0])
+    destination = placeCodes.get(destinationplace, places[1])
+
+    carriers = [{"CarrierId": 100 + number, "Name": "Carrier " + str(number)}
+                for number in range(numCarriers)]
+
+    quotes = []
+    for quoteId in range(1, numQuotes + 1):
+        quote = {"QuoteId": quoteId,
+                 "MinPrice": rng.randint(20, 400),
+                 "Direct": rng.random() < 0.5,
+                 "OutboundLeg": {"CarrierIds": [rng.choice(carriers)["CarrierId"]],
+                                 "OriginId": origin["PlaceId"],
+                                 "DestinationId": destination["PlaceId"],
+                                 "DepartureDate": _randomDate(outboundpartialdate, rng) + "T00:00:00"},
+                 "QuoteDateTime": "2021-01-01T00:00:00"}
+        if inboundpartialdate:
+            quote["InboundLeg"] = {"CarrierIds": [rng.choice(carriers)["CarrierId"]],
+                                   "OriginId": destination["PlaceId"],
+                                   "DestinationId": origin["PlaceId"],
+                                   "DepartureDate": _randomDate(inboundpartialdate, rng) + "T00:00:00"}
+        quotes.append(quote)
+
+    responsePlaces = [{key: place[key] for key in ("PlaceId", "IataCode", "Name", "Type",
+                                                   "SkyscannerCode", "CountryName")}
+                      for place in (origin, destination)]
+
+    return {"Quotes": quotes, "Places": responsePlaces, "Carriers": carriers,
+            "Currencies": [{"Code": "GBP", "Symbol": "£"}]}
+
+
+def cachedBrowseQuotes(originplace, destinationplace, outboundpartialdate,
+                       inboundpartialdate="", numQuotes=10, numCarriers=20, maxQuotes=None):
+    """
+    Generates a BrowseQuotes response as the real endpoint serves it from its
+    cache of quotes: a query for a whole month returns, for each date (or
+    date pair) in the month, the same quotes as a query for that exact date.
+    This is what lets month-level calls be split by date, refer to
+    query_planner.py.
+
+    Args:
+        originplace, destinationplace, outboundpartialdate, inboundpartialdate,
+        numQuotes, numCarriers: As for syntheticBrowseQuotes, with numQuotes
+        the number of quotes for each exact date pair.
+
+        maxQuotes(integer): Optional, the most quotes in the response. Date
+        pairs are added whole, in date order, so that a response may leave
+        out the later dates of a month but never part of a date.
+
+    Returns:
+        response_json(dictionary): As for syntheticBrowseQuotes.
+    """
+    inboundDates = _datesIn(inboundpartialdate) if inboundpartialdate else [""]
+
+    response_json = None
+    quotes = []
+    for outboundDate, inboundDate in itertools.product(_datesIn(outboundpartialdate), inboundDates):
+        dateResponse = syntheticBrowseQuotes(originplace, destinationplace, outboundDate, inboundDate,
+                                             numQuotes, numCarriers)
+        if maxQuotes is not None and quotes and len(quotes) + len(dateResponse["Quotes"]) > maxQuotes:
+            break
+        response_json = response_json or dateResponse
+        quotes.extend(dateResponse["Quotes"])
+
+    for quoteId, quote in enumerate(quotes, 1):
+        quote["QuoteId"] = quoteId
+    response_json["Quotes"] = quotes
+
+    return response_json
+
+
+def loadRecordedResponses(path):
+    """
+    Loads recorded BrowseQuotes responses to serve instead of synthetic ones.
+
+    Args:
+        path(string): A .json file, or a directory of .json files. Each file
+        holds a single response, or a list of responses (such as a
+        resultsJson value from the browse_quotes_results table).
+
+    Returns:
+        count(integer): The number of responses loaded.
+    """
+    files = sorted(glob.glob(os.path.join(path, "*.json"))) if os.path.isdir(path) else [path]
+    for fileName in files:
+        with open(fileName) as recordedFile:
+            recorded = json.load(recordedFile)
+        if isinstance(recorded, list):
+            recordedResponses.extend(response for response in recorded if "Quotes" in response)
+        else:
+            recordedResponses.append(recorded)
+
+    return len(recordedResponses)
+
+
+def _count(key):
+    with _statsLock:
+        mockStats[key] += 1
+
+
+def _rateLimitHeaders():
+    with _statsLock:
+        used = mockStats["browseQuotes"] + mockStats["autosuggest"]
+    return {"x-ratelimit-requests-limit": str(mockSettings["quota"]),
+            "x-ratelimit-requests-remaining": str(max(0, mockSettings["quota"] - used)),
+            "x-ratelimit-requests-reset": "3600"}
+
+
+def createMockApp():
+    """
+    Returns the Flask app serving the stand-in API endpoints.
+    """
+    mockApp = Flask(__name__)
+
+    @mockApp.before_request
+    def simulateConditions():
+        """Adds latency, and fails a fraction of calls"""
+        delay = random.gauss(mockSettings["latency"], mockSettings["latencyJitter"])
+        if delay > 0:
+            time.sleep(delay)
+
+        chance = random.random()
+        if chance < mockSettings["throttleRate"]:
+            _count("throttled")
+            return (jsonify({"message": "You have exceeded the rate limit per second for your plan"}),
+                    429, {"Retry-After": "1"})
+        if chance < mockSettings["throttleRate"] + mockSettings["errorRate"]:
+            return jsonify({"message": "Internal server error"}), 500
+
+    @mockApp.after_request
+    def countErrors(response):
+        """Counts the responses with an error status"""
+        if response.status_code >= 400:
+            _count("errors")
+        return response
+
+    @mockApp.route("/apiservices/browsequotes/v1.0/<country>/<currency>/<locale>/<originplace>/<destinationplace>/<outboundpartialdate>/",
+                   defaults={"inboundpartialdate": ""})
+    @mockApp.route("/apiservices/browsequotes/v1.0/<country>/<currency>/<locale>/<originplace>/<destinationplace>/<outboundpartialdate>/<inboundpartialdate>")
+    def browseQuotes(country, currency, locale, originplace, destinationplace,
+                     outboundpartialdate, inboundpartialdate):
+        """Serves a recorded or synthetic BrowseQuotes response"""
+        _count("browseQuotes")
+
+        if recordedResponses:
+            key = "/".join([originplace, destinationplace, outboundpartialdate, inboundpartialdate])
+            response_json = recordedResponses[zlib.crc32(key.encode()) % len(recordedResponses)]
+        else:
+            response_json = cachedBrowseQuotes(originplace, destinationplace, outboundpartialdate,
+                                               inboundpartialdate, mockSettings["numQuotes"],
+                                               mockSettings["numCarriers"], mockSettings["monthQuotes"])
+
+        return jsonify(response_json), 200, _rateLimitHeaders()
+
+    @mockApp.route("/apiservices/autosuggest/v1.0/<country>/<currency>/<locale>/")
+    def autosuggest(country, currency, locale):
+        """Serves places whose name contains the query string"""
+        _count("autosuggest")
+        query = request.args.get("query", "").lower()
+
+        places = [{"PlaceId": place["PlaceCode"], "PlaceName": place["Name"],
+                   "CountryId": "", "RegionId": "", "CityId": place["CityId"],
+                   "CountryName": place["CountryName"]}
+                  for place in getPlaces() if query in place["Name"].lower()]
+
+        return jsonify({"Places": places}), 200, _rateLimitHeaders()
+
+    return mockApp
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Skyscanner API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5001)
+    parser.add_argument("--latency", type=float, default=mockSettings["latency"])
+    parser.add_argument("--latency-jitter", type=float, default=mockSettings["latencyJitter"])
+    parser.add_argument("--error-rate", type=float, default=mockSettings["errorRate"])
+    parser.add_argument("--throttle-rate", type=float, default=mockSettings["throttleRate"])
+    parser.add_argument("--quotes", type=int, default=mockSettings["numQuotes"])
+    parser.add_argument("--carriers", type=int, default=mockSettings["numCarriers"])
+    parser.add_argument("--month-quotes", type=int, default=mockSettings["monthQuotes"])
+    parser.add_argument("--recorded", help="A .json file or directory of recorded responses")
+    args = parser.parse_args()
+
+    mockSettings.update({"latency": args.latency, "latencyJitter": args.latency_jitter,
+                         "errorRate": args.error_rate, "throttleRate": args.throttle_rate,
+                         "numQuotes": args.quotes, "numCarriers": args.carriers,
+                         "monthQuotes": args.month_quotes})
+    if args.recorded:
+        print("Loaded {} recorded responses".format(loadRecordedResponses(args.recorded)))
+
+    createMockApp().run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
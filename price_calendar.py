@@ -0,0 +1,195 @@
+"""
+This file builds the price calendar for a route: the minimum price for each
+outbound date and number of nights away, shown as a heatmap by /calendar in
+app.py.
+
+calendarCells reduces BrowseQuotes responses to the cheapest price for each
+route and date pair. logBQResults in db_functions.py applies it to every set
+of results it stores, and upserts the cells into the price_calendar table, so
+the calendar of a route is kept up to date by every search that covers it
+rather than rebuilt on each view.
+
+missingQueries lists the queries for the cells of a calendar with no price, or
+only an out of date one, so that filling the calendar only calls the API for
+those cells. The calls may in turn be answered from the quote cache, or
+collapsed into month-level calls if monthCollapseMinDates is set (refer to
+query_planner.py and BrowseQuotesGetData in ss_api_functions.py).
+"""
+
+from datetime import date, timedelta
+
+# Prices older than this many seconds are still shown, but are refreshed when
+# the calendar is filled
+calendarMaxAge = 86400
+
+# Default and maximum size of a calendar
+calendarDefaultDays = 31
+calendarMaxDays = 92
+calendarDefaultNights = (1, 14)
+calendarMaxNights = 30
+
+
+def calendarCells(queryList, browseQuotesList):
+    """
+    Returns the cheapest price for each route and date pair quoted in a list
+    of BrowseQuotes responses. A route is the origin and destination places,
+    and currency, of the query answered by the response.
+
+    Args:
+        queryList(list(of dictionaries)): The queries, as logged by logBQQuery.
+
+        browseQuotesList(list(of dictionaries)): The response to each query,
+        in the same order. Error responses are ignored.
+
+    Returns:
+        cells(dictionary): (originplace, destinationplace, currency,
+        outboundDate, inboundDate): minPrice, where the dates are in the format
+        yyyy-mm-dd, and inboundDate is "" for one way trips.
+    """
+    cells = {}
+    for query, response in zip(queryList, browseQuotesList):
+        if not isinstance(response, dict) or "Quotes" not in response:
+            continue
+
+        route = (query.get("originplace"), query.get("destinationplace"), query.get("currency"))
+        for quote in response["Quotes"]:
+            try:
+                price = quote["MinPrice"]
+                outboundDate = quote["OutboundLeg"]["DepartureDate"][:10]
+                inboundDate = quote["InboundLeg"]["DepartureDate"][:10] if quote.get("InboundLeg") else ""
+            except (KeyError, TypeError):
+                continue
+
+            key = route + (outboundDate, inboundDate)
+            if key not in cells or price < cells[key]:
+                cells[key] = price
+
+    return cells
+
+
+def parseCalendarRequest(args):
+    """
+    Reads the route and size of a calendar from the query string (or form) of
+    a request.
+
+    Args:
+        args(MultiDict): request.args or request.form
+
+    Returns:
+        calendar(dictionary): With the keys origin, destination (string),
+        start (date), days, minNights and maxNights (integer). origin and
+        destination are "" if not given.
+
+    Exceptions:
+        ValueError: If a parameter is not valid.
+    """
+    start = args.get("start", "")
+    start = date.fromisoformat(start) if start else date.today() + timedelta(days=1)
+
+    days = args.get("days", calendarDefaultDays, type=int)
+    minNights = args.get("minNights", calendarDefaultNights[0], type=int)
+    maxNights = args.get("maxNights", calendarDefaultNights[1], type=int)
+
+    if not 1 <= days <= calendarMaxDays:
+        raise ValueError("Days must be between 1 and {}".format(calendarMaxDays))
+    if not 0 <= minNights <= maxNights <= calendarMaxNights:
+        raise ValueError("Nights must be between 0 and {}".format(calendarMaxNights))
+
+    return {"origin": args.get("origin", "").strip(),
+            "destination": args.get("destination", "").strip(),
+            "start": start,
+            "days": days,
+            "minNights": minNights,
+            "maxNights": maxNights}
+
+
+def calendarGrid(calendarRows, start, days, minNights, maxNights, now):
+    """
+    Arranges the stored cells of a route into a calendar of outbound dates
+    against nights away.
+
+    Args:
+        calendarRows(list(of dictionaries)): Rows of the price_calendar table
+        for the route, refer to getPriceCalendar in db_functions.py.
+
+        start(date): The first outbound date.
+
+        days(integer): The number of outbound dates.
+
+        minNights, maxNights(integer): The range of nights away.
+
+        now(float): The current time in seconds since epoch, to find out of
+        date prices.
+
+    Returns:
+        grid(list(of dictionaries)): One per outbound date, with the keys
+        outboundDate (string) and cells, a list with one dictionary per number
+        of nights, with the keys:
+            inboundDate (string): The date of the inbound trip
+            price (number): The cheapest price, or None if missing
+            stale (boolean): True if the price is older than calendarMaxAge
+            shade (number): From 0 for the cheapest price in the calendar, to
+                1 for the most expensive. None if missing.
+    """
+    stored = {(row["outboundDate"], row["inboundDate"]): row for row in calendarRows}
+
+    grid = []
+    prices = []
+    for day in range(days):
+        outboundDate = start + timedelta(days=day)
+        cells = []
+        for nights in range(minNights, maxNights + 1):
+            inboundDate = (outboundDate + timedelta(days=nights)).isoformat()
+            row = stored.get((outboundDate.isoformat(), inboundDate))
+            cell = {"inboundDate": inboundDate, "price": None, "stale": False, "shade": None}
+            if row is not None:
+                cell["price"] = row["minPrice"]
+                cell["stale"] = row["updated"] < now - calendarMaxAge
+                prices.append(row["minPrice"])
+            cells.append(cell)
+        grid.append({"outboundDate": outboundDate.isoformat(), "cells": cells})
+
+    # Shade each price between the cheapest and most expensive in the calendar
+    if prices:
+        lowest, priceRange = min(prices), (max(prices) - min(prices)) or 1
+        for row in grid:
+            for cell in row["cells"]:
+                if cell["price"] is not None:
+                    cell["shade"] = (cell["price"] - lowest) / priceRange
+
+    return grid
+
+
+def missingQueries(grid, origin, destination, country, currency, locale, adults, today):
+    """
+    Returns the BrowseQuotes queries for the cells of a calendar with no
+    price, or an out of date price. Cells with an outbound date before today
+    are left out.
+
+    Args:
+        grid(list(of dictionaries)): From calendarGrid.
+
+        origin, destination(string): The Skyscanner PlaceIds of the route.
+
+        country, currency, locale, adults(string): Values applied to every
+        query, as for expandSearchForm in query_planner.py.
+
+        today(date): The current date.
+
+    Returns:
+        queryList(list(of dictionaries)): The queries, in the format of
+        expandSearchForm.
+    """
+    queryList = []
+    for row in grid:
+        if row["outboundDate"] < today.isoformat():
+            continue
+        for cell in row["cells"]:
+            if cell["price"] is None or cell["stale"]:
+                queryList.append({'country': country, 'currency': currency, 'locale': locale, 'adults': adults,
+                                  'originplace': origin,
+                                  'destinationplace': destination,
+                                  'outboundpartialdate': row["outboundDate"],
+                                  'inboundpartialdate': cell["inboundDate"]})
+
+    return queryList
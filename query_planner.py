@@ -0,0 +1,479 @@
+"""
+This file contains the query planner, which sits between the parsing of a
+user's search form and the calls to the BrowseQuotes API endpoint in
+ss_api_functions. It rewrites a list of BrowseQuotes queries into fewer API
+calls, and maps the responses back onto the original queries.
+
+The BrowseQuotes endpoint accepts partial dates (yyyy-mm) as well as exact
+dates (yyyy-mm-dd). Where a search asks for many dates on the same route in the
+same month, a single month-level call returns the quotes for all of them, and
+the quotes for each requested date are then split out locally. Only the dates
+that vary are widened to the month, e.g. many outbound dates with one fixed
+inbound date keep the exact inbound date.
+
+This relies on the endpoint serving quotes from its cache by date: a
+month-level response holds, for each date it quotes, the same quotes as a
+call for that exact date. It need not quote every date in the month, so any
+requested date pair it has no quote for is sent as its own exact follow-up
+call. Set monthCollapseMinDates to 0 if the responses are found to differ.
+
+It also expands search forms into query lists, and estimates and limits the
+cost of a search before it is run.
+"""
+
+import copy
+import math
+import ss_api_functions
+from ss_api_functions import BrowseQuotes, iterBrowseQuotes
+
+# The minimum number of distinct date pairs on one route in one month (or one
+# outbound and inbound month combination) before they are collapsed into a
+# single month-level call. 0 disables collapsing.
+monthCollapseMinDates = 3
+
+# Limits on the size of a single search, for anonymous and logged in users.
+# Individual users may be given different limits in userSearchLimits, keyed by
+# user_id. maxQueries bounds the queries expanded from the form, and maxApiCalls
+# the calls remaining after deduplication, month collapsing and caching.
+searchLimits = {
+    "anonymous": {"maxQueries": 100, "maxApiCalls": 30},
+    "user": {"maxQueries": 1000, "maxApiCalls": 200},
+    }
+userSearchLimits = {}
+
+# Searches predicted to take longer than this many seconds are shown to the
+# user for confirmation before being run
+confirmSearchSeconds = 10
+
+
+def countSearchForm(form, inboundKey):
+    """
+    Counts the queries that expandSearchForm would produce for a search form,
+    without building them, so that oversized searches can be rejected cheaply.
+
+    Args:
+        form(MultiDict): The submitted search form (refer to expandSearchForm).
+
+        inboundKey(string): The name prefix of the inbound date inputs.
+
+    Returns:
+        queryCount(integer): The number of queries in the expanded search.
+    """
+    rows = int(form.get("rowNum"))
+    queryCount = 0
+    for i in range(rows+1):
+        queryCount += (len(form.getlist("originplaces_" + str(i))) *
+                       len(form.getlist("destinationplaces_" + str(i))) *
+                       len(form.get("outboundpartialdate_" + str(i), "").split(",")) *
+                       len(form.get(inboundKey + "_" + str(i), "").split(",")))
+
+    return queryCount
+
+
+def expandSearchForm(form, inboundKey, country, currency, locale, adults):
+    """
+    Builds the list of individual queries for a search form. Each form row
+    may list several origins, destinations, and comma separated outbound and
+    inbound dates, and a query is produced for every combination.
+
+    Args:
+        form(MultiDict): The submitted search form, with the inputs (where N is
+        the number of query rows, given by rowNum):
+            originplaces_[0-N] (string): In the format Skyscanner PlaceId
+            destinationplaces_[0-N] (string): In the format Skyscanner PlaceId
+            outboundpartialdate_[0-N] (string): Dates in the format yyyy-mm-dd
+            [inboundKey]_[0-N] (string): Dates in the format yyyy-mm-dd
+
+        inboundKey(string): The name prefix of the inbound date inputs, which
+        is also used as the inbound date key in each query.
+
+        country, currency, locale, adults(string): Values applied to every
+        query.
+
+    Returns:
+        queryList(list(of dictionaries)): The expanded queries.
+    """
+    rows = int(form.get("rowNum"))
+    queryList = []
+
+    # For each combination of destination and dates
+    for i in range(rows+1):
+        # Populate list of Origin places and Destination places
+        originplacesList = form.getlist("originplaces_" + str(i))
+        destinationplacesList = form.getlist("destinationplaces_" + str(i))
+
+        # Populate list of outbound and inbound dates
+        outboundpartialdateList = form.get("outboundpartialdate_" + str(i), "").split(",")
+        inboundDateList = form.get(inboundKey + "_" + str(i), "").split(",")
+
+        # Format multi-data lists into individual date and place itineraries and append to list
+        for originplace in originplacesList:
+            for destinationplace in destinationplacesList:
+                for outboundDate in outboundpartialdateList:
+                    for inboundDate in inboundDateList:
+                        queryList.append({'country' : country, 'currency': currency, 'locale' : locale, 'adults' : adults,
+                        'originplace': originplace,
+                        'destinationplace': destinationplace,
+                        'outboundpartialdate': outboundDate,
+                        inboundKey: inboundDate})
+
+    return queryList
+
+
+def parseQueryList(queries, country, currency, locale, adults):
+    """
+    Checks the list of queries posted to the json search API, and fills in
+    any optional keys, so that it matches the output of expandSearchForm.
+
+    Args:
+        queries(list(of dictionaries)): The posted queries, each with the keys
+        "originplace", "destinationplace" and "outboundpartialdate", and
+        optionally "inboundpartialdate", "country", "currency", "locale" and
+        "adults" (refer to formatBqUrl in ss_api_functions).
+
+        country, currency, locale, adults(string): Defaults for the optional
+        keys.
+
+    Returns:
+        queryList(list(of dictionaries)): The queries.
+
+    Exceptions:
+        ValueError: If queries is not a non-empty list of dictionaries with
+        string values for the required keys.
+    """
+    if not isinstance(queries, list) or not queries:
+        raise ValueError("queries must be a non-empty list")
+
+    queryList = []
+    for queryIndex, query in enumerate(queries):
+        if not isinstance(query, dict):
+            raise ValueError("Query {} is not an object".format(queryIndex))
+
+        # Other keys are ignored, so only the keys of expandSearchForm are logged
+        defaults = {'country': country, 'currency': currency, 'locale': locale, 'adults': adults,
+                    'originplace': None, 'destinationplace': None, 'outboundpartialdate': None,
+                    'inboundpartialdate': ""}
+        fullQuery = {key: query.get(key, default) for key, default in defaults.items()}
+
+        for key, value in fullQuery.items():
+            if not isinstance(value, str):
+                raise ValueError("Query {} has no {}".format(queryIndex, key))
+            if "/" in value:
+                raise ValueError("Query {} has an invalid {}".format(queryIndex, key))
+
+        queryList.append(fullQuery)
+
+    return queryList
+
+
+def getSearchLimits(user_id):
+    """
+    Returns the search size limits that apply to a user.
+
+    Args:
+        user_id(integer): The user's id, or "" for an anonymous search.
+
+    Returns:
+        limits(dictionary): With the keys maxQueries and maxApiCalls.
+    """
+    if user_id in userSearchLimits:
+        return userSearchLimits[user_id]
+    if user_id == "" or user_id is None:
+        return searchLimits["anonymous"]
+    return searchLimits["user"]
+
+
+def estimateSearchCost(queryList):
+    """
+    Estimates the cost of running a BrowseQuotes search, after deduplication,
+    month collapsing (refer to planBrowseQuotes) and the quote cache.
+
+    Args:
+        queryList(list(of dictionaries)): The queries to be searched.
+
+    Returns:
+        estimate(dictionary): With the keys:
+            expandedQueries(integer): The number of queries in queryList.
+            uniqueQueries(integer): The number of distinct queries.
+            plannedCalls(integer): The distinct calls after month collapsing,
+            not counting any follow-up calls for dates missing from
+            month-level responses.
+            cachedCalls(integer): Planned calls that will be answered by the
+            quote cache.
+            apiCalls(integer): Planned calls that will be sent to the API.
+            estimatedSeconds(float): The predicted time to run the search.
+    """
+    uniqueQueries = set(ss_api_functions.bqCacheKey(query) for query in queryList)
+
+    plan = planBrowseQuotes(queryList)
+    plannedCalls = set(ss_api_functions.bqCacheKey(call) for call in plan["calls"])
+    cachedCalls = sum(1 for cacheKey in plannedCalls if ss_api_functions.isQuoteCached(cacheKey))
+    apiCalls = len(plannedCalls) - cachedCalls
+
+    # Calls run in rounds of bqMaxWorkers, but no faster than the rate limit
+    rounds = math.ceil(apiCalls / max(1, ss_api_functions.bqMaxWorkers))
+    estimatedSeconds = max(rounds * ss_api_functions.getAverageLatency(),
+                           apiCalls / ss_api_functions.rateLimitPerSecond)
+
+    return {"expandedQueries": len(queryList),
+            "uniqueQueries": len(uniqueQueries),
+            "plannedCalls": len(plannedCalls),
+            "cachedCalls": cachedCalls,
+            "apiCalls": apiCalls,
+            "estimatedSeconds": round(estimatedSeconds, 1)}
+
+
+def checkSearchLimits(estimate, limits):
+    """
+    Checks a search cost estimate against a user's limits.
+
+    Args:
+        estimate(dictionary): From estimateSearchCost.
+
+        limits(dictionary): From getSearchLimits.
+
+    Returns:
+        message(string): A description of the limit exceeded, or None if the
+        search is within the limits.
+    """
+    if estimate["expandedQueries"] > limits["maxQueries"]:
+        return "Search has {} queries, the limit is {}".format(estimate["expandedQueries"], limits["maxQueries"])
+    if estimate["apiCalls"] > limits["maxApiCalls"]:
+        return "Search requires {} API calls, the limit is {}".format(estimate["apiCalls"], limits["maxApiCalls"])
+    return None
+
+
+def isExactDate(dateString):
+    """
+    Returns True if dateString is an exact date in the format yyyy-mm-dd.
+    """
+    return (isinstance(dateString, str) and len(dateString) == 10 and
+            dateString[4] == "-" and dateString[7] == "-")
+
+
+def planBrowseQuotes(queryList, minDates=None):
+    """
+    Produces a plan of the API calls required to answer a list of BrowseQuotes
+    queries, collapsing queries for many dates on the same route and month into
+    single month-level calls.
+
+    Args:
+        queryList(list(of dictionaries)): A list of dictionaries, each of which
+        contains the keys required to query the BrowseQuotes API endpoint
+        (refer to formatBqUrl in ss_api_functions).
+
+        minDates(integer): Optional, overrides monthCollapseMinDates.
+
+    Returns:
+        plan(dictionary): With the keys:
+            calls(list(of dictionaries)): The queries to send to BrowseQuotes.
+            members(list(of lists)): For each call, a list of tuples
+            (queryIndex, outboundDate, inboundDate) identifying the original
+            queries the call answers. The dates are None where the call is
+            the original query and its response needs no splitting.
+            numQueries(integer): The length of queryList.
+    """
+    if minDates is None:
+        minDates = monthCollapseMinDates
+
+    # Group the queries with exact dates by route and month(s)
+    groups = {}
+    for queryIndex, query in enumerate(queryList):
+        outboundDate = query.get("outboundpartialdate")
+        inboundDate = query.get("inboundpartialdate", "")
+        if not isExactDate(outboundDate) or not (inboundDate == "" or isExactDate(inboundDate)):
+            continue
+
+        groupKey = (query.get("country"), query.get("currency"), query.get("locale"),
+                    query.get("adults"), query.get("originplace"), query.get("destinationplace"),
+                    outboundDate[:7], inboundDate[:7])
+        groups.setdefault(groupKey, []).append(queryIndex)
+
+    # Decide which groups are worth collapsing, and the dates of their call:
+    # the month for a date that varies within the group, otherwise the date
+    collapsed = {}
+    callDates = {}
+    for groupKey, queryIndexes in groups.items():
+        datePairs = set((queryList[i]["outboundpartialdate"], queryList[i].get("inboundpartialdate", ""))
+                        for i in queryIndexes)
+        if minDates and len(datePairs) >= max(minDates, 2):
+            outboundDates = set(outboundDate for outboundDate, inboundDate in datePairs)
+            inboundDates = set(inboundDate for outboundDate, inboundDate in datePairs)
+            callDates[groupKey] = (groupKey[6] if len(outboundDates) > 1 else outboundDates.pop(),
+                                   groupKey[7] if len(inboundDates) > 1 else inboundDates.pop())
+            for queryIndex in queryIndexes:
+                collapsed[queryIndex] = groupKey
+
+    # Build the list of calls, in the order the queries were first seen
+    calls = []
+    members = []
+    groupCall = {}
+    for queryIndex, query in enumerate(queryList):
+        groupKey = collapsed.get(queryIndex)
+
+        if groupKey is None:
+            calls.append(query)
+            members.append([(queryIndex, None, None)])
+            continue
+
+        if groupKey not in groupCall:
+            monthQuery = dict(query)
+            monthQuery["outboundpartialdate"], monthQuery["inboundpartialdate"] = callDates[groupKey]
+            groupCall[groupKey] = len(calls)
+            calls.append(monthQuery)
+            members.append([])
+
+        members[groupCall[groupKey]].append((queryIndex, query["outboundpartialdate"],
+                                             query.get("inboundpartialdate", "")))
+
+    return {"calls": calls, "members": members, "numQueries": len(queryList)}
+
+
+def splitMonthResponse(response, outboundDate, inboundDate):
+    """
+    Produces the response for a single date pair from the response to a
+    month-level BrowseQuotes call, by keeping only the quotes departing on the
+    requested dates. The Places, Carriers and Currencies lists are shared with
+    the month-level response, not copied.
+
+    Args:
+        response(dictionary): The month-level response, as received from
+        BrowseQuotesGetData.
+
+        outboundDate(string): The requested outbound date, yyyy-mm-dd.
+
+        inboundDate(string): The requested inbound date, yyyy-mm-dd, or "" for
+        a one way query.
+
+    Returns:
+        dateResponse(dictionary): A response in the same format with only the
+        matching quotes. Error responses are returned unchanged.
+    """
+    if not isinstance(response, dict) or "Quotes" not in response:
+        return response
+
+    dateQuotes = []
+    for quote in response["Quotes"]:
+        try:
+            if quote["OutboundLeg"]["DepartureDate"][:10] != outboundDate:
+                continue
+            if inboundDate and quote["InboundLeg"]["DepartureDate"][:10] != inboundDate:
+                continue
+        except (KeyError, TypeError):
+            continue
+        dateQuotes.append(quote)
+
+    dateResponse = copy.copy(response)
+    dateResponse["Quotes"] = dateQuotes
+
+    return dateResponse
+
+
+def splitPlannedResult(plan, callIndex, response):
+    """
+    Maps the response for one call in a plan back onto the original queries
+    it answers.
+
+    Args:
+        plan(dictionary): A plan from planBrowseQuotes.
+
+        callIndex(integer): The position of the call in plan["calls"].
+
+        response(dictionary): The response received for the call.
+
+    Returns:
+        queryResults(list(of tuples)): A list of (queryIndex, response) for
+        each original query answered by the call. response is None where the
+        call was month-level and has no quote for the query's dates, so the
+        query must be sent as a follow-up call of its own.
+    """
+    queryResults = []
+    for queryIndex, outboundDate, inboundDate in plan["members"][callIndex]:
+        if outboundDate is None:
+            queryResults.append((queryIndex, response))
+            continue
+
+        dateResponse = splitMonthResponse(response, outboundDate, inboundDate)
+        if isinstance(dateResponse, dict) and dateResponse.get("Quotes") == []:
+            dateResponse = None
+        queryResults.append((queryIndex, dateResponse))
+
+    return queryResults
+
+
+def BrowseQuotesPlanned(queryList, maxWorkers=None, progressCallback=None):
+    """
+    Equivalent to BrowseQuotes in ss_api_functions, but makes the calls in the
+    plan from planBrowseQuotes rather than one call per query.
+
+    Args:
+        queryList(list(of dictionaries)): A list of dictionaries, each of which
+        contains the keys required to query the BrowseQuotes API endpoint.
+
+        maxWorkers(integer): Optional, passed to BrowseQuotes.
+
+        progressCallback(function): Optional, passed to BrowseQuotes. Progress
+        is reported in planned calls, not queries. Follow-up calls (refer to
+        splitPlannedResult) are added to the total once the planned calls
+        are done.
+
+    Returns:
+        results(list(of dictionaries)): One response per query, in the same
+        order as queryList, in the format received from BrowseQuotesGetData.
+    """
+    plan = planBrowseQuotes(queryList)
+    callResults = BrowseQuotes(plan["calls"], maxWorkers, progressCallback)
+
+    results = [None] * len(queryList)
+    followUps = []
+    for callIndex, response in enumerate(callResults):
+        for queryIndex, queryResponse in splitPlannedResult(plan, callIndex, response):
+            if queryResponse is None:
+                followUps.append(queryIndex)
+            else:
+                results[queryIndex] = queryResponse
+
+    # Query the date pairs missing from the month-level responses exactly
+    if followUps:
+        followUpProgress = None
+        if progressCallback:
+            plannedCalls = len(plan["calls"])
+            followUpProgress = lambda completed, total: progressCallback(plannedCalls + completed,
+                                                                         plannedCalls + total)
+        followUpResults = BrowseQuotes([queryList[queryIndex] for queryIndex in followUps], maxWorkers,
+                                       followUpProgress)
+        for queryIndex, response in zip(followUps, followUpResults):
+            results[queryIndex] = response
+
+    return results
+
+
+def iterBrowseQuotesPlanned(queryList, maxWorkers=None):
+    """
+    Generator version of BrowseQuotesPlanned, which yields the response for
+    each query as soon as the call answering it completes.
+
+    Args:
+        queryList(list(of dictionaries)): A list of dictionaries, each of which
+        contains the keys required to query the BrowseQuotes API endpoint.
+
+        maxWorkers(integer): Optional, passed to iterBrowseQuotes.
+
+    Yields:
+        (tuple): (queryIndex, response) in completion order, where queryIndex
+        is the position of the query in queryList.
+    """
+    plan = planBrowseQuotes(queryList)
+
+    followUps = []
+    for callIndex, response in iterBrowseQuotes(plan["calls"], maxWorkers):
+        for queryIndex, queryResponse in splitPlannedResult(plan, callIndex, response):
+            if queryResponse is None:
+                followUps.append(queryIndex)
+            else:
+                yield (queryIndex, queryResponse)
+
+    # Query the date pairs missing from the month-level responses exactly
+    followUpQueries = [queryList[queryIndex] for queryIndex in followUps]
+    for followUpIndex, response in iterBrowseQuotes(followUpQueries, maxWorkers):
+        yield (followUps[followUpIndex], response)
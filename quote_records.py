@@ -0,0 +1,168 @@
+"""
+This file contains the compact record types produced by BrowseQuotesFormatResults
+(refer to ss_api_functions.py) for each quote: a Quote with an outbound and an
+optional inbound Leg.
+
+The records use __slots__, so hold no per-instance dictionary, and carrier
+lists are tuples of interned strings shared between quotes. A Quote is also a
+read-only Mapping with the keys of the earlier formatted result dictionaries
+(e.g. quote['Outbound_OriginPlace']), so it can be used unchanged by the
+Jinja templates, DicttoCSV and QuoteTable. Use asDict to convert to json.
+
+packQuotes and unpackQuotes convert a list of Quotes to and from a compact
+list of lists, used to store formatted results in the database.
+"""
+
+import sys
+from collections.abc import Mapping
+
+# Version of the formatted results. Increment whenever the records, the packed
+# layout, or the output of BrowseQuotesFormatResults change, so that formatted
+# results stored by earlier versions are rebuilt from the raw results.
+formatVersion = 1
+
+
+class Leg:
+    """
+    One leg (outbound or inbound) of a quoted trip.
+
+    Args:
+        originId, destinationId(integer): Numeric Skyscanner place identifiers.
+
+        date(string): Departure date, in the format yyyy-mm-ddThh:mm:ss.
+
+        carrierIds(tuple(of integers)): Numeric identifiers of the carrier(s).
+
+        originPlace, destinationPlace(string): Place names. May be None if not
+        provided in the response.
+
+        carrierNames(tuple(of strings)): Names of the carrier(s).
+    """
+    __slots__ = ("originId", "destinationId", "date", "carrierIds",
+                 "originPlace", "destinationPlace", "carrierNames")
+
+    def __init__(self, originId, destinationId, date, carrierIds,
+                 originPlace=None, destinationPlace=None, carrierNames=()):
+        self.originId = originId
+        self.destinationId = destinationId
+        self.date = date
+        self.carrierIds = carrierIds
+        self.originPlace = originPlace
+        self.destinationPlace = destinationPlace
+        self.carrierNames = carrierNames
+
+    def __repr__(self):
+        return "Leg({!r} -> {!r}, {!r}, {!r})".format(self.originPlace, self.destinationPlace,
+                                                     self.date, self.carrierNames)
+
+
+# Mapping keys of a Quote, in order, as (attribute, leg attribute)
+_itemAttributes = {
+    'MinPrice': ("price", None),
+    'Outbound_OriginID': ("outbound", "originId"),
+    'Outbound_DestinationID': ("outbound", "destinationId"),
+    'Direct': ("direct", None),
+    'Outbound_CarrierID': ("outbound", "carrierIds"),
+    'Outbound_Date': ("outbound", "date"),
+    'Outbound_OriginPlace': ("outbound", "originPlace"),
+    'Outbound_DestinationPlace': ("outbound", "destinationPlace"),
+    'Outbound_CarrierNames': ("outbound", "carrierNames"),
+    'Inbound_CarrierID': ("inbound", "carrierIds"),
+    'Inbound_Date': ("inbound", "date"),
+    'Inbound_CarrierNames': ("inbound", "carrierNames"),
+    }
+
+# Values of the inbound keys for a one way trip
+_missingLeg = {"carrierIds": None, "date": None, "carrierNames": ()}
+
+
+class Quote(Mapping):
+    """
+    A single formatted BrowseQuotes quote.
+
+    Args:
+        price(number): The MinPrice of the quote.
+
+        direct(boolean): True if the trip has no stops.
+
+        outbound(Leg): The outbound leg.
+
+        inbound(Leg): The inbound leg, or None for a one way trip.
+    """
+    __slots__ = ("price", "direct", "outbound", "inbound")
+
+    def __init__(self, price, direct, outbound, inbound=None):
+        self.price = price
+        self.direct = direct
+        self.outbound = outbound
+        self.inbound = inbound
+
+    def __getitem__(self, key):
+        try:
+            attribute, legAttribute = _itemAttributes[key]
+        except KeyError:
+            raise KeyError(key) from None
+        value = getattr(self, attribute)
+        if legAttribute is None:
+            return value
+        if value is None:
+            return _missingLeg[legAttribute]
+        return getattr(value, legAttribute)
+
+    def __iter__(self):
+        return iter(_itemAttributes)
+
+    def __len__(self):
+        return len(_itemAttributes)
+
+    def __repr__(self):
+        return "Quote({!r}, {!r}, {!r}, {!r})".format(self.price, self.direct, self.outbound, self.inbound)
+
+    def asDict(self):
+        """
+        Returns the quote as a formatted result dictionary, with lists in place
+        of tuples, e.g. for json.dumps.
+        """
+        return {key: list(value) if isinstance(value, tuple) else value
+                for key, value in self.items()}
+
+
+def _packLeg(leg):
+    return [leg.originId, leg.destinationId, leg.date, list(leg.carrierIds),
+            leg.originPlace, leg.destinationPlace, list(leg.carrierNames)]
+
+
+def packQuotes(quotes):
+    """
+    Converts a list of Quotes into a list of lists holding only values, i.e.
+    [price, direct, outbound, inbound] where each leg is [originId,
+    destinationId, date, carrierIds, originPlace, destinationPlace,
+    carrierNames] or None. The result may be stored using json.dumps.
+    """
+    return [[quote.price, quote.direct, _packLeg(quote.outbound),
+             _packLeg(quote.inbound) if quote.inbound else None]
+            for quote in quotes]
+
+
+def unpackQuotes(packedQuotes):
+    """
+    Converts the output of packQuotes back into a list of Quotes. Strings are
+    interned, and identical carrier lists share a tuple, as in
+    BrowseQuotesFormatResults.
+    """
+    tuples = {}
+
+    def intern(value):
+        return sys.intern(value) if value is not None else None
+
+    def share(values):
+        values = tuple(intern(value) if isinstance(value, str) else value for value in values)
+        return tuples.setdefault(values, values)
+
+    def unpackLeg(packedLeg):
+        originId, destinationId, date, carrierIds, originPlace, destinationPlace, carrierNames = packedLeg
+        return Leg(originId, destinationId, date, share(carrierIds),
+                   intern(originPlace), intern(destinationPlace), share(carrierNames))
+
+    return [Quote(price, direct, unpackLeg(outbound), unpackLeg(inbound) if inbound else None)
+            for price, direct, outbound, inbound in packedQuotes]
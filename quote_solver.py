@@ -0,0 +1,227 @@
+"""
+This file answers questions across the formatted quotes of a multi-origin,
+multi-destination search (refer to BrowseQuotesFormatResults in
+ss_api_functions.py), such as:
+    - the cheapest destinations from each origin (cheapestPerOrigin)
+    - the cheapest destination common to a group flying from several origins
+      (cheapestCommonDestination)
+    - the cheapest outbound and inbound date pair within a window
+      (cheapestDatePairs)
+
+Each makes a single pass over the quotes, keeping the cheapest quote per key
+in a dictionary, then ranks the keys with heapq, so runs in O(n log k) for n
+quotes and the k answers requested.
+
+gatherQuotes collects the quotes for a stored search without calling the
+API: the stored results, with the responses for any of its queries still in
+the quote cache used in their place, as they are more recent.
+"""
+
+import heapq
+from datetime import date
+import db_functions
+import results_query
+from query_planner import planBrowseQuotes, splitPlannedResult
+from ss_api_functions import BrowseQuotesFormatResults, bqCacheKey, getCachedQuote
+
+# Default number of answers returned by each solver
+defaultAnswers = 5
+
+
+def gatherQuotes(db, search_id, includeCached=True):
+    """
+    Returns the formatted quotes for a stored search, making no API calls.
+
+    Args:
+        db(string): The address of the database file.
+
+        search_id(integer): The unique identifier for the search.
+
+        includeCached(boolean): Optional, if True the response for each query
+        of the search still in the quote cache replaces its stored response.
+
+    Returns:
+        (tuple): (quotes, cachedQueries) where quotes is a list of Quotes, and
+        cachedQueries the number of queries answered from the quote cache.
+    """
+    cachedResponses = {}
+    if includeCached:
+        # The search made the calls in its plan, so the cache holds responses
+        # under the keys of the planned calls
+        plan = planBrowseQuotes(db_functions.getSearchQuery(db, search_id))
+        for callIndex, call in enumerate(plan["calls"]):
+            response = getCachedQuote(bqCacheKey(call))
+            if response is not None:
+                # Dates missing from a month-level response keep their stored response
+                cachedResponses.update((queryIndex, queryResponse) for queryIndex, queryResponse
+                                       in splitPlannedResult(plan, callIndex, response)
+                                       if queryResponse is not None)
+
+    if not cachedResponses:
+        return results_query.getResults(db, search_id)[0], 0
+
+    results_json = db_functions.getSearchResult(db, search_id)
+    for queryIndex, response in cachedResponses.items():
+        if queryIndex < len(results_json):
+            results_json[queryIndex] = response
+
+    return BrowseQuotesFormatResults(results_json), len(cachedResponses)
+
+
+def _cheapestBy(quotes, keyFunction):
+    """
+    Returns a dictionary of key: the cheapest Quote with that key, for the key
+    returned by keyFunction for each quote. Quotes with a key of None are
+    left out.
+    """
+    cheapest = {}
+    for quote in quotes:
+        key = keyFunction(quote)
+        if key is None:
+            continue
+        best = cheapest.get(key)
+        if best is None or quote.price < best.price:
+            cheapest[key] = quote
+
+    return cheapest
+
+
+def cheapestPerOrigin(quotes, k=defaultAnswers):
+    """
+    Returns the cheapest destinations from each origin.
+
+    Args:
+        quotes(list(of Quotes)): Formatted quotes, e.g. from gatherQuotes.
+
+        k(integer): Optional, the number of destinations per origin.
+
+    Returns:
+        cheapest(dictionary): originId: a list of up to k Quotes, the cheapest
+        quote to each of the cheapest destinations from the origin, cheapest
+        first.
+    """
+    cheapestRoutes = _cheapestBy(quotes, lambda quote: (quote.outbound.originId, quote.outbound.destinationId))
+
+    byOrigin = {}
+    for (originId, destinationId), quote in cheapestRoutes.items():
+        byOrigin.setdefault(originId, []).append(quote)
+
+    return {originId: heapq.nsmallest(k, routeQuotes, key=lambda quote: quote.price)
+            for originId, routeQuotes in byOrigin.items()}
+
+
+def cheapestCommonDestination(quotes, origins=None, k=defaultAnswers, sameDates=False):
+    """
+    Returns the cheapest destinations that a group may reach from each of
+    several origins, ranked by the total of the cheapest price from each
+    origin.
+
+    Args:
+        quotes(list(of Quotes)): Formatted quotes, e.g. from gatherQuotes.
+
+        origins(iterable(of integers)): Optional, the originIds of the group.
+        Defaults to every origin in quotes.
+
+        k(integer): Optional, the number of destinations.
+
+        sameDates(boolean): Optional, if True the group must travel on the
+        same outbound and inbound dates, so destinations are ranked per date
+        pair.
+
+    Returns:
+        common(list(of dictionaries)): Up to k dictionaries, cheapest first,
+        with the keys:
+            destinationId (integer): Numeric location identifier
+            destinationPlace (string): Name of the destination
+            outboundDate, inboundDate (string): The dates, if sameDates,
+                otherwise None
+            totalPrice (number): The total price for the group
+            quotes (list(of Quotes)): The cheapest quote from each origin, in
+                the order of origins
+    """
+    if origins is None:
+        origins = sorted({quote.outbound.originId for quote in quotes})
+    origins = list(origins)
+    originSet = set(origins)
+
+    def key(quote):
+        outbound, inbound = quote.outbound, quote.inbound
+        if outbound.originId not in originSet:
+            return None
+        if sameDates:
+            return (outbound.destinationId, outbound.date, inbound.date if inbound else None,
+                    outbound.originId)
+        return (outbound.destinationId, None, None, outbound.originId)
+
+    # Index the cheapest quote from each origin to each destination
+    byDestination = {}
+    for (destinationId, outboundDate, inboundDate, originId), quote in _cheapestBy(quotes, key).items():
+        byDestination.setdefault((destinationId, outboundDate, inboundDate), {})[originId] = quote
+
+    # Only destinations reachable from every origin are common to the group
+    candidates = ((sum(quote.price for quote in fromOrigins.values()), destination, fromOrigins)
+                  for destination, fromOrigins in byDestination.items()
+                  if len(fromOrigins) == len(originSet))
+
+    common = []
+    for totalPrice, destination, fromOrigins in heapq.nsmallest(k, candidates, key=lambda candidate: candidate[0]):
+        destinationId, outboundDate, inboundDate = destination
+        originQuotes = [fromOrigins[originId] for originId in origins]
+        common.append({"destinationId": destinationId,
+                       "destinationPlace": originQuotes[0].outbound.destinationPlace,
+                       "outboundDate": outboundDate,
+                       "inboundDate": inboundDate,
+                       "totalPrice": totalPrice,
+                       "quotes": originQuotes})
+
+    return common
+
+
+def cheapestDatePairs(quotes, windowStart=None, windowEnd=None, minNights=None, maxNights=None,
+                      k=defaultAnswers):
+    """
+    Returns the cheapest outbound and inbound date pairs for return trips
+    within a window.
+
+    Args:
+        quotes(list(of Quotes)): Formatted quotes, e.g. from gatherQuotes. One
+        way quotes are left out.
+
+        windowStart, windowEnd(string): Optional, the earliest outbound date
+        and the latest inbound date, in the format yyyy-mm-dd.
+
+        minNights, maxNights(integer): Optional, limits on the number of nights
+        between the outbound and inbound dates.
+
+        k(integer): Optional, the number of date pairs.
+
+    Returns:
+        datePairs(list(of Quotes)): Up to k Quotes, the cheapest quote for
+        each of the cheapest date pairs, cheapest first.
+    """
+    # Many quotes share each date, so parse each date once
+    parsedDates = {}
+
+    def parseDate(dateString):
+        day = dateString[:10]
+        if day not in parsedDates:
+            parsedDates[day] = date.fromisoformat(day)
+        return parsedDates[day]
+
+    def key(quote):
+        outbound, inbound = quote.outbound, quote.inbound
+        if inbound is None or not outbound.date or not inbound.date:
+            return None
+        if windowStart and outbound.date[:10] < windowStart:
+            return None
+        if windowEnd and inbound.date[:10] > windowEnd:
+            return None
+        if minNights is not None or maxNights is not None:
+            nights = (parseDate(inbound.date) - parseDate(outbound.date)).days
+            if minNights is not None and nights < minNights:
+                return None
+            if maxNights is not None and nights > maxNights:
+                return None
+        return (outbound.date[:10], inbound.date[:10])
+
+    return heapq.nsmallest(k, _cheapestBy(quotes, key).values(), key=lambda quote: quote.price)
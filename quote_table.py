@@ -0,0 +1,291 @@
+"""
+This file contains a columnar representation of formatted BrowseQuotes results
+(refer to BrowseQuotesFormatResults in ss_api_functions.py), for sorting,
+filtering and aggregating large result sets without iterating over a Python
+object per quote.
+
+A QuoteTable holds a NumPy array per column: price, outbound and inbound
+dates, the direct flag, and integer codes for the interned origin,
+destination and carrier names. Columns are only built when an operation uses
+them. Operations return a new QuoteTable, and toRows converts back to the
+Quote records (refer to quote_records.py) used by results_bq.html.
+
+Building the columns costs about as much as one pass over the records,
+so the gain is largest when a table is built once and queried several times
+(refer to "python benchmark.py table").
+
+NumPy is optional. If it is not installed, filterResults falls back to plain
+Python and QuoteTable is unavailable.
+"""
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Result sets smaller than this are filtered in plain Python by filterResults,
+# as building the arrays costs more than it saves
+columnarMinRows = 5000
+
+# Columns that may be used to group or filter a QuoteTable by label
+groupColumns = ("origin", "destination", "carrier", "outboundDate", "inboundDate")
+
+
+def numpyAvailable():
+    """
+    Returns True if NumPy is installed, and so QuoteTable may be used.
+    """
+    return np is not None
+
+
+def _intern(values):
+    """
+    Interns a list of hashable values as integer codes.
+
+    Returns:
+        (tuple): (codes, labels) where codes is an int32 array the length of
+        values, and labels is the list of distinct values such that
+        labels[codes[i]] == values[i].
+    """
+    index = {}
+    codes = np.array([index.setdefault(value, len(index)) for value in values], dtype=np.int32)
+    return codes, list(index)
+
+
+def _toDate(departureDate):
+    # Dates are formatted as yyyy-mm-ddThh:mm:ss, or None for one way trips
+    return departureDate[:10] if departureDate else "NaT"
+
+
+# How to build each column from the Quote records
+_columnSources = {
+    "price": lambda rows: np.array([row.price for row in rows], dtype=np.float64),
+    "direct": lambda rows: np.array([bool(row.direct) for row in rows], dtype=bool),
+    "outboundDate": lambda rows: np.array([_toDate(row.outbound.date) for row in rows],
+                                          dtype="datetime64[D]"),
+    "inboundDate": lambda rows: np.array([_toDate(row.inbound.date if row.inbound else None) for row in rows],
+                                         dtype="datetime64[D]"),
+    "origin": lambda rows: _intern([row.outbound.originPlace for row in rows]),
+    "destination": lambda rows: _intern([row.outbound.destinationPlace for row in rows]),
+    "carrier": lambda rows: _intern([row.outbound.carrierNames for row in rows]),
+    }
+
+
+class QuoteTable:
+    """
+    A columnar table of formatted BrowseQuotes results. Columns are built from
+    the rows when first used, and are shared by the tables derived from this
+    one by filter, sortByPrice and cheapestBy.
+
+    Args:
+        rows(list(of Quotes)): Formatted results, as returned by
+        BrowseQuotesFormatResults.
+
+    Exceptions:
+        ImportError: If NumPy is not installed.
+    """
+
+    def __init__(self, rows):
+        if np is None:
+            raise ImportError("QuoteTable requires numpy")
+
+        self._rows = rows
+        self.rowIndex = np.arange(len(rows))
+        # Full length columns of the original rows, and the interned labels,
+        # shared with derived tables
+        self._base = {}
+        self.labels = {}
+        # This table's rows of each column used so far
+        self._columns = {}
+
+    def __len__(self):
+        return len(self.rowIndex)
+
+    def column(self, name):
+        """
+        Returns the array for a column of the table: "price", "direct",
+        "outboundDate", "inboundDate", or the integer codes of "origin",
+        "destination" or "carrier" (refer to labels).
+        """
+        if name not in self._columns:
+            if name not in self._base:
+                built = _columnSources[name](self._rows)
+                if isinstance(built, tuple):
+                    built, self.labels[name] = built
+                self._base[name] = built
+            self._columns[name] = self._base[name][self.rowIndex]
+        return self._columns[name]
+
+    price = property(lambda self: self.column("price"))
+    direct = property(lambda self: self.column("direct"))
+    outboundDate = property(lambda self: self.column("outboundDate"))
+    inboundDate = property(lambda self: self.column("inboundDate"))
+
+    def _take(self, positions):
+        """
+        Returns a new QuoteTable of the rows at the given positions (an index
+        or boolean array).
+        """
+        table = QuoteTable.__new__(QuoteTable)
+        table._rows = self._rows
+        table.rowIndex = self.rowIndex[positions]
+        table._base = self._base
+        table.labels = self.labels
+        table._columns = {name: values[positions] for name, values in self._columns.items()}
+        return table
+
+    def _groupCodes(self, column):
+        """
+        Returns an integer array identifying the group of each row for column,
+        one of groupColumns.
+        """
+        if column not in groupColumns:
+            raise ValueError("Unknown column: {}".format(column))
+        codes = self.column(column)
+        if column in ("outboundDate", "inboundDate"):
+            return codes.astype(np.int64)
+        return codes
+
+    def filter(self, maxPrice=None, minPrice=None, directOnly=False, origins=None, destinations=None,
+               outboundFrom=None, outboundTo=None):
+        """
+        Returns the rows matching all of the given conditions.
+
+        Args:
+            maxPrice, minPrice(number): Optional, inclusive price limits.
+
+            directOnly(boolean): Optional, if True only direct trips.
+
+            origins, destinations(list(of strings)): Optional, place names.
+
+            outboundFrom, outboundTo(string): Optional, inclusive outbound date
+            limits in the format yyyy-mm-dd.
+
+        Returns:
+            table(QuoteTable): The matching rows.
+        """
+        mask = np.ones(len(self), dtype=bool)
+        if maxPrice is not None:
+            mask &= self.price <= maxPrice
+        if minPrice is not None:
+            mask &= self.price >= minPrice
+        if directOnly:
+            mask &= self.direct
+        for column, names in (("origin", origins), ("destination", destinations)):
+            if names is not None:
+                codes = self.column(column)
+                names = set(names)
+                wanted = [code for code, label in enumerate(self.labels[column]) if label in names]
+                mask &= np.isin(codes, wanted)
+        if outboundFrom is not None:
+            mask &= self.outboundDate >= np.datetime64(outboundFrom, "D")
+        if outboundTo is not None:
+            mask &= self.outboundDate <= np.datetime64(outboundTo, "D")
+
+        return self._take(mask)
+
+    def sortByPrice(self, descending=False):
+        """
+        Returns the rows in order of price. Rows of equal price keep their order.
+        """
+        order = np.argsort(-self.price if descending else self.price, kind="stable")
+        return self._take(order)
+
+    def _groupOrder(self, column):
+        """
+        Returns the row order sorted by group then price, and the group code of
+        each row in that order.
+        """
+        groups = self._groupCodes(column)
+        order = np.lexsort((self.price, groups))
+        return order, groups[order]
+
+    def cheapestBy(self, column="destination"):
+        """
+        Returns the cheapest row in each group of column (one of groupColumns),
+        in order of price.
+        """
+        if not len(self):
+            return self
+        order, sortedGroups = self._groupOrder(column)
+        first = np.flatnonzero(np.r_[True, sortedGroups[1:] != sortedGroups[:-1]])
+        return self._take(order[first]).sortByPrice()
+
+    def minPriceBy(self, column="destination"):
+        """
+        Returns the minimum price in each group of column, as a dictionary of
+        label: price. Dates are labelled in the format yyyy-mm-dd.
+        """
+        cheapest = self.cheapestBy(column)
+        if column in ("outboundDate", "inboundDate"):
+            labels = [str(date) for date in cheapest.column(column)]
+        else:
+            labels = [self.labels[column][code] for code in cheapest.column(column)]
+        return dict(zip(labels, cheapest.price.tolist()))
+
+    def rankBy(self, column="destination"):
+        """
+        Returns the price rank of each row within its group of column, where 1
+        is the cheapest.
+
+        Returns:
+            ranks(array(of integers)): In the order of the table's rows.
+        """
+        ranks = np.empty(len(self), dtype=np.int64)
+        if not len(self):
+            return ranks
+        order, sortedGroups = self._groupOrder(column)
+        starts = np.r_[True, sortedGroups[1:] != sortedGroups[:-1]]
+        groupStart = np.maximum.accumulate(np.where(starts, np.arange(len(self)), 0))
+        ranks[order] = np.arange(len(self)) - groupStart + 1
+        return ranks
+
+    def toRows(self):
+        """
+        Returns the Quote records of the table's rows, in order.
+        """
+        return [self._rows[i] for i in self.rowIndex.tolist()]
+
+
+def filterResults(resultsDict, cheapestBy=None, maxPrice=None, directOnly=False):
+    """
+    Filters formatted BrowseQuotes results, optionally keeping only the cheapest
+    quote per group, and sorts them by price. Uses a QuoteTable for large result
+    sets when NumPy is installed.
+
+    Args:
+        resultsDict(list(of Quotes)): From BrowseQuotesFormatResults.
+
+        cheapestBy(string): Optional, one of groupColumns.
+
+        maxPrice(number): Optional, the maximum price to include.
+
+        directOnly(boolean): Optional, if True only direct trips are included.
+
+    Returns:
+        resultsDict(list(of Quotes)): The selected results.
+    """
+    if np is not None and len(resultsDict) >= columnarMinRows:
+        table = QuoteTable(resultsDict).filter(maxPrice=maxPrice, directOnly=directOnly)
+        table = table.cheapestBy(cheapestBy) if cheapestBy else table.sortByPrice()
+        return table.toRows()
+
+    selected = [result for result in resultsDict
+                if (maxPrice is None or result['MinPrice'] <= maxPrice)
+                and (not directOnly or result['Direct'])]
+    selected.sort(key=lambda result: result['MinPrice'])
+
+    if cheapestBy:
+        groupKeys = {"origin": lambda result: result['Outbound_OriginPlace'],
+                     "destination": lambda result: result['Outbound_DestinationPlace'],
+                     "carrier": lambda result: result['Outbound_CarrierNames'],
+                     "outboundDate": lambda result: _toDate(result['Outbound_Date']),
+                     "inboundDate": lambda result: _toDate(result['Inbound_Date'])}
+        if cheapestBy not in groupKeys:
+            raise ValueError("Unknown column: {}".format(cheapestBy))
+        cheapest = {}
+        for result in selected:
+            cheapest.setdefault(groupKeys[cheapestBy](result), result)
+        selected = list(cheapest.values())
+
+    return selected
@@ -0,0 +1,226 @@
+"""
+This file serves the formatted results of a stored search a page at a time,
+for the DataTables server-side processing mode used by results_bq.html (refer
+to /api/results in app.py and https://datatables.net/manual/server-side).
+
+The formatted results of recent searches are held in memory, as stored
+results never change, so each page request only filters, sorts and slices
+them rather than reading the database.
+"""
+
+import threading
+from collections import OrderedDict
+import db_functions
+import quote_table
+from ss_api_functions import BrowseQuotesErrors, BrowseQuotesFormatResults
+
+# Number of searches whose formatted results are held in memory
+resultsCacheSize = 8
+
+# Maximum rows per page
+maxPageLength = 500
+
+# search_id: (resultsDict, failedQueries, numQueries), least recently used first
+_resultsCache = OrderedDict()
+_resultsCacheLock = threading.Lock()
+
+# The columns of the results table, in order, as (name, sort key). The link
+# column is not sortable.
+resultColumns = [
+    ("origin", lambda quote: quote.outbound.originPlace or ""),
+    ("destination", lambda quote: quote.outbound.destinationPlace or ""),
+    ("direct", lambda quote: bool(quote.direct)),
+    ("outboundDate", lambda quote: quote.outbound.date or ""),
+    ("outboundCarriers", lambda quote: quote.outbound.carrierNames),
+    ("inboundDate", lambda quote: quote.inbound.date if quote.inbound else ""),
+    ("inboundCarriers", lambda quote: quote.inbound.carrierNames if quote.inbound else ()),
+    ("price", lambda quote: quote.price),
+    ("link", None),
+    ]
+
+
+def getFormattedResults(db, search_id):
+    """
+    Returns the formatted results of a stored search. The formatted results
+    stored by logBQResults are used where possible, so the raw results need not
+    be parsed and formatted. Otherwise (e.g. results stored by an earlier
+    version of the formatter) they are rebuilt from the raw results, and stored
+    for next time.
+
+    Args:
+        db(string): The address of the database file.
+
+        search_id(integer): The unique identifier for the search.
+
+    Returns:
+        (tuple): (resultsDict, failedQueries, numQueries) where resultsDict is
+        the output of BrowseQuotesFormatResults, failedQueries is the number of
+        unsuccessful queries, and numQueries the total number of queries.
+    """
+    stored = db_functions.getFormattedSearchResult(db, search_id)
+    if stored is not None:
+        return stored
+
+    results_json = db_functions.getSearchResult(db, search_id)
+    resultsDict = BrowseQuotesFormatResults(results_json)
+    failedQueries = len(BrowseQuotesErrors(results_json))
+    db_functions.updateFormattedSearchResult(db, search_id, resultsDict, failedQueries, len(results_json))
+
+    return resultsDict, failedQueries, len(results_json)
+
+
+def getResults(db, search_id):
+    """
+    Returns the formatted results of a stored search, from memory if recently
+    used, otherwise using getFormattedResults.
+
+    Returns:
+        (tuple): (resultsDict, failedQueries, numQueries), refer to
+        getFormattedResults.
+    """
+    with _resultsCacheLock:
+        if search_id in _resultsCache:
+            _resultsCache.move_to_end(search_id)
+            return _resultsCache[search_id]
+
+    results = getFormattedResults(db, search_id)
+    cacheResults(search_id, results)
+
+    return results
+
+
+def cacheResults(search_id, results):
+    """
+    Holds the formatted results of a search in memory, e.g. just after the
+    search has run.
+
+    Args:
+        search_id(integer): The unique identifier for the search.
+
+        results(tuple): (resultsDict, failedQueries, numQueries).
+    """
+    with _resultsCacheLock:
+        _resultsCache[search_id] = results
+        _resultsCache.move_to_end(search_id)
+        while len(_resultsCache) > resultsCacheSize:
+            _resultsCache.popitem(last=False)
+
+
+def parseResultsRequest(args):
+    """
+    Reads the DataTables server-side parameters, and the result filters, from
+    the query string of a request.
+
+    Args:
+        args(MultiDict): request.args
+
+    Returns:
+        query(dictionary): The arguments for queryResults.
+
+    Exceptions:
+        ValueError: If a parameter is not valid.
+    """
+    cheapestBy = args.get("cheapest") or None
+    if cheapestBy is not None and cheapestBy not in quote_table.groupColumns:
+        raise ValueError("Unknown column: {}".format(cheapestBy))
+
+    sortColumn = args.get("order[0][column]", 7, type=int)
+    if not 0 <= sortColumn < len(resultColumns) or resultColumns[sortColumn][1] is None:
+        raise ValueError("Column {} is not sortable".format(sortColumn))
+
+    def price(name):
+        value = args.get(name, "")
+        return float(value) if value != "" else None
+
+    return {"cheapestBy": cheapestBy,
+            "minPrice": price("minPrice"),
+            "maxPrice": price("maxPrice"),
+            "directOnly": args.get("direct") == "1",
+            "origin": args.get("origin", "").strip().lower(),
+            "destination": args.get("destination", "").strip().lower(),
+            "outboundFrom": args.get("outboundFrom", ""),
+            "outboundTo": args.get("outboundTo", ""),
+            "search": args.get("search[value]", "").strip().lower(),
+            "sortColumn": sortColumn,
+            "descending": args.get("order[0][dir]") == "desc",
+            "start": max(0, args.get("start", 0, type=int)),
+            # Bounded below too, as a length of -1 would return every row
+            "length": max(1, min(maxPageLength, args.get("length", 50, type=int)))}
+
+
+def queryResults(resultsDict, cheapestBy=None, minPrice=None, maxPrice=None, directOnly=False,
+                 origin="", destination="", outboundFrom="", outboundTo="", search="",
+                 sortColumn=7, descending=False, start=0, length=50):
+    """
+    Filters, sorts and pages formatted results.
+
+    Args:
+        resultsDict(list(of Quotes)): From BrowseQuotesFormatResults.
+
+        cheapestBy, maxPrice, directOnly: Optional, refer to filterResults in
+        quote_table.py.
+
+        minPrice(number): Optional, the minimum price to include.
+
+        origin, destination(string): Optional, lower case text that the place
+        name must contain.
+
+        outboundFrom, outboundTo(string): Optional, inclusive outbound date
+        limits in the format yyyy-mm-dd.
+
+        search(string): Optional, lower case text that the places or carriers
+        must contain.
+
+        sortColumn(integer): The index in resultColumns to sort by.
+
+        descending(boolean): If True, sort in descending order.
+
+        start(integer): The index of the first result of the page.
+
+        length(integer): The number of results in the page. All remaining
+        results if -1.
+
+    Returns:
+        (tuple): (page, recordsFiltered) where page is the list of Quotes for
+        the page, and recordsFiltered the number of results matching the
+        filters.
+    """
+    if cheapestBy or maxPrice is not None or directOnly:
+        resultsDict = quote_table.filterResults(resultsDict, cheapestBy, maxPrice, directOnly)
+
+    def matches(quote):
+        outbound = quote.outbound
+        if minPrice is not None and quote.price < minPrice:
+            return False
+        if origin and origin not in (outbound.originPlace or "").lower():
+            return False
+        if destination and destination not in (outbound.destinationPlace or "").lower():
+            return False
+        if outboundFrom and outbound.date[:10] < outboundFrom:
+            return False
+        if outboundTo and outbound.date[:10] > outboundTo:
+            return False
+        if search:
+            text = " ".join([outbound.originPlace or "", outbound.destinationPlace or ""]
+                            + list(outbound.carrierNames)
+                            + list(quote.inbound.carrierNames if quote.inbound else ()))
+            return search in text.lower()
+        return True
+
+    if minPrice is not None or origin or destination or outboundFrom or outboundTo or search:
+        resultsDict = [quote for quote in resultsDict if matches(quote)]
+
+    resultsDict = sorted(resultsDict, key=resultColumns[sortColumn][1], reverse=descending)
+    end = len(resultsDict) if length == -1 else start + length
+
+    return resultsDict[start:end], len(resultsDict)
+
+
+def resultRow(quote):
+    """
+    Returns a Quote as a row of the results table, in the order of
+    resultColumns.
+    """
+    return [quote['Outbound_OriginPlace'], quote['Outbound_DestinationPlace'], quote['Direct'],
+            quote['Outbound_Date'], ", ".join(quote['Outbound_CarrierNames']), quote['Inbound_Date'],
+            ", ".join(quote['Inbound_CarrierNames']), quote['MinPrice'], quote.get('linkURL')]
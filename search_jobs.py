@@ -0,0 +1,177 @@
+"""
+This file runs BrowseQuotes searches outside of the normal request/response
+cycle: as background jobs, so that large searches do not tie up a web
+request, or as a stream of results sent while the search runs. Jobs are recorded in the search_jobs
+table of the Escapade database and run by a local pool of worker threads. No
+external broker is required.
+
+A job runs the query list already logged by logBQQuery, reports its progress
+to the database, and writes the results through logBQResults. The browser
+polls the job status and is sent to the stored results when it is done.
+
+A stream (refer to streamSearch) yields the formatted quotes for each query as
+soon as its API call completes, and stores the results once all are done.
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import db_functions
+from query_planner import BrowseQuotesPlanned, iterBrowseQuotesPlanned, planBrowseQuotes
+from ss_api_functions import BrowseQuotesErrors, BrowseQuotesFormatResults
+
+# Number of searches that may run at once. Each search also runs its API calls
+# concurrently (refer to bqMaxWorkers in ss_api_functions).
+jobWorkers = 2
+
+# Minimum seconds between progress updates written to the database per job
+progressInterval = 0.5
+
+# The worker pool, created on first use
+_executor = None
+_executorLock = threading.Lock()
+
+
+def _getExecutor():
+    """
+    Returns the job worker pool, creating it on first use.
+    """
+    global _executor
+    with _executorLock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=jobWorkers,
+                                           thread_name_prefix="search_job")
+    return _executor
+
+
+def submitSearchJob(db, user_id, search_id, queryList):
+    """
+    Queues a logged search to be run by the job worker pool.
+
+    Args:
+        db(string): The address of the database file.
+
+        user_id(integer): User id for the search. May be "" if no user is
+        logged in.
+
+        search_id(integer): The search id returned by logBQQuery for queryList.
+
+        queryList(list(of dictionaries)): The BrowseQuotes queries to run.
+
+    Returns:
+        job_id(integer): The unique identifier for the job, for use with
+        getSearchJob.
+    """
+    totalCalls = len(planBrowseQuotes(queryList)["calls"])
+    job_id = db_functions.createSearchJob(db, search_id, user_id, totalCalls)
+
+    _getExecutor().submit(runSearchJob, db, job_id, user_id, search_id, queryList)
+
+    return job_id
+
+
+def runSearchJob(db, job_id, user_id, search_id, queryList):
+    """
+    Runs a search job to completion, recording progress and the final status
+    against the job. Called by the worker pool.
+
+    Args:
+        db(string): The address of the database file.
+
+        job_id(integer): The unique identifier for the job.
+
+        user_id(integer): User id for the search.
+
+        search_id(integer): The search id for queryList.
+
+        queryList(list(of dictionaries)): The BrowseQuotes queries to run.
+    """
+    db_functions.updateSearchJob(db, job_id, "running", 0)
+    lastUpdate = [0.0]
+
+    def reportProgress(completed, total):
+        # Limit database writes for searches with many fast (cached) calls
+        now = time.monotonic()
+        if completed == total or now - lastUpdate[0] >= progressInterval:
+            lastUpdate[0] = now
+            db_functions.updateSearchJob(db, job_id, "running", completed, totalCalls=total)
+
+    try:
+        results_json = BrowseQuotesPlanned(queryList, progressCallback=reportProgress)
+        results_id = db_functions.logBQResults(db, user_id, search_id, results_json,
+                                               BrowseQuotesFormatResults(results_json),
+                                               len(BrowseQuotesErrors(results_json)))
+
+    except Exception as e:
+        db_functions.updateSearchJob(db, job_id, "failed", errorMessage=str(e))
+        return
+
+    # putData returns None if the results could not be stored
+    if results_id is None:
+        db_functions.updateSearchJob(db, job_id, "failed", errorMessage="The results could not be stored")
+        return
+
+    db_functions.updateSearchJob(db, job_id, "done")
+
+
+def resumeSearchJobs(db):
+    """
+    Requeues any jobs left queued or running when the app last stopped. Their
+    query lists are reloaded from search_bq_log. Where several app processes
+    share a database, only one of them should call this.
+
+    Args:
+        db(string): The address of the database file.
+
+    Returns:
+        resumed(integer): The number of jobs requeued.
+    """
+    jobs = db_functions.getUnfinishedSearchJobs(db) or []
+
+    for job in jobs:
+        queryList = db_functions.getSearchQuery(db, job["search_id"])
+        db_functions.updateSearchJob(db, job["job_id"], "queued", 0)
+        _getExecutor().submit(runSearchJob, db, job["job_id"], job["user_id"],
+                              job["search_id"], queryList)
+
+    return len(jobs)
+
+
+def streamSearch(db, user_id, search_id, queryList):
+    """
+    Generator that runs a logged search, yielding the formatted quotes for each
+    query as soon as its API call completes. Once every query has completed,
+    the results are stored through logBQResults. If the caller stops early
+    (e.g. the browser disconnects), the remaining calls are abandoned and
+    nothing is stored.
+
+    Args:
+        db(string): The address of the database file.
+
+        user_id(integer): User id for the search. May be "" if no user is
+        logged in.
+
+        search_id(integer): The search id returned by logBQQuery for queryList.
+
+        queryList(list(of dictionaries)): The BrowseQuotes queries to run.
+
+    Yields:
+        (tuple): (queryIndex, formattedResults, failed) in completion order,
+        where formattedResults is the output of BrowseQuotesFormatResults for
+        the query's response, and failed is True if the query was unsuccessful.
+    """
+    results_json = [None] * len(queryList)
+    formattedByQuery = [()] * len(queryList)
+    failedQueries = 0
+
+    for queryIndex, response in iterBrowseQuotesPlanned(queryList):
+        results_json[queryIndex] = response
+        formattedByQuery[queryIndex] = BrowseQuotesFormatResults([response])
+        failed = not isinstance(response, dict) or "Quotes" not in response
+        failedQueries += failed
+        yield (queryIndex, formattedByQuery[queryIndex], failed)
+
+    # A reconnecting browser may have run the same search twice
+    if not db_functions.searchHasResults(db, search_id):
+        formattedResults = [quote for formatted in formattedByQuery for quote in formatted]
+        db_functions.logBQResults(db, user_id, search_id, results_json, formattedResults, failedQueries)
@@ -8,7 +8,19 @@ endpoint was removed due to Skyscanner removal from free account privileges.
 
 """
 
-import requests, json, csv, string, time
+import requests, json, csv, string, time, threading, random, logging, math, os, sys
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+import db_functions
+from quote_records import Leg, Quote
+
+logger = logging.getLogger(__name__)
+
+# Base URL of the Skyscanner API. May be pointed at a local stand-in server
+# (refer to mock_ss_server.py) by setting the SS_API_BASE_URL environment variable.
+apiBaseUrl = os.environ.get("SS_API_BASE_URL",
+                            "https://skyscanner-skyscanner-flight-search-v1.p.rapidapi.com")
 
 # Define API header information
 headers = {
@@ -17,6 +29,67 @@ headers = {
     'content-type': "application/x-www-form-urlencoded"
     }
 
+# Maximum number of concurrent calls made by BrowseQuotes. A value of 1 makes
+# the calls one after another.
+bqMaxWorkers = 8
+
+# HTTP client settings for the shared keep-alive session (refer to getSession).
+# The pool size should be at least bqMaxWorkers so that no worker has to open
+# a fresh connection.
+httpPoolSize = 16
+httpConnectTimeout = 5 # Seconds to establish a connection
+httpReadTimeout = 30 # Seconds to wait for a response
+httpUseGzip = True # Request gzip compressed responses
+
+# Module level session shared by all endpoint functions, created on first use
+_session = None
+_sessionLock = threading.Lock()
+
+# Client-side rate limiting and retry settings (refer to apiGet). Calls are
+# limited by a token bucket shared by all endpoint functions and threads.
+rateLimitPerSecond = 5.0 # Sustained calls per second
+rateLimitBurst = 5 # Calls that may be made at once after an idle period
+retryMaxAttempts = 4 # Total attempts for a call that is throttled or fails
+retryBaseDelay = 0.5 # Seconds, doubled for each further attempt
+retryMaxDelay = 30.0 # Seconds, upper limit of any single wait
+
+# Token bucket state, and the time before which no call may be made (set by
+# Retry-After, or by an exhausted RapidAPI quota)
+_rateTokens = float(rateLimitBurst)
+_rateUpdated = time.monotonic()
+_rateBlockedUntil = 0.0
+_rateLock = threading.Lock()
+
+# Latest RapidAPI quota information and retry counters (refer to getQuotaStatus)
+_quotaStatus = {"limit": None, "remaining": None, "reset": None,
+                "throttled": 0, "serverErrors": 0, "retries": 0}
+
+# Observed API call latency, as an exponentially weighted moving average in
+# seconds, used to predict search durations (refer to getAverageLatency)
+defaultCallLatency = 1.0 # Seconds, assumed until a call has been made
+_latencyAverage = None
+_latencyWeight = 0.2
+
+# BrowseQuotes cache settings (refer to configureQuoteCache). The in-process
+# tier is a LRU of up to quoteCacheMaxEntries responses. The persistent tier is
+# an sqlite database shared by all app workers, and is disabled while
+# quoteCacheDb is None.
+quoteCacheTTL = 3600 # Seconds a cached response remains valid
+quoteCacheMaxEntries = 1024
+quoteCacheDb = None
+quoteCacheDbMaxEntries = 100000
+quoteCachePruneInterval = 500 # Prune the persistent tier every N writes
+
+# In-process cache tier of cacheKey: (expires, response_json), oldest first
+_quoteCache = OrderedDict()
+_quoteCacheLock = threading.Lock()
+_quoteCacheWrites = 0
+
+# BrowseQuotes calls currently in progress, as cacheKey: Future. Used to share
+# one upstream call between identical concurrent queries (single-flight).
+_inFlight = {}
+_inFlightLock = threading.Lock()
+
 def CSVtoDict(csv_input_file):
     """
     GENERAL PURPOSE - Opens a CSV containing data with a single header row and
@@ -112,7 +185,7 @@ def formatBqUrl(inputDict):
     # Contruct the URL in the format defined here:
     # https://rapidapi.com/skyscanner/api/skyscanner-flight-search?endpoint=5aa1eab3e4b00687d3574279
     # Construct URL for Outbound Trip
-    urlBq = ("https://skyscanner-skyscanner-flight-search-v1.p.rapidapi.com/apiservices/browsequotes/v1.0/" +
+    urlBq = (apiBaseUrl + "/apiservices/browsequotes/v1.0/" +
                         inputDict["country"] + "/" +
                         inputDict["currency"] + "/" +
                         inputDict["locale"] + "/" +
@@ -123,7 +196,404 @@ def formatBqUrl(inputDict):
     
     return urlBq
 
-def BrowseQuotesGetData(inputDict):
+def bqCacheKey(inputDict):
+    """
+    Returns the key used to identify a BrowseQuotes query in the quote cache.
+    This is the formatBqUrl output normalised so that queries differing only
+    by letter case, surrounding whitespace or a missing inbound date share a
+    key.
+
+    Args:
+        inputDict (dictionary): A dictionary, containing keys
+        required to construct an URL for the BrowseQuotes API endpoint.
+
+    Returns:
+        cacheKey (string): The normalised URL.
+    """
+    url = formatBqUrl(inputDict)
+    segments = [segment.strip() for segment in url.split("/")]
+
+    return "/".join(segments).rstrip("/").lower()
+
+def getCachedQuote(cacheKey):
+    """
+    Retreives a BrowseQuotes response from the quote cache. The in-process tier
+    is checked first, then the persistent tier (if enabled), and a persistent
+    hit is copied into the in-process tier.
+
+    Args:
+        cacheKey (string): The key for the query, from bqCacheKey.
+
+    Returns:
+        response_json (dictionary): The cached response, or None if there is no
+        unexpired entry.
+    """
+    now = time.time()
+
+    with _quoteCacheLock:
+        entry = _quoteCache.get(cacheKey)
+        if entry is not None:
+            if entry[0] > now:
+                _quoteCache.move_to_end(cacheKey)
+                return entry[1]
+            del _quoteCache[cacheKey]
+
+    if quoteCacheDb is None:
+        return None
+
+    entry = db_functions.getCachedQuote(quoteCacheDb, cacheKey, now)
+    if entry is None:
+        return None
+
+    response_json, expires = entry
+    _putMemoryCache(cacheKey, response_json, expires)
+
+    return response_json
+
+def isQuoteCached(cacheKey):
+    """
+    Checks whether an unexpired response for a query is held in either tier of
+    the quote cache, without loading it.
+
+    Args:
+        cacheKey (string): The key for the query, from bqCacheKey.
+
+    Returns:
+        (Bool): True if a cached response is available.
+    """
+    now = time.time()
+
+    with _quoteCacheLock:
+        entry = _quoteCache.get(cacheKey)
+        if entry is not None and entry[0] > now:
+            return True
+
+    if quoteCacheDb is None:
+        return False
+
+    return db_functions.isCachedQuote(quoteCacheDb, cacheKey, now)
+
+def putCachedQuote(cacheKey, response_json):
+    """
+    Stores a BrowseQuotes response in both tiers of the quote cache for
+    quoteCacheTTL seconds. Only responses containing quotes data are cached,
+    so that errors and throttling responses are retried on the next call.
+
+    Args:
+        cacheKey (string): The key for the query, from bqCacheKey.
+
+        response_json (dictionary): The response received from the API endpoint.
+    """
+    global _quoteCacheWrites
+
+    if quoteCacheTTL <= 0 or not isinstance(response_json, dict) or "Quotes" not in response_json:
+        return
+
+    now = time.time()
+    expires = now + quoteCacheTTL
+    _putMemoryCache(cacheKey, response_json, expires)
+
+    if quoteCacheDb is None:
+        return
+
+    db_functions.putCachedQuote(quoteCacheDb, cacheKey, response_json, now, expires)
+
+    with _quoteCacheLock:
+        _quoteCacheWrites += 1
+        prune = _quoteCacheWrites % quoteCachePruneInterval == 0
+    if prune:
+        db_functions.pruneQuoteCache(quoteCacheDb, quoteCacheDbMaxEntries, now)
+
+def _putMemoryCache(cacheKey, response_json, expires):
+    """
+    Adds an entry to the in-process cache tier, evicting the least recently
+    used entries beyond quoteCacheMaxEntries.
+    """
+    with _quoteCacheLock:
+        _quoteCache[cacheKey] = (expires, response_json)
+        _quoteCache.move_to_end(cacheKey)
+        while len(_quoteCache) > quoteCacheMaxEntries:
+            _quoteCache.popitem(last=False)
+
+def configureQuoteCache(ttl=None, maxEntries=None, db=None, dbMaxEntries=None):
+    """
+    Updates the quote cache settings. Arguments left as None keep their current
+    value.
+
+    Args:
+        ttl (integer): Seconds a cached response remains valid. 0 disables
+        caching of new responses.
+
+        maxEntries (integer): Maximum entries in the in-process tier.
+
+        db (string): The address of the sqlite database file for the persistent
+        tier. It is created if required.
+
+        dbMaxEntries (integer): Maximum entries in the persistent tier.
+    """
+    global quoteCacheTTL, quoteCacheMaxEntries, quoteCacheDb, quoteCacheDbMaxEntries
+    if ttl is not None:
+        quoteCacheTTL = ttl
+    if maxEntries is not None:
+        quoteCacheMaxEntries = maxEntries
+    if dbMaxEntries is not None:
+        quoteCacheDbMaxEntries = dbMaxEntries
+    if db is not None:
+        db_functions.intialiseQuoteCache(db)
+        quoteCacheDb = db
+
+def clearQuoteCache():
+    """
+    Empties the in-process tier of the quote cache. The persistent tier is left
+    to expire.
+    """
+    with _quoteCacheLock:
+        _quoteCache.clear()
+
+def getSession():
+    """
+    Returns the requests.Session shared by all calls to the Skyscanner API,
+    creating it on first use. The session keeps connections to the RapidAPI
+    host alive between calls, so each call after the first avoids a new TCP
+    and TLS handshake. It is safe to share between the BrowseQuotes worker
+    threads.
+
+    Returns:
+        session (requests.Session): The shared session, with a connection pool
+        of httpPoolSize and the API headers applied.
+    """
+    global _session
+    if _session is None:
+        with _sessionLock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=httpPoolSize,
+                                      pool_maxsize=httpPoolSize)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                session.headers.update(headers)
+                if httpUseGzip:
+                    session.headers["Accept-Encoding"] = "gzip, deflate"
+                else:
+                    session.headers["Accept-Encoding"] = "identity"
+                _session = session
+    return _session
+
+
+def configureSession(poolSize=None, connectTimeout=None, readTimeout=None,
+                     useGzip=None):
+    """
+    Updates the HTTP client settings and discards the current shared session,
+    so that the next call creates a new one with the new settings. Arguments
+    left as None keep their current value.
+
+    Args:
+        poolSize (integer): Maximum number of kept-alive connections.
+
+        connectTimeout (float): Seconds to wait to establish a connection.
+
+        readTimeout (float): Seconds to wait for a response.
+
+        useGzip (Bool): Whether to request gzip compressed responses.
+    """
+    global _session, httpPoolSize, httpConnectTimeout, httpReadTimeout, httpUseGzip
+    with _sessionLock:
+        if poolSize is not None:
+            httpPoolSize = poolSize
+        if connectTimeout is not None:
+            httpConnectTimeout = connectTimeout
+        if readTimeout is not None:
+            httpReadTimeout = readTimeout
+        if useGzip is not None:
+            httpUseGzip = useGzip
+        if _session is not None:
+            _session.close()
+        _session = None
+
+
+def acquireRateToken():
+    """
+    Blocks until the rate limiter allows another call to the API. Calls are
+    spread at rateLimitPerSecond with bursts of up to rateLimitBurst, and
+    all calls wait while the API has asked us to back off.
+    """
+    global _rateTokens, _rateUpdated
+    while True:
+        with _rateLock:
+            now = time.monotonic()
+            _rateTokens = min(float(rateLimitBurst),
+                              _rateTokens + (now - _rateUpdated) * rateLimitPerSecond)
+            _rateUpdated = now
+
+            if now < _rateBlockedUntil:
+                wait = _rateBlockedUntil - now
+            elif _rateTokens >= 1:
+                _rateTokens -= 1
+                return
+            else:
+                wait = (1 - _rateTokens) / rateLimitPerSecond
+
+        time.sleep(wait)
+
+
+def _blockCalls(seconds):
+    """
+    Stops all threads from making calls for the given number of seconds.
+    """
+    global _rateBlockedUntil
+    with _rateLock:
+        _rateBlockedUntil = max(_rateBlockedUntil, time.monotonic() + seconds)
+
+
+def _updateQuota(response):
+    """
+    Records the RapidAPI rate limit headers from a response. If the quota is
+    used up, calls are held until it resets rather than being sent to fail.
+    """
+    limit = response.headers.get("x-ratelimit-requests-limit")
+    remaining = response.headers.get("x-ratelimit-requests-remaining")
+    reset = response.headers.get("x-ratelimit-requests-reset")
+
+    with _rateLock:
+        if limit is not None and limit.isdigit():
+            _quotaStatus["limit"] = int(limit)
+        if remaining is not None and remaining.isdigit():
+            _quotaStatus["remaining"] = int(remaining)
+        if reset is not None and reset.isdigit():
+            _quotaStatus["reset"] = time.time() + int(reset)
+
+    if remaining == "0" and reset is not None and reset.isdigit():
+        _blockCalls(min(int(reset), retryMaxDelay))
+
+
+def _retryDelay(response, attempt):
+    """
+    Returns the seconds to wait before retrying. The Retry-After header is
+    used if present and a finite number of seconds, otherwise exponential
+    backoff with full jitter.
+    """
+    if response is not None:
+        retryAfter = response.headers.get("Retry-After")
+        if retryAfter is not None:
+            try:
+                retryAfter = float(retryAfter)
+            except ValueError:
+                retryAfter = None
+            if retryAfter is not None and math.isfinite(retryAfter):
+                return max(0.0, min(retryAfter, retryMaxDelay))
+
+    return random.uniform(0, min(retryMaxDelay, retryBaseDelay * 2 ** attempt))
+
+
+def _recordLatency(seconds):
+    """
+    Adds the duration of a successful call to the latency moving average.
+    """
+    global _latencyAverage
+    with _rateLock:
+        if _latencyAverage is None:
+            _latencyAverage = seconds
+        else:
+            _latencyAverage += _latencyWeight * (seconds - _latencyAverage)
+
+
+def getAverageLatency():
+    """
+    Returns the moving average duration of recent successful API calls in
+    seconds, or defaultCallLatency if no call has been made yet.
+    """
+    with _rateLock:
+        if _latencyAverage is None:
+            return defaultCallLatency
+        return _latencyAverage
+
+
+def getQuotaStatus():
+    """
+    Returns the rate limiter and RapidAPI quota counters, for display or for
+    sizing large fan-outs.
+
+    Returns:
+        quotaStatus (dictionary): With the keys:
+            limit (integer): The RapidAPI request quota, or None if not yet known
+            remaining (integer): Requests remaining in the quota, or None
+            reset (float): Time since epoch at which the quota resets, or None
+            throttled (integer): Number of 429 responses received
+            serverErrors (integer): Number of 5xx responses received
+            retries (integer): Number of calls retried
+            tokens (float): Calls currently available from the rate limiter
+    """
+    with _rateLock:
+        quotaStatus = dict(_quotaStatus)
+        quotaStatus["tokens"] = _rateTokens
+
+    return quotaStatus
+
+
+def apiGet(url, params=None):
+    """
+    Makes a GET request to the Skyscanner API using the shared session and the
+    configured timeouts.
+
+    Each attempt first takes a token from the rate limiter. Responses with
+    status 429 or 5xx, and connection failures, are retried up to
+    retryMaxAttempts in total, waiting as given by Retry-After or by
+    exponential backoff with jitter. A 429 holds back every thread, not just
+    the one that received it.
+
+    Args:
+        url (string): The full URL of the endpoint.
+
+        params (dictionary): Optional query string parameters.
+
+    Returns:
+        response (requests.Response): The response received from the endpoint.
+        After the final attempt this may still be a 429 or 5xx response.
+
+    Exceptions:
+        requests.RequestException: If the final attempt fails to connect.
+    """
+    for attempt in range(retryMaxAttempts):
+        acquireRateToken()
+        lastAttempt = attempt == retryMaxAttempts - 1
+
+        try:
+            callStart = time.monotonic()
+            response = getSession().get(url, params=params,
+                                        timeout=(httpConnectTimeout, httpReadTimeout))
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if lastAttempt:
+                raise
+            logger.warning("API call failed (%s), retrying: %s", e, url)
+            delay = _retryDelay(None, attempt)
+
+        else:
+            _updateQuota(response)
+            if response.status_code != 429 and response.status_code < 500:
+                _recordLatency(time.monotonic() - callStart)
+                return response
+
+            with _rateLock:
+                if response.status_code == 429:
+                    _quotaStatus["throttled"] += 1
+                else:
+                    _quotaStatus["serverErrors"] += 1
+
+            if lastAttempt:
+                return response
+
+            delay = _retryDelay(response, attempt)
+            logger.warning("API returned %s, retrying in %.1fs: %s",
+                           response.status_code, delay, url)
+            if response.status_code == 429:
+                _blockCalls(delay)
+
+        with _rateLock:
+            _quotaStatus["retries"] += 1
+        time.sleep(delay)
+
+
+def BrowseQuotesGetData(inputDict, useCache=True):
     """
     Makes a call to the Skyscanner API endpoint Browse Routes to retreive a
     .JSON formated string comprising search results for a given query. 
@@ -131,10 +601,16 @@ def BrowseQuotesGetData(inputDict):
     Refer to:
     https://rapidapi.com/skyscanner/api/skyscanner-flight-search
 
+    A cached response for the same query is returned instead of calling the
+    API, if one is available (refer to getCachedQuote).
+
     Args:
         inputDict (dictionary): A dictionary, containing keys
         required to construct an URL for the BrowseQuotes API endpoint.
 
+        useCache (Bool): Optional, set False to bypass the quote cache lookup.
+        The response is still stored in the cache.
+
         headers (dictionary): A dictionary containing the html headers required
         to be submitted with the API call. This is a global variable within this
         file.
@@ -142,134 +618,320 @@ def BrowseQuotesGetData(inputDict):
     Returns:
         response_json (dictionary): A Python formatted json containing
         multiple lists and dictionaries, as recevied from the API endpoint.
+        If the call is unsuccessful after retries (refer to apiGet), a
+        dictionary with the keys "ErrorMessage", "StatusCode" and "Query".
 
     Exceptions:
         TODO - - Need an exception / behaviour if no result returned.
 
     """
-    # Format the request URL for the outbound data
-    url = formatBqUrl(inputDict)
+    # Return the cached response if there is one
+    cacheKey = bqCacheKey(inputDict)
+    if useCache:
+        response_json = getCachedQuote(cacheKey)
+        if response_json is not None:
+            return response_json
+
+    # If an identical query is already in progress, wait for and share its result
+    with _inFlightLock:
+        inFlight = _inFlight.get(cacheKey)
+        if inFlight is None:
+            inFlight = Future()
+            _inFlight[cacheKey] = inFlight
+            leader = True
+        else:
+            leader = False
+
+    if not leader:
+        return inFlight.result()
+
+    try:
+        # Format the request URL for the outbound data
+        url = formatBqUrl(inputDict)
+
+        # Make the API call and receive a .json formatted string
+        response_string = apiGet(url)
+
+        # Convert .json into Python lists and dictionaries, or report the
+        # failure if the call did not succeed after retries
+        if response_string.ok:
+            response_json = response_string.json()
+        else:
+            response_json = {"ErrorMessage": "HTTP " + str(response_string.status_code) +
+                                             ": " + response_string.text[:500],
+                             "StatusCode": response_string.status_code,
+                             "Query": inputDict}
+
+        # Cache before releasing the in-flight entry so later callers hit the cache
+        putCachedQuote(cacheKey, response_json)
+        inFlight.set_result(response_json)
+
+    except Exception as e:
+        inFlight.set_exception(e)
+        raise
+
+    finally:
+        with _inFlightLock:
+            del _inFlight[cacheKey]
 
-    # Make the API call and receive a .json formatted string
-    response_string = requests.request("GET", url, headers=headers)
+    return response_json
 
-    # Convert .json into Python lists and dictionaries
-    response_json = response_string.json()
 
-    return response_json
+def BrowseQuotesSafeGetData(inputDict):
+    """
+    Wrapper for BrowseQuotesGetData that does not raise. Any failure for a single
+    query is returned as an error dictionary, so that one failed call does not
+    lose the results of the rest of the batch.
+
+    Args:
+        inputDict (dictionary): A dictionary, containing keys
+        required to construct an URL for the BrowseQuotes API endpoint.
+
+    Returns:
+        response_json (dictionary): The response from BrowseQuotesGetData, or on
+        failure a dictionary with the keys "ErrorMessage" (string) and "Query"
+        (the inputDict that failed).
+    """
+    try:
+        return BrowseQuotesGetData(inputDict)
+    except Exception as e:
+        return {"ErrorMessage": str(e), "Query": inputDict}
 
 
-def BrowseQuotes(inputDictList):
+def iterBrowseQuotes(inputDictList, maxWorkers=None):
+    """
+    Generator version of BrowseQuotes, which yields each response as soon as
+    its call completes rather than waiting for the whole list. Identical
+    queries within the list are only called once, and the shared response is
+    yielded for each of their positions together.
+
+    Args:
+        inputDictList (list(of dictionaries)): A list of dictionaries, each of which
+        contains the keys required to query to BrowseQuotesAPI endpoint.  (Refer 
+        to function formatBqUrl for details).
+
+        maxWorkers (integer): Optional, the maximum number of concurrent calls.
+        Defaults to the module setting bqMaxWorkers.
+
+    Yields:
+        (tuple): (index, response_json) in completion order, where index is the
+        position of the query in inputDictList, and response_json is as
+        received from BrowseQuotesSafeGetData.
+    """
+    # Reduce to unique queries, recording the positions of each in the input
+    uniqueQueries = []
+    uniqueIndex = {}
+    positions = []
+    for index, inputDict in enumerate(inputDictList):
+        cacheKey = bqCacheKey(inputDict)
+        if cacheKey not in uniqueIndex:
+            uniqueIndex[cacheKey] = len(uniqueQueries)
+            uniqueQueries.append(inputDict)
+            positions.append([])
+        positions[uniqueIndex[cacheKey]].append(index)
+
+    if maxWorkers is None:
+        maxWorkers = bqMaxWorkers
+    maxWorkers = max(1, min(maxWorkers, len(uniqueQueries)))
+
+    # No benefit from a pool for a single worker
+    if maxWorkers == 1:
+        for unique, inputDict in enumerate(uniqueQueries):
+            response_json = BrowseQuotesSafeGetData(inputDict)
+            for index in positions[unique]:
+                yield (index, response_json)
+        return
+
+    executor = ThreadPoolExecutor(max_workers=maxWorkers)
+    futures = {executor.submit(BrowseQuotesSafeGetData, inputDict): unique
+               for unique, inputDict in enumerate(uniqueQueries)}
+    try:
+        for future in as_completed(futures):
+            response_json = future.result()
+            for index in positions[futures[future]]:
+                yield (index, response_json)
+
+    finally:
+        # If the caller stops early, do not start the calls still queued
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def BrowseQuotes(inputDictList, maxWorkers=None, progressCallback=None):
     """
     Makes multiple calls to the BrowseQuotesGetData function for each query defined
     within a list of query URLs. Returns a list of the individual dictionary
     responses returned from BrowseQuotesAPI.
 
+    Calls are made concurrently by a pool of up to maxWorkers threads. Results
+    are always returned in the same order as inputDictList. Identical queries
+    within the list (same bqCacheKey) are only called once, and share the
+    same response. Refer to iterBrowseQuotes.
+
     Args:
         inputDictList (list(of dictionaries)): A list of dictionaries, each of which
         contains the keys required to query to BrowseQuotesAPI endpoint.  (Refer 
         to function formatBqUrl for details).
 
+        maxWorkers (integer): Optional, the maximum number of concurrent calls.
+        Defaults to the module setting bqMaxWorkers.
+
+        progressCallback (function): Optional, called as
+        progressCallback(completed, total) as each query completes.
+
     Returns:
         results (list(of dictionaries)): A list of dictionaries, each of which has format,
-        received from BrowseQuotesGetData function.
+        received from BrowseQuotesGetData function. A query that failed is
+        represented by an error dictionary (refer to BrowseQuotesSafeGetData).
 
     """
-    results = []
-    for inputDict in inputDictList:
-        quote = BrowseQuotesGetData(inputDict)
-        results.append(quote)
-    
+    results = [None] * len(inputDictList)
+
+    # Results are placed by index, so order is kept regardless of completion order
+    for completed, (index, response_json) in enumerate(iterBrowseQuotes(inputDictList, maxWorkers), 1):
+        results[index] = response_json
+        if progressCallback:
+            progressCallback(completed, len(inputDictList))
+
     return results
 
-def BrowseQuotesFormatResults(rawResults):
+def BrowseQuotesFormatResults(rawResults, cheapestOnly=False):
     """
-    Converts a list of raw Browse Quotes API responses into a list of single depth
-    dictionaries for parsing to the webapp.
+    Converts a list of raw Browse Quotes API responses into a list of Quote
+    records (refer to quote_records.py) for parsing to the webapp. Every quote
+    in each response is included, unless cheapestOnly is set.
 
     Args:
         rawResults(list (of dictionaries)): A list of dictionaries, each of which has format,
         received from BrowseQuotesGetData function.
 
+        cheapestOnly(boolean): Optional, if True only the cheapest quote for each
+        route and date pair (origin, destination, outbound and inbound date) is
+        included, as in earlier versions which returned a single quote per query.
+
     Returns:
-        formattedResultList(list (of dictionaries)): A formatted list of dictionaries,
-        each of which has the following keys:
+        formattedResultList(list (of Quotes)): A list of Quote records, each of
+        which may be read as a dictionary with the following keys:
+            MinPrice (integer): The price of the quote
+            Direct (boolean): True if the trip has no stops
             Outbound_OriginID (string): Numeric location identifer for origin
             Outbound_DestinationID (string): Numeric location identifer for
                 destination
-            Outbound_CarrierID (list): A list of numeric identifiers for the
+            Outbound_CarrierID (tuple): Numeric identifiers for the
                 carrier(s) for the outbound leg of the trip
             Outbound_Date (string): Date of the outbound leg of the  trip
             Outbound_OriginPlace (string): Name of the origin place
             Outbound_DestinationPlace (string): Name of the destination place
-            Outbound_CarrierNames (list): A list of the names of the Carriers
+            Outbound_CarrierNames (tuple): The names of the Carriers
                 for the trip
-            Inbound_CarrierID (list): A list of numeric identifiers for the
-                carrier(s) for the inbound leg of the trip
-            Outbound_Date (string): Date of the inbound leg of the trip
-            Inbound_CarrierNames (list): A list of the names of the Carriers
+            Inbound_CarrierID (tuple): Numeric identifiers for the
+                carrier(s) for the inbound leg of the trip. None if one way.
+            Inbound_Date (string): Date of the inbound leg of the trip. None if
+                one way.
+            Inbound_CarrierNames (tuple): The names of the Carriers
                 for the inbound leg of the trip.
 
-    TODO - - Need an exception / behaviour if no result returned. 
+        Error responses (refer to BrowseQuotesErrors) contribute no results.
     """
-    
-    formattedResultList = []    
+    formattedResultList = []
+    cheapest = {}
     for result in rawResults:
-        # Try to format results based on valid keys being present in the results
-        try:
-            # Extract required data into a single dictionary for outbound leg.
-            formattedResult = {}
-            Quotes_list = result["Quotes"]
-            Places_list = result["Places"]
-            Carriers_list = result["Carriers"]
-            formattedResult['MinPrice'] = Quotes_list[0]['MinPrice']
-            formattedResult['Outbound_OriginID'] = Quotes_list[0]['OutboundLeg']['OriginId']
-            formattedResult['Outbound_DestinationID'] = Quotes_list[0]['OutboundLeg']['DestinationId']
-            formattedResult['Direct'] = Quotes_list[0]['Direct']
-            formattedResult['Outbound_CarrierID'] = Quotes_list[0]['OutboundLeg']['CarrierIds']
-            formattedResult['Outbound_Date'] = Quotes_list[0]['OutboundLeg']['DepartureDate']
-
-            for place in Places_list:
-                if place['PlaceId'] == formattedResult['Outbound_OriginID']:
-                    formattedResult['Outbound_OriginPlace'] = place['Name']
-                elif place['PlaceId'] == formattedResult['Outbound_DestinationID']:
-                    formattedResult['Outbound_DestinationPlace'] = place['Name']
-
-            # Try to format inbound leg parameters, if present
-            formattedResult['Inbound_CarrierID'] = None
-            formattedResult['Inbound_Date'] = None
+        if not isinstance(result, dict) or "Quotes" not in result:
+            logger.warning("Dropped BrowseQuotes error response: %s", str(result)[:500])
+            continue
+
+        # Index the place and carrier names once per response, rather than
+        # scanning the Places and Carriers lists for every quote. Names are
+        # interned so that quotes from every response share the same strings.
+        placeNames = {place["PlaceId"]: sys.intern(place["Name"]) for place in result.get("Places", [])}
+        carrierNames = {carrier["CarrierId"]: sys.intern(carrier["Name"]) for carrier in result.get("Carriers", [])}
+        carrierTuples = {}
+
+        for quote in result["Quotes"]:
             try:
-                formattedResult['Inbound_CarrierID'] = Quotes_list[0]['InboundLeg']['CarrierIds']
-                formattedResult['Inbound_Date'] = Quotes_list[0]['InboundLeg']['DepartureDate']
-            except:
-                pass
-        
-
-            # There may be multiple carriers so requires a lists
-            formattedResult['Outbound_CarrierNames'] = []
-            formattedResult['Inbound_CarrierNames'] = []
-            for carrier in Carriers_list:
-                if carrier['CarrierId'] in formattedResult['Outbound_CarrierID']:
-                    formattedResult['Outbound_CarrierNames'].append(carrier['Name'])
-                try:
-                    if carrier['CarrierId'] in formattedResult['Inbound_CarrierID']:
-                        formattedResult['Inbound_CarrierNames'].append(carrier['Name'])
-                except:
-                    pass
-
-            # Append either the result to the results list
-            formattedResultList.append(formattedResult)
-
-        except:
-            # TODO - Populate with basic values and show no results provided
-            # This isn't easy as failed result provides no detail abou the query
-            pass
-    
+                formattedResult = _formatQuote(quote, placeNames, carrierNames, carrierTuples)
+            except (KeyError, TypeError):
+                logger.warning("Skipped malformed BrowseQuotes quote: %s", str(quote)[:500])
+                continue
+
+            if not cheapestOnly:
+                formattedResultList.append(formattedResult)
+                continue
 
+            outbound, inbound = formattedResult.outbound, formattedResult.inbound
+            routeDate = (outbound.originId, outbound.destinationId, outbound.date,
+                         inbound.date if inbound else None)
+            if routeDate not in cheapest or formattedResult.price < cheapest[routeDate].price:
+                cheapest[routeDate] = formattedResult
+
+    if cheapestOnly:
+        formattedResultList = list(cheapest.values())
 
     return formattedResultList
 
 
+def _formatLeg(leg, placeNames, carrierNames, carrierTuples):
+    """
+    Returns a Leg record for the OutboundLeg or InboundLeg of a quote. The
+    carrier id and name tuples are shared between legs with the same carriers
+    through carrierTuples.
+    """
+    carrierIds = tuple(leg['CarrierIds'])
+    if carrierIds not in carrierTuples:
+        carrierTuples[carrierIds] = (carrierIds, tuple(carrierNames[carrierId] for carrierId in carrierIds
+                                                       if carrierId in carrierNames))
+    carrierIds, names = carrierTuples[carrierIds]
+
+    return Leg(leg['OriginId'], leg['DestinationId'], leg['DepartureDate'], carrierIds,
+               placeNames.get(leg['OriginId']), placeNames.get(leg['DestinationId']), names)
+
+
+def _formatQuote(quote, placeNames, carrierNames, carrierTuples):
+    """
+    Formats a single quote from a Browse Quotes response, for
+    BrowseQuotesFormatResults.
+
+    Args:
+        quote(dictionary): An entry in the "Quotes" list of the response.
+
+        placeNames, carrierNames(dictionaries): PlaceId -> Name and
+        CarrierId -> Name for the response.
+
+        carrierTuples(dictionary): Carrier tuples already built for the
+        response, refer to _formatLeg.
+
+    Returns:
+        formattedResult(Quote): As described in BrowseQuotesFormatResults.
+
+    Exceptions:
+        KeyError: If the quote does not have a price or outbound leg.
+    """
+    outbound = _formatLeg(quote['OutboundLeg'], placeNames, carrierNames, carrierTuples)
+
+    # Inbound leg, if present
+    inboundLeg = quote.get('InboundLeg')
+    inbound = _formatLeg(inboundLeg, placeNames, carrierNames, carrierTuples) if inboundLeg else None
+
+    return Quote(quote['MinPrice'], quote.get('Direct'), outbound, inbound)
+
+
+def BrowseQuotesErrors(rawResults):
+    """
+    Returns the error responses within a list of raw Browse Quotes API responses,
+    i.e. those that were not successful and so contribute no formatted results.
+
+    Args:
+        rawResults(list (of dictionaries)): A list of dictionaries, each of which has format,
+        received from BrowseQuotesGetData function.
+
+    Returns:
+        errors(list (of dictionaries)): The responses without a "Quotes" key.
+    """
+    return [result for result in rawResults
+            if not isinstance(result, dict) or "Quotes" not in result]
+
+
 def validSsAPIResponse(response_json):
     """
     TODO - Requires conversion for Browse Quotes API end point.
@@ -303,10 +965,10 @@ def getLocationsAll():
     # Iterate for each letter in alphabet
     for letter in string.ascii_lowercase:
         # Define fixed URL and query parameters
-        url =  "https://skyscanner-skyscanner-flight-search-v1.p.rapidapi.com/apiservices/autosuggest/v1.0/UK/GBP/en-GB/"
+        url =  apiBaseUrl + "/apiservices/autosuggest/v1.0/UK/GBP/en-GB/"
         querystring = {"query":letter}
         # Call API and receive string response. Example format in ./dev_area/results_places.txt
-        response_string = requests.request("GET", url, headers=headers, params=querystring)
+        response_string = apiGet(url, params=querystring)
         # Convert to JSON / dictionary
         response_json = response_string.json()
         # Retreive places as list of dictionaries, and append to full list
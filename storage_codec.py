@@ -0,0 +1,172 @@
+"""
+This file contains the codec used to store json values in the Escapade
+database (refer to encodedColumns in db_functions.py), such as the raw
+BrowseQuotes responses in browse_quotes_results.resultsJson.
+
+Values are serialised to json, using orjson if it is installed, and
+compressed with zstd (if the zstandard package is installed) or zlib. The
+first byte of each stored value records how it was compressed. Values stored
+as plain json text by earlier versions are still read.
+
+To convert the values already in a database, refer to "migrate-codec" in
+db_tools.py.
+"""
+
+import json
+import threading
+import zlib
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Codec used by encodeJson: "zstd", "zlib", or "none" for plain json text
+storageCodec = "zstd" if zstandard is not None else "zlib"
+
+# Compression level for each codec
+compressionLevels = {"zlib": 6, "zstd": 3}
+
+# Version byte at the start of each compressed value. Plain json text values
+# are stored as text, so are told apart by their type.
+_versionZlib = 1
+_versionZstd = 2
+
+# zstandard compressors are not thread safe, so each thread has its own
+_zstdLocal = threading.local()
+
+
+def availableCodecs():
+    """
+    Returns the codecs that may be used in this environment.
+    """
+    return ["none", "zlib"] + (["zstd"] if zstandard is not None else [])
+
+
+def dumpsJson(obj):
+    """
+    Serialises obj to json, as bytes, using orjson if it is installed.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode()
+
+
+def canonicalJson(obj):
+    """
+    Serialises obj to json bytes with sorted keys, so that equal objects give
+    equal bytes, e.g. for hashing.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+    return json.dumps(obj, sort_keys=True, separators=(",", ":"), ensure_ascii=False).encode()
+
+
+def loadsJson(data):
+    """
+    Deserialises json bytes or text, using orjson if it is installed.
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _zstd():
+    """
+    Returns the (compressor, decompressor) for the current thread.
+    """
+    if not hasattr(_zstdLocal, "codecs"):
+        _zstdLocal.codecs = (zstandard.ZstdCompressor(level=compressionLevels["zstd"]),
+                             zstandard.ZstdDecompressor())
+    return _zstdLocal.codecs
+
+
+def encodeJson(obj, codec=None):
+    """
+    Encodes a json serialisable object for storage in the database.
+
+    Args:
+        obj: The object to store, e.g. a list of API responses.
+
+        codec(string): Optional, one of availableCodecs. Defaults to
+        storageCodec.
+
+    Returns:
+        value(bytes or string): The value to store. A string if codec is "none".
+
+    Exceptions:
+        ValueError: If the codec is unknown or not available.
+    """
+    return encodeJsonBytes(dumpsJson(obj), codec)
+
+
+def encodeJsonBytes(data, codec=None):
+    """
+    Like encodeJson, for an object already serialised to json bytes, e.g. by
+    canonicalJson.
+    """
+    codec = codec or storageCodec
+
+    if codec == "none":
+        return data.decode()
+    if codec == "zlib":
+        return bytes([_versionZlib]) + zlib.compress(data, compressionLevels["zlib"])
+    if codec == "zstd" and zstandard is not None:
+        return bytes([_versionZstd]) + _zstd()[0].compress(data)
+
+    raise ValueError("Storage codec not available: {}".format(codec))
+
+
+def decodeJson(value):
+    """
+    Decodes a value stored by encodeJson, or a plain json text value stored by
+    an earlier version.
+
+    Args:
+        value(bytes or string): The stored value. May be None.
+
+    Returns:
+        obj: The stored object, or None if value is None.
+
+    Exceptions:
+        ValueError: If the value was compressed with an unknown or unavailable
+        codec.
+    """
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return loadsJson(value)
+
+    version = value[0]
+    if version == _versionZlib:
+        return loadsJson(zlib.decompress(value[1:]))
+    if version == _versionZstd:
+        if zstandard is None:
+            raise ValueError("The zstandard package is required to read this value")
+        return loadsJson(_zstd()[1].decompress(value[1:]))
+
+    raise ValueError("Unknown storage codec version: {}".format(version))
+
+
+def valueCodec(value):
+    """
+    Returns the codec of a stored value: "none", "zlib" or "zstd". None if the
+    value is None.
+    """
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return "none"
+    return {_versionZlib: "zlib", _versionZstd: "zstd"}.get(value[0], "unknown")
+
+
+def storedSize(value):
+    """
+    Returns the size in bytes of a stored value, bytes or text.
+    """
+    return len(value.encode()) if isinstance(value, str) else len(value)
@@ -0,0 +1,282 @@
+"""
+This file runs write-behind logging: writes are queued by the threads serving
+requests and committed by one background writer thread, many writes to a
+transaction, so that a request does not wait for its writes to be serialised
+and committed. logBQQuery and logBQResults in db_functions.py use one
+WriteBehindLogger per database when db_functions.writeBehind is set.
+
+The queue is bounded. When the writer falls behind and the queue is full,
+put blocks until there is room, so a burst of searches slows the requests
+making them rather than using unbounded memory. Blocked puts and the time
+spent blocked are counted, with the age of the oldest unwritten item (lag),
+refer to WriteBehindLogger.status.
+
+Items are written in the order they are queued. Each item may be queued with
+keys naming what it writes (e.g. a search), and a reader calls waitFor with
+the key first so that it never reads before a queued write is committed. If
+the write failed, waitFor returns False so that the reader can report it
+rather than read a row that was never stored.
+"""
+
+import queue
+import threading
+import time
+
+# Queued in place of an item to stop the writer thread
+_stop = object()
+
+
+class WriteFailedError(RuntimeError):
+    """Raised by readers when a queued write they wait for was not written"""
+
+
+class WriteBehindLogger:
+    """
+    A bounded queue of writes, committed in batches by a background writer
+    thread.
+
+    Args:
+        writeBatch(function): Called by the writer thread with a list of
+        queued items, in the order queued, to write them in one transaction.
+        Raises an exception if the batch is not written.
+
+        queueSize(integer): The most items queued before put blocks.
+
+        batchSize(integer): The most items passed to writeBatch at once.
+
+        name(string): Optional, the name of the writer thread.
+    """
+    def __init__(self, writeBatch, queueSize, batchSize, name="write_behind"):
+        self.writeBatch = writeBatch
+        self.queueSize = queueSize
+        self.batchSize = batchSize
+
+        self._queue = queue.Queue(maxsize=queueSize)
+
+        # Keeps the sequence of items equal to their order in the queue
+        self._putLock = threading.Lock()
+
+        # Guards the counters below, and is notified as items are written
+        self._written = threading.Condition()
+        self._lastSeq = 0 # The last item queued
+        self._writtenSeq = 0 # The last item written, or failed to be written
+        self._pendingKeys = {} # key: the last item queued with the key
+        self._failedKeys = {} # key: the last item with the key, if it was not written
+        self._writingSince = None # When the oldest item being written was queued
+        self._closed = False
+        self._counters = {"queued": 0, "written": 0, "failed": 0, "batches": 0, "maxQueued": 0,
+                          "blockedPuts": 0, "blockedSeconds": 0.0, "waits": 0, "waitSeconds": 0.0,
+                          "lastLag": 0.0, "maxLag": 0.0}
+
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def put(self, item, keys=()):
+        """
+        Queues an item to be written, blocking while the queue is full.
+
+        Args:
+            item(object): Passed to writeBatch.
+
+            keys(iterable): Optional, keys for waitFor to wait on until the
+            item is written.
+
+        Exceptions:
+            RuntimeError: If the logger has been closed.
+        """
+        with self._putLock:
+            with self._written:
+                if self._closed:
+                    raise RuntimeError("Write-behind logger is closed")
+                self._lastSeq += 1
+                seq = self._lastSeq
+                for key in keys:
+                    self._pendingKeys[key] = seq
+
+            entry = (seq, time.monotonic(), keys, item)
+            try:
+                self._queue.put_nowait(entry)
+            except queue.Full:
+                blockedFrom = time.monotonic()
+                self._queue.put(entry)
+                with self._written:
+                    self._counters["blockedPuts"] += 1
+                    self._counters["blockedSeconds"] += time.monotonic() - blockedFrom
+
+            with self._written:
+                self._counters["queued"] += 1
+                self._counters["maxQueued"] = max(self._counters["maxQueued"], self._queue.qsize())
+
+    def waitFor(self, key=None, timeout=None):
+        """
+        Waits until the items queued with a key have been written.
+
+        Args:
+            key(object): Optional, as given to put. If None, waits for every
+            item queued so far.
+
+            timeout(float): Optional, the most seconds to wait.
+
+        Returns:
+            (Bool): False if the timeout passed first, or if the last item
+            queued with the key could not be written, otherwise True. Items
+            queued without a key are not checked, refer to status.
+        """
+        # The writer never waits on itself, e.g. if writeBatch reads
+        if threading.current_thread() is self._thread:
+            return True
+
+        with self._written:
+            target = self._lastSeq if key is None else self._pendingKeys.get(key)
+            if target is not None and self._writtenSeq < target:
+                waitFrom = time.monotonic()
+                done = self._written.wait_for(lambda: self._writtenSeq >= target, timeout)
+                self._counters["waits"] += 1
+                self._counters["waitSeconds"] += time.monotonic() - waitFrom
+                if not done:
+                    return False
+
+            return key is None or key not in self._failedKeys
+
+    def flush(self, timeout=None):
+        """
+        Waits until every item queued so far has been written, refer to
+        waitFor.
+        """
+        return self.waitFor(None, timeout)
+
+    def close(self, timeout=None):
+        """
+        Writes the items still queued, then stops the writer thread. Items
+        may not be queued once closed.
+
+        Args:
+            timeout(float): Optional, the most seconds to wait.
+
+        Returns:
+            (Bool): False if the writer thread was still running when the
+            timeout passed, otherwise True.
+        """
+        with self._putLock:
+            with self._written:
+                if self._closed:
+                    return not self._thread.is_alive()
+                self._closed = True
+            self._queue.put(_stop)
+
+        self._thread.join(timeout)
+
+        return not self._thread.is_alive()
+
+    def status(self):
+        """
+        Returns the backpressure and lag counters of the logger.
+
+        Returns:
+            status (dictionary): With the keys:
+                pending (integer): Items queued or being written
+                queueSize (integer): The most items queued before put blocks
+                maxQueued (integer): The most items that have been queued at once
+                queued (integer): Items queued since the logger started
+                written (integer): Items written
+                failed (integer): Items that could not be written
+                batches (integer): Transactions committed by the writer
+                blockedPuts (integer): Puts that waited for room in the queue
+                blockedSeconds (float): Total seconds puts waited for room
+                waits (integer): Reads that waited for a queued write
+                waitSeconds (float): Total seconds reads waited
+                lag (float): Seconds the oldest unwritten item has been queued
+                lastLag (float): Seconds from queued to written of the oldest
+                    item in the last batch
+                maxLag (float): The greatest lastLag so far
+        """
+        with self._written:
+            status = dict(self._counters)
+            status["pending"] = self._lastSeq - self._writtenSeq
+            status["queueSize"] = self.queueSize
+
+            oldest = self._writingSince
+            if oldest is None:
+                with self._queue.mutex:
+                    if self._queue.queue and self._queue.queue[0] is not _stop:
+                        oldest = self._queue.queue[0][1]
+            status["lag"] = time.monotonic() - oldest if oldest is not None else 0.0
+
+        return status
+
+    def _run(self):
+        """
+        The writer thread: takes up to batchSize items already queued, writes
+        them through writeBatch, and repeats until closed. Items queued while
+        a batch is written make up the next batch, so the batches grow with
+        the load.
+        """
+        stopping = False
+        while not stopping:
+            entry = self._queue.get()
+            if entry is _stop:
+                break
+
+            batch = [entry]
+            while len(batch) < self.batchSize:
+                try:
+                    entry = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if entry is _stop:
+                    stopping = True
+                    break
+                batch.append(entry)
+
+            with self._written:
+                self._writingSince = batch[0][1]
+
+            failed = self._writeEntries(batch)
+            writtenAt = time.monotonic()
+
+            with self._written:
+                self._writtenSeq = batch[-1][0]
+                for seq, queuedAt, keys, item in batch:
+                    for key in keys:
+                        if seq in failed:
+                            self._failedKeys[key] = seq
+                        elif self._failedKeys.get(key, seq) < seq:
+                            del self._failedKeys[key]
+                        if self._pendingKeys.get(key, seq) <= seq:
+                            self._pendingKeys.pop(key, None)
+                self._writingSince = None
+
+                lag = writtenAt - batch[0][1]
+                self._counters["written"] += len(batch) - len(failed)
+                self._counters["failed"] += len(failed)
+                self._counters["batches"] += 1
+                self._counters["lastLag"] = lag
+                self._counters["maxLag"] = max(self._counters["maxLag"], lag)
+                self._written.notify_all()
+
+    def _writeEntries(self, batch):
+        """
+        Writes a batch of queue entries. If the batch fails, each item is
+        retried alone, so that one bad item does not lose the others.
+
+        Returns:
+            failed(set): The sequence numbers of the items that could not be
+            written.
+        """
+        try:
+            self.writeBatch([entry[3] for entry in batch])
+            return set()
+        except Exception as e:
+            if len(batch) == 1:
+                print(e)
+                return {batch[0][0]}
+
+        failed = set()
+        for entry in batch:
+            try:
+                self.writeBatch([entry[3]])
+            except Exception as e:
+                print(e)
+                failed.add(entry[0])
+
+        return failed